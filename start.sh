@@ -12,10 +12,6 @@ if [ -z "$AGENT_SLEEP_SECONDS" ] ; then
 fi
 
 TIMEOUT=540 # 9 minutes
-while :
-do
-    echo "Executing AWS agent..."
-    timeout $TIMEOUT zmon-aws-agent -e $ENTITY_SERVICE_URL
-    echo "sleeping..." $AGENT_SLEEP_SECONDS "seconds"
-    sleep $AGENT_SLEEP_SECONDS
-done
+
+echo "Executing AWS agent..."
+exec zmon-aws-agent -e $ENTITY_SERVICE_URL --daemon --interval $AGENT_SLEEP_SECONDS --cycle-timeout $TIMEOUT
@@ -8,7 +8,12 @@ import pytest
 
 from botocore.exceptions import ClientError
 
-from zmon_aws_agent.aws import get_hash
+from zmon_aws_agent.aws import get_hash, USER_DATA_CACHE, ELB_LISTENERS_CACHE, IMAGE_CACHE, DNS_ZONE_CACHE, \
+    DNS_RR_CACHE_ZONE, DNS_CNAME_CACHE_ZONE, DNS_ZONE_SNAPSHOTS, DNS_WEIGHT_INDEX, DNS_CNAME_INDEX, \
+    DYNAMODB_TABLES_CACHE, ACM_CERTIFICATE_CACHE, ACCOUNT_METADATA_CACHE
+from zmon_aws_agent.common import CLIENTS
+from zmon_aws_agent.elastigroup import STACK_ELASTIGROUPS_CACHE, SPOTINST_CLIENTS
+from zmon_aws_agent.postgresql import POSTGRESQL_DATABASES_CACHE, EIP_ALLOCATION_CACHE
 
 
 ACCOUNT = 'aws:1234'
@@ -21,6 +26,27 @@ class ThrottleError(ClientError):
         self.response = {'Error': {'Code': 'Throttling' if throttling else 'BadRequest'}}
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    CLIENTS.clear()
+    USER_DATA_CACHE.clear()
+    ELB_LISTENERS_CACHE.clear()
+    DYNAMODB_TABLES_CACHE.clear()
+    ACM_CERTIFICATE_CACHE.clear()
+    ACCOUNT_METADATA_CACHE.clear()
+    IMAGE_CACHE.clear()
+    DNS_ZONE_CACHE.clear()
+    DNS_RR_CACHE_ZONE.clear()
+    DNS_ZONE_SNAPSHOTS.clear()
+    DNS_CNAME_CACHE_ZONE.clear()
+    DNS_WEIGHT_INDEX.clear()
+    DNS_CNAME_INDEX.clear()
+    POSTGRESQL_DATABASES_CACHE.clear()
+    EIP_ALLOCATION_CACHE.clear()
+    STACK_ELASTIGROUPS_CACHE.clear()
+    SPOTINST_CLIENTS.clear()
+
+
 def get_elc_cluster():
     cluster = {
         'CacheClusterStatus': 'available',
@@ -182,7 +208,10 @@ def get_elbs_application():
 
     tags = {'TagDescriptions': [{'ResourceArn': 'arn-/app/elb-1/123456', 'Tags': []}]}
 
-    groups = {'TargetGroups': [{'TargetGroupArn': 'arn-group-1-elb-1'}]}
+    groups = {'TargetGroups': [
+        {'TargetGroupArn': 'arn-group-1-elb-1', 'LoadBalancerArns': ['arn-/app/elb-1/123456']},
+        {'TargetGroupArn': 'arn-group-2-unused', 'LoadBalancerArns': []},
+    ]}
 
     health = {
         'TargetHealthDescriptions': [
@@ -254,7 +283,7 @@ def get_apps():
         ]
     }
 
-    status_resp = {'InstanceStatuses': [{'Events': ['ev-1', 'ev-2']}]}
+    status_resp = {'InstanceStatuses': [{'InstanceId': 'ins-1', 'Events': ['ev-1', 'ev-2']}, {'InstanceId': 'ins-2'}]}
 
     user_data = [
         {
@@ -353,7 +382,7 @@ def get_apps_existing():
         ]
     }
 
-    status_resp = {'InstanceStatuses': [{'Events': ['ev-1', 'ev-2']}]}
+    status_resp = {'InstanceStatuses': [{'InstanceId': 'ins-1', 'Events': ['ev-1', 'ev-2']}, {'InstanceId': 'ins-2'}]}
 
     user_data = [
         {
@@ -803,17 +832,6 @@ def fx_hosted_zones(request):
          'Id': '/hostedzone/Z1FLVOF8MF971S'}]}
 
 
-@pytest.fixture()
-def fx_hosted_zones_expected(request):
-    return ['/hostedzone/Z1FLVOF8MF971S']
-
-
-@pytest.fixture()
-def fx_launch_configuration_expected(request):
-    return {'malm': 'ZW52aXJvbm1lbnQ6IHtFSVBfQUxMT0NBVElPTjogZWlwYWxsb2MtMjIzMzQ0NTV9Cg==',
-            'foo-staging': 'ZW52aXJvbm1lbnQ6IHtFSVBfQUxMTzMzQ0NTV9Cg=='}
-
-
 @pytest.fixture()
 def fx_recordsets(request):
     return {'ResourceRecordSets': [
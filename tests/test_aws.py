@@ -1,9 +1,17 @@
+import base64
+import json
+import time
 import pytest
 
-from mock import MagicMock, call
+from datetime import datetime
+
+from mock import MagicMock, call, ANY
 
 import zmon_aws_agent.aws as aws
 
+from zmon_aws_agent.common import MAX_PAGE
+from zmon_aws_agent.inventory import RegionInventory
+
 from conftest import ThrottleError
 from conftest import ACCOUNT, REGION
 from conftest import get_elc_cluster, get_autoscaling, get_elbs, get_elbs_application, get_apps, get_certificates, \
@@ -45,13 +53,16 @@ def test_aws_get_account_alias(monkeypatch, result):
     if type(result) is dict:
         fail = False
 
+    sts_client = MagicMock()
+    sts_client.get_caller_identity.return_value = {'Account': '12'}
+
     iam_client = MagicMock()
     if fail:
         iam_client.list_account_aliases.side_effect = result
     else:
         iam_client.list_account_aliases.return_value = result
 
-    boto = get_boto_client(monkeypatch, iam_client)
+    boto = get_boto_client(monkeypatch, sts_client, iam_client)
 
     res = aws.get_account_alias(REGION)
 
@@ -60,33 +71,74 @@ def test_aws_get_account_alias(monkeypatch, result):
     else:
         assert res == result['AccountAliases'][0]
 
-    boto.assert_called_with('iam', region_name=REGION)
+    boto.assert_called_with('iam', region_name=REGION, config=ANY)
 
 
-@pytest.mark.parametrize(
-    'result', [{'Roles': [{'Arn': 'arn:iam:aws::12:eu'}, {'Arn': 'arn:iam:aws::12:eu'}]}, RuntimeError]
-)
+@pytest.mark.parametrize('result', [{'Account': '12', 'Arn': 'arn:aws:sts::12:assumed-role/agent/i-1'}, RuntimeError])
 def test_aws_get_account_id(monkeypatch, result):
     fail = True
     if type(result) is dict:
         fail = False
 
-    iam_client = MagicMock()
+    sts_client = MagicMock()
     if fail:
-        iam_client.list_roles.side_effect = result
+        sts_client.get_caller_identity.side_effect = result
     else:
-        iam_client.list_roles.return_value = result
+        sts_client.get_caller_identity.return_value = result
 
-    boto = get_boto_client(monkeypatch, iam_client)
+    boto = get_boto_client(monkeypatch, sts_client)
+    monkeypatch.setattr('zmon_aws_agent.aws.call_and_retry', call_retry_mock)
 
     res = aws.get_account_id(REGION)
 
     if fail:
         assert res is None
     else:
-        assert res == result['Roles'][0]['Arn'].split(':')[4]
+        assert res == result['Account']
+
+    boto.assert_called_with('sts', region_name=REGION, config=ANY)
+
+
+def test_aws_get_account_metadata_cached(monkeypatch):
+    sts_client = MagicMock()
+    sts_client.get_caller_identity.return_value = {'Account': '12'}
+
+    iam_client = MagicMock()
+    iam_client.list_account_aliases.return_value = {'AccountAliases': ['alias-1']}
+
+    get_boto_client(monkeypatch, sts_client, iam_client)
+
+    saved = {}
+    monkeypatch.setattr('zmon_aws_agent.aws.save_cache', lambda name, data: saved.update({name: data}))
+
+    now = 1000
+    monkeypatch.setattr('zmon_aws_agent.aws.time.time', lambda: now)
+
+    assert aws.get_account_id(REGION) == '12'
+    assert aws.get_account_alias(REGION) == 'alias-1'
+    assert aws.get_account_id(REGION) == '12'
+    assert aws.get_account_alias(REGION) == 'alias-1'
+
+    sts_client.get_caller_identity.assert_called_once_with()
+    iam_client.list_account_aliases.assert_called_once_with()
+
+    # the account ID is not persisted
+    assert list(saved['account_metadata']) == [('12', REGION, 'alias')]
 
-    boto.assert_called_with('iam', region_name=REGION)
+    monkeypatch.setattr('zmon_aws_agent.aws.time.time', lambda: now + aws.ACCOUNT_ALIAS_TTL + 1)
+
+    assert aws.get_account_alias(REGION) == 'alias-1'
+    assert iam_client.list_account_aliases.call_count == 2
+
+
+def test_aws_get_account_metadata_persisted(monkeypatch):
+    monkeypatch.setattr('zmon_aws_agent.aws.load_cache',
+                        lambda name, default: {('12', REGION, 'alias'): (time.time() + 60, 'alias-1')})
+
+    load = MagicMock()
+
+    assert aws.get_account_metadata(('12', REGION, 'alias'), 60, load) == 'alias-1'
+    load.assert_not_called()
 
 
 def test_aws_get_apps_from_entities(monkeypatch):
@@ -143,7 +195,7 @@ def test_aws_get_rds_instances(monkeypatch, fx_rds, minute):
 
         rds_client.get_paginator.assert_called_with('describe_db_instances')
 
-        boto.assert_called_with('rds', region_name=REGION)
+        boto.assert_called_with('rds', region_name=REGION, config=ANY)
 
 
 def test_aws_get_dynamodb_tables(monkeypatch, fx_dynamodb):
@@ -155,7 +207,8 @@ def test_aws_get_dynamodb_tables(monkeypatch, fx_dynamodb):
 
     dynamodb_client = MagicMock()
     dynamodb_client.get_paginator.return_value.paginate.return_value.build_full_result.return_value = resp
-    dynamodb_client.describe_table.side_effect = tables
+    descriptions = {t['Table']['TableName']: t for t in tables}
+    dynamodb_client.describe_table.side_effect = lambda TableName: descriptions[TableName]
     if fail:
         dynamodb_client.get_paginator.return_value.paginate.return_value.build_full_result.side_effect = resp
 
@@ -175,7 +228,40 @@ def test_aws_get_dynamodb_tables(monkeypatch, fx_dynamodb):
 
     dynamodb_client.get_paginator.assert_called_with('list_tables')
 
-    boto.assert_called_with('dynamodb', region_name=REGION)
+    boto.assert_called_with('dynamodb', region_name=REGION, config=ANY)
+
+
+def test_aws_get_dynamodb_table_descriptions_cached(monkeypatch):
+    tables = {
+        't-1': {'TableStatus': 'ACTIVE', 'TableName': 't-1', 'TableArn': 'aws.t-1', 'ItemCount': 10},
+        't-2': {'TableStatus': 'CREATING', 'TableName': 't-2', 'TableArn': 'aws.t-2'},
+    }
+
+    ddb = MagicMock()
+    ddb.describe_table.side_effect = lambda TableName: {'Table': tables[TableName]}
+
+    aws.DYNAMODB_TABLES_CACHE[('other-region', 't-1')] = (0, {})
+    aws.DYNAMODB_TABLES_CACHE[(REGION, 't-3')] = (0, {})
+
+    now = 1000
+    monkeypatch.setattr('zmon_aws_agent.aws.time.time', lambda: now)
+
+    res = aws.get_dynamodb_table_descriptions(ddb, REGION, ['t-1', 't-2'])
+
+    assert res == [{'TableStatus': 'ACTIVE', 'TableName': 't-1', 'TableArn': 'aws.t-1'},
+                   {'TableStatus': 'CREATING', 'TableName': 't-2', 'TableArn': 'aws.t-2'}]
+    assert sorted(aws.DYNAMODB_TABLES_CACHE) == sorted([('other-region', 't-1'), (REGION, 't-1'), (REGION, 't-2')])
+    assert ddb.describe_table.call_count == 2
+
+    # transitioning tables expire earlier than active ones
+    tables['t-2']['TableStatus'] = 'ACTIVE'
+    monkeypatch.setattr('zmon_aws_agent.aws.time.time', lambda: now + aws.DYNAMODB_TABLES_TRANSITION_TTL + 1)
+
+    res = aws.get_dynamodb_table_descriptions(ddb, REGION, ['t-1', 't-2'])
+
+    assert [t['TableStatus'] for t in res] == ['ACTIVE', 'ACTIVE']
+    assert ddb.describe_table.call_count == 3
+    ddb.describe_table.assert_called_with(TableName='t-2')
 
 
 def test_aws_get_elasticache(monkeypatch):
@@ -192,7 +278,7 @@ def test_aws_get_elasticache(monkeypatch):
 
     elc_client.get_paginator.assert_called_with('describe_cache_clusters')
 
-    boto.assert_called_with('elasticache', region_name=REGION)
+    boto.assert_called_with('elasticache', region_name=REGION, config=ANY)
 
 
 def test_aws_get_auto_scaling_groups(monkeypatch):
@@ -212,10 +298,48 @@ def test_aws_get_auto_scaling_groups(monkeypatch):
 
     asg_client.get_paginator.assert_called_with('describe_auto_scaling_groups')
     ec2_client.get_paginator.assert_called_with('describe_instances')
-    ec2_client.get_paginator.return_value.paginate.assert_called_with(InstanceIds=instance_ids)
+    ec2_client.get_paginator.return_value.paginate.assert_called_once_with(PaginationConfig={'MaxItems': MAX_PAGE})
 
-    calls = [call('autoscaling', region_name=REGION), call('ec2', region_name=REGION)]
-    boto.assert_has_calls(calls, any_order=True)
+    calls = [call('autoscaling', region_name=REGION, config=ANY), call('ec2', region_name=REGION, config=ANY)]
+    boto.assert_has_calls(calls)
+
+
+def test_aws_get_auto_scaling_groups_single_instance_lookup(monkeypatch):
+    resp, reservations, instance_ids, result = get_autoscaling()
+
+    second = dict(resp['AutoScalingGroups'][0], AutoScalingGroupName='asg-2',
+                  Instances=[{'InstanceId': 'ins-1', 'LifecycleState': 'InService'},
+                             {'InstanceId': 'ins-5', 'LifecycleState': 'InService'}])
+    resp['AutoScalingGroups'].append(second)
+
+    asg_client = MagicMock()
+    asg_client.get_paginator.return_value.paginate.return_value.build_full_result.return_value = resp
+
+    ec2_client = MagicMock()
+    ec2_client.get_paginator.return_value.paginate.return_value.build_full_result.return_value = reservations
+
+    get_boto_client(monkeypatch, asg_client, ec2_client)
+
+    res = aws.get_auto_scaling_groups(REGION, ACCOUNT)
+
+    assert [g['instances'] for g in res] == [[{'aws_id': 'ins-1', 'ip': '192.168.20.16'}]] * 2
+
+    ec2_client.get_paginator.return_value.paginate.assert_called_once_with(PaginationConfig={'MaxItems': MAX_PAGE})
+
+
+def test_aws_get_auto_scaling_groups_shared_inventory(monkeypatch):
+    resp, reservations, instance_ids, result = get_autoscaling()
+
+    inventory = RegionInventory(REGION)
+    inventory._data.update(auto_scaling_groups=resp['AutoScalingGroups'], reservations=reservations['Reservations'])
+
+    boto = get_boto_client(monkeypatch)
+
+    res = aws.get_auto_scaling_groups(REGION, ACCOUNT, inventory=inventory)
+
+    assert res == result
+
+    boto.assert_not_called()
 
 
 def test_aws_get_running_elbs(monkeypatch):
@@ -266,7 +390,25 @@ def test_aws_get_running_elbs_classic(monkeypatch, exc):
 
     elb_client.get_paginator.assert_called_with('describe_load_balancers')
 
-    boto.assert_called_with('elb', region_name=REGION)
+    boto.assert_called_with('elb', region_name=REGION, config=ANY)
+
+
+def test_aws_get_running_elbs_classic_without_instances(monkeypatch):
+    resp, tags, health, result = get_elbs()
+
+    resp['LoadBalancerDescriptions'][0]['Instances'] = []
+    result[0]['members'] = 0
+    result[0]['active_members'] = 0
+
+    elb_client = MagicMock()
+    elb_client.get_paginator.return_value.paginate.return_value.build_full_result.return_value = resp
+    elb_client.describe_tags.return_value = tags
+
+    get_boto_client(monkeypatch, elb_client)
+
+    assert aws.get_running_elbs_classic(REGION, ACCOUNT) == result
+
+    elb_client.describe_instance_health.assert_not_called()
 
 
 @pytest.mark.parametrize('exc', [True, ThrottleError(), ThrottleError(throttling=False), RuntimeError])
@@ -312,23 +454,53 @@ def test_aws_get_running_elbs_application(monkeypatch, exc):
     calls = [call('describe_load_balancers'), call('describe_target_groups')]
     elb_client.get_paginator.assert_has_calls(calls)
 
-    boto.assert_called_with('elbv2', region_name=REGION)
+    boto.assert_called_with('elbv2', region_name=REGION, config=ANY)
+    if not fail:
+        elb_client.describe_target_health.assert_called_once_with(TargetGroupArn='arn-group-1-elb-1')
 
 
-@pytest.mark.parametrize('fail', [False, True])
-def test_aws_get_certificates(monkeypatch, fail):
-    resp_iam, resp_acm, acm_certs, result = get_certificates()
+def test_aws_get_running_elbs_application_listeners_cache(monkeypatch):
+    resp, tags, listeners, groups, health, result = get_elbs_application()
 
+    elb_client = MagicMock()
+    elb_client.get_paginator.return_value.paginate.return_value.build_full_result.side_effect = [
+        resp, groups, resp, groups, {'LoadBalancers': []}, groups]
+    elb_client.describe_tags.return_value = tags
+    elb_client.describe_listeners.return_value = listeners
+    elb_client.describe_target_health.return_value = health
+
+    get_boto_client(monkeypatch, elb_client)
+
+    assert aws.get_running_elbs_application(REGION, ACCOUNT) == result
+    assert aws.get_running_elbs_application(REGION, ACCOUNT) == result
+
+    elb_client.describe_listeners.assert_called_once_with(LoadBalancerArn='arn-/app/elb-1/123456')
+
+    assert aws.get_running_elbs_application(REGION, ACCOUNT) == []
+    assert aws.ELB_LISTENERS_CACHE == {}
+
+
+def get_certificate_clients(resp_iam, resp_acm, acm_certs):
     iam_client = MagicMock()
-    iam_client.list_server_certificates.return_value = resp_iam
+    iam_client.get_paginator.return_value.paginate.return_value.build_full_result.return_value = resp_iam
+
+    certificates = {c['Certificate']['CertificateArn']: c for c in acm_certs}
 
     acm_client = MagicMock()
-    if not fail:
-        acm_client.list_certificates.return_value = resp_acm
-        acm_client.describe_certificate.side_effect = acm_certs
-    else:
+    acm_client.get_paginator.return_value.paginate.return_value.build_full_result.return_value = resp_acm
+    acm_client.describe_certificate.side_effect = lambda CertificateArn: certificates[CertificateArn]
+
+    return iam_client, acm_client
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_aws_get_certificates(monkeypatch, fail):
+    resp_iam, resp_acm, acm_certs, result = get_certificates()
+
+    iam_client, acm_client = get_certificate_clients(resp_iam, resp_acm, acm_certs)
+    if fail:
         result = []
-        acm_client.list_certificates.side_effect = RuntimeError
+        acm_client.get_paginator.return_value.paginate.return_value.build_full_result.side_effect = RuntimeError
 
     monkeypatch.setattr('zmon_aws_agent.aws.call_and_retry', call_retry_mock)
     boto = get_boto_client(monkeypatch, iam_client, acm_client)
@@ -337,17 +509,81 @@ def test_aws_get_certificates(monkeypatch, fail):
 
     assert res == result
 
-    calls = [call('iam', region_name=REGION), call('acm', region_name=REGION)]
+    calls = [call('iam', region_name=REGION, config=ANY), call('acm', region_name=REGION, config=ANY)]
     boto.assert_has_calls(calls)
 
+    iam_client.get_paginator.assert_called_with('list_server_certificates')
+    acm_client.get_paginator.assert_called_with('list_certificates')
+
+
+def test_aws_get_certificates_cached(monkeypatch):
+    resp_iam, resp_acm, acm_certs, result = get_certificates()
+
+    for c in acm_certs:
+        c['Certificate']['Status'] = 'ISSUED'
+        c['Certificate']['NotAfter'] = datetime(2030, 1, 1)
+    acm_certs[2]['Certificate']['NotAfter'] = datetime(2020, 1, 1)
+
+    iam_client, acm_client = get_certificate_clients(resp_iam, resp_acm, acm_certs)
+
+    monkeypatch.setattr('zmon_aws_agent.aws.call_and_retry', call_retry_mock)
+    get_boto_client(monkeypatch, iam_client, acm_client)
+
+    now = datetime(2025, 1, 1).timestamp()
+    monkeypatch.setattr('zmon_aws_agent.aws.time.time', lambda: now)
+
+    res = aws.get_certificates(REGION, ACCOUNT)
+
+    assert [e['name'] for e in res] == ['zmon-cert-1', 'zmon-cert-2', 'zmon-cert-3', 'zmon-cert-4']
+    assert acm_client.describe_certificate.call_count == 3
+
+    # only the expired certificate is described again, and failures keep the cached details
+    acm_client.describe_certificate.side_effect = ThrottleError(throttling=False)
+    monkeypatch.setattr('zmon_aws_agent.aws.time.time', lambda: now + aws.ACM_CERTIFICATE_TRANSITION_TTL + 1)
+
+    assert aws.get_certificates(REGION, ACCOUNT) == res
+    assert acm_client.describe_certificate.call_count == 4
+    acm_client.describe_certificate.assert_called_with(CertificateArn='arn-acm-zmon-cert-4/4-123')
+
+    # removed certificates are evicted
+    resp_acm['CertificateSummaryList'].pop(0)
+
+    assert [e['name'] for e in aws.get_certificates(REGION, ACCOUNT)] == ['zmon-cert-1', 'zmon-cert-3', 'zmon-cert-4']
+    cached = sorted(arn for _, arn in aws.ACM_CERTIFICATE_CACHE)
+    assert cached == ['arn-acm-zmon-cert-3/3-123', 'arn-acm-zmon-cert-4/4-123']
+
+
+def test_aws_get_certificates_skips_failed(monkeypatch):
+    resp_iam, resp_acm, acm_certs, result = get_certificates()
+
+    iam_client, acm_client = get_certificate_clients(resp_iam, resp_acm, acm_certs)
+
+    certificates = {c['Certificate']['CertificateArn']: c for c in acm_certs}
+    certificates['arn-acm-zmon-cert-3/3-123'] = ThrottleError(throttling=False)
+
+    def describe_certificate(CertificateArn):
+        if isinstance(certificates[CertificateArn], Exception):
+            raise certificates[CertificateArn]
+        return certificates[CertificateArn]
+
+    acm_client.describe_certificate.side_effect = describe_certificate
+
+    monkeypatch.setattr('zmon_aws_agent.aws.call_and_retry', call_retry_mock)
+    get_boto_client(monkeypatch, iam_client, acm_client)
+
+    assert aws.get_certificates(REGION, ACCOUNT) == [e for e in result if e['name'] != 'zmon-cert-3']
+
 
 def test_aws_get_running_apps(monkeypatch):
     resp, status_resp, user_resp, result, images = get_apps()
 
+    paginators = {'describe_instances': MagicMock(), 'describe_instance_status': MagicMock()}
+    paginators['describe_instances'].paginate.return_value.build_full_result.return_value = resp
+    paginators['describe_instance_status'].paginate.return_value.build_full_result.return_value = status_resp
+
     ec2_client = MagicMock()
-    ec2_client.get_paginator.return_value.paginate.return_value.build_full_result.return_value = resp
+    ec2_client.get_paginator.side_effect = lambda name: paginators[name]
     ec2_client.describe_instance_attribute.side_effect = user_resp
-    ec2_client.describe_instance_status.return_value = status_resp
     ec2_client.describe_images.return_value = images
 
     dt = MagicMock()
@@ -364,10 +600,55 @@ def test_aws_get_running_apps(monkeypatch):
     calls = [call(InstanceId='ins-1', Attribute='userData'), call(InstanceId='ins-2', Attribute='userData')]
     ec2_client.describe_instance_attribute.assert_has_calls(calls, any_order=True)
 
-    ec2_client.describe_instance_status.assert_called_with(InstanceIds=['ins-1'])
+    paginators['describe_instance_status'].paginate.assert_called_once_with(Filters=[])
     ec2_client.describe_images.assert_called_with(ImageIds=['ami-1234'])
 
-    boto.assert_called_with('ec2', region_name=REGION)
+    boto.assert_called_with('ec2', region_name=REGION, config=ANY)
+
+
+def test_aws_get_running_apps_image_cache(monkeypatch):
+    resp, status_resp, user_resp, result, images = get_apps()
+
+    ec2_client = MagicMock()
+    ec2_client.get_paginator.return_value.paginate.return_value.build_full_result.return_value = resp
+    ec2_client.describe_instance_attribute.side_effect = user_resp
+    ec2_client.describe_images.return_value = images
+
+    dt = MagicMock()
+    dt.now.return_value.minute = 10
+    monkeypatch.setattr('zmon_aws_agent.aws.datetime', dt)
+
+    get_boto_client(monkeypatch, ec2_client)
+
+    first = aws.get_running_apps(REGION)
+    second = aws.get_running_apps(REGION)
+
+    assert first[0]['image'] == second[0]['image'] == result[0]['image']
+
+    ec2_client.describe_images.assert_called_once_with(ImageIds=['ami-1234'])
+
+
+def test_aws_get_images(monkeypatch):
+    ec2_client = MagicMock()
+    ec2_client.describe_images.side_effect = lambda ImageIds: {
+        'Images': [{'ImageId': i, 'Name': 'name-' + i, 'CreationDate': '2017-05-12T14:22:25.000Z'}
+                   for i in ImageIds if i != 'ami-gone']
+    }
+
+    monkeypatch.setattr('zmon_aws_agent.aws.IMAGE_CHUNK_SIZE', 2)
+    aws.IMAGE_CACHE['ami-old'] = {'name': 'old', 'date': '1970-01-01T00:00:00.000+00:00'}
+    aws.IMAGE_CACHE['ami-1'] = {'name': 'cached', 'date': '1970-01-01T00:00:00.000+00:00'}
+
+    res = aws.get_images(ec2_client, ['ami-1', 'ami-2', 'ami-3', 'ami-4', 'ami-gone'])
+
+    assert sorted(res) == ['ami-1', 'ami-2', 'ami-3', 'ami-4']
+    assert res['ami-1']['name'] == 'cached'
+    assert res['ami-2'] == {'name': 'name-ami-2', 'date': '2017-05-12T14:22:25.000+00:00'}
+    assert 'ami-old' not in aws.IMAGE_CACHE
+
+    ec2_client.describe_images.assert_has_calls([call(ImageIds=['ami-2', 'ami-3']),
+                                                 call(ImageIds=['ami-4', 'ami-gone'])])
+    assert ec2_client.describe_images.call_count == 2
 
 
 def test_aws_get_running_apps_existing(monkeypatch):
@@ -390,6 +671,95 @@ def test_aws_get_running_apps_existing(monkeypatch):
     calls = [call(InstanceId='ins-1', Attribute='userData'), call(InstanceId='ins-2', Attribute='userData')]
     ec2_client.describe_instance_attribute.assert_has_calls(calls, any_order=True)
     ec2_client.describe_images.assert_not_called()
+    ec2_client.get_paginator.assert_called_once_with('describe_instances')
+
+
+@pytest.mark.parametrize('codes', [[], ['instance-retirement', 'system-reboot']])
+def test_aws_get_instance_events(monkeypatch, codes):
+    statuses = {'InstanceStatuses': [
+        {'InstanceId': 'ins-1', 'Events': ['ev-1']},
+        {'InstanceId': 'ins-2'},
+        {'InstanceId': 'ins-3', 'Events': ['ev-3', 'ev-4']},
+    ]}
+
+    ec2_client = MagicMock()
+    ec2_client.get_paginator.return_value.paginate.return_value.build_full_result.return_value = statuses
+
+    monkeypatch.setattr('zmon_aws_agent.aws.INSTANCE_EVENT_CODES', codes)
+
+    res = aws.get_instance_events(ec2_client)
+
+    assert res == {'ins-1': ['ev-1'], 'ins-3': ['ev-3', 'ev-4']}
+
+    filters = [{'Name': 'event.code', 'Values': codes}] if codes else []
+    ec2_client.get_paginator.assert_called_once_with('describe_instance_status')
+    ec2_client.get_paginator.return_value.paginate.assert_called_once_with(Filters=filters)
+
+
+def test_aws_get_instance_events_fails(monkeypatch):
+    ec2_client = MagicMock()
+    ec2_client.get_paginator.return_value.paginate.return_value.build_full_result.side_effect = RuntimeError
+
+    assert aws.get_instance_events(ec2_client) == {}
+
+
+def test_aws_get_running_apps_user_data_cache(monkeypatch):
+    resp, status_resp, user_resp, result = get_apps_existing()
+
+    ec2_client = MagicMock()
+    ec2_client.get_paginator.return_value.paginate.return_value.build_full_result.return_value = resp
+    ec2_client.describe_instance_attribute.side_effect = user_resp + [RuntimeError] * 2
+    ec2_client.describe_instance_status.return_value = status_resp
+
+    dt = MagicMock()
+    dt.now.return_value.minute = 7
+    monkeypatch.setattr('zmon_aws_agent.aws.datetime', dt)
+
+    get_boto_client(monkeypatch, ec2_client)
+
+    assert aws.get_running_apps(REGION) == result
+    assert aws.get_running_apps(REGION) == result
+
+    # ins-3 failed and is retried, the others are served from the cache
+    calls = [call(InstanceId='ins-1', Attribute='userData'), call(InstanceId='ins-2', Attribute='userData'),
+             call(InstanceId='ins-3', Attribute='userData'), call(InstanceId='ins-3', Attribute='userData')]
+    ec2_client.describe_instance_attribute.assert_has_calls(calls)
+    assert ec2_client.describe_instance_attribute.call_count == 4
+
+    resp['Reservations'][0]['Instances'].pop(1)
+    aws.get_running_apps(REGION)
+
+    assert set(aws.USER_DATA_CACHE.keys()) == {'ins-1'}
+
+
+def test_aws_get_user_data_keeps_only_used_keys():
+    user_data = {'application_id': 'app-1', 'source': 'registry/app-1:1', 'runtime': 'docker',
+                 'environment': {'DB_PASSWORD': 'secret'}, 'mint_bucket': 'bucket'}
+
+    ec2_client = MagicMock()
+    ec2_client.describe_instance_attribute.side_effect = [
+        {'UserData': {'Value': base64.encodebytes(bytes(json.dumps(user_data), 'utf-8'))}},
+        {'UserData': {'Value': base64.encodebytes(b'#!/bin/sh\necho secret')}},
+    ]
+
+    expected = {'application_id': 'app-1', 'source': 'registry/app-1:1', 'runtime': 'docker'}
+
+    assert aws.get_user_data(ec2_client, {'InstanceId': 'ins-1'}) == expected
+    assert aws.get_user_data(ec2_client, {'InstanceId': 'ins-2'}) is None
+
+    assert aws.USER_DATA_CACHE == {'ins-1': ('', expected), 'ins-2': ('', None)}
+
+
+def get_route53_client(records):
+    def paginate(HostedZoneId):
+        page = MagicMock()
+        page.build_full_result.return_value = {'ResourceRecordSets': records[HostedZoneId]}
+        return page
+
+    route53_client = MagicMock()
+    route53_client.get_paginator.return_value.paginate.side_effect = paginate
+
+    return route53_client
 
 
 def test_aws_populate_dns(monkeypatch):
@@ -400,22 +770,28 @@ def test_aws_populate_dns(monkeypatch):
         ]
     }
 
-    records_resp = [
-        {
-            'ResourceRecordSets': [
-                {'SetIdentifier': 'r-1', 'Weight': '100', 'Type': 'CNAME'},
-                {'SetIdentifier': 'r-2', 'Weight': '100', 'Type': 'A', 'AliasTarget': {'DNSName': 'app.example.org'}},
-                {'SetIdentifier': 'r-skip', 'Weight': '100', 'Type': 'A', 'AliasTarget': {}},
-                {'SetIdentifier': 'r-skip', 'Weight': '100', 'Type': 'A'},
-                {'Weight': '100', 'Type': 'A'}, {'SetIdentifier': 'r-skip', 'Type': 'A'},
-            ]
-        },
-        {'ResourceRecordSets': [{'SetIdentifier': 'r-2-2', 'Weight': '100', 'Type': 'CNAME'}]}
-    ]
+    records = {
+        '1': [
+            {'SetIdentifier': 'r-1', 'Weight': '100', 'Type': 'CNAME'},
+            {'SetIdentifier': 'r-2', 'Weight': '100', 'Type': 'A', 'AliasTarget': {'DNSName': 'app.example.org'}},
+            {'SetIdentifier': 'r-skip', 'Weight': '100', 'Type': 'A', 'AliasTarget': {}},
+            {'SetIdentifier': 'r-skip', 'Weight': '100', 'Type': 'A'},
+            {'Weight': '100', 'Type': 'A'}, {'SetIdentifier': 'r-skip', 'Type': 'A'},
+            {'Name': 'db.zone-1.', 'Type': 'CNAME',
+             'ResourceRecords': [{'Value': 'ec2-1-2-3-4.eu-central-1.compute.amazonaws.com.'}]},
+        ],
+        '2': [
+            {'SetIdentifier': 'r-2-2', 'Weight': '100', 'Type': 'CNAME'},
+            {'Name': 'db.zone-2.', 'Type': 'CNAME',
+             'ResourceRecords': [{'Value': 'ec2-1-2-3-4.eu-central-1.compute.amazonaws.com.'}]},
+            {'Name': 'other.zone-2.', 'Type': 'CNAME',
+             'ResourceRecords': [{'Value': 'ec2-5-6-7-8.eu-central-1.compute.amazonaws.com.'}]},
+            {'Name': 'app.zone-2.', 'Type': 'CNAME', 'ResourceRecords': [{'Value': 'app-1.elb.amazonaws.com.'}]},
+        ],
+    }
 
-    route53_client = MagicMock()
+    route53_client = get_route53_client(records)
     route53_client.list_hosted_zones.return_value = resp
-    route53_client.list_resource_record_sets.side_effect = records_resp
 
     boto = get_boto_client(monkeypatch, route53_client)
 
@@ -427,20 +803,153 @@ def test_aws_populate_dns(monkeypatch):
     }
 
     dns_rr_cache_zone = {
-        'zone-1': [
+        '1': [
             {'SetIdentifier': 'r-1', 'Weight': '100', 'Type': 'CNAME'},
             {'SetIdentifier': 'r-2', 'Weight': '100', 'Type': 'A', 'AliasTarget': {'DNSName': 'app.example.org'}},
         ],
-        'zone-2': [{'SetIdentifier': 'r-2-2', 'Weight': '100', 'Type': 'CNAME'}]
+        '2': [{'SetIdentifier': 'r-2-2', 'Weight': '100', 'Type': 'CNAME'}]
     }
 
     assert dns_zone_cache == aws.DNS_ZONE_CACHE
     assert dns_rr_cache_zone == aws.DNS_RR_CACHE_ZONE
+    assert aws.DNS_WEIGHT_INDEX == {'r-1': '100', 'r-2': '100', 'r-2-2': '100'}
+    assert aws.DNS_CNAME_INDEX == {'1.2.3.4': 'db.zone-1', '5.6.7.8': 'other.zone-2'}
 
+    route53_client.get_paginator.assert_called_with('list_resource_record_sets')
     calls = [call(HostedZoneId='1'), call(HostedZoneId='2')]
-    route53_client.list_resource_record_sets.assert_has_calls(calls, any_order=True)
+    route53_client.get_paginator.return_value.paginate.assert_has_calls(calls, any_order=True)
+
+    boto.assert_called_with('route53', region_name=None, config=ANY)
+
+
+def test_aws_populate_dns_incremental(monkeypatch):
+    zones = [
+        {'Name': 'zone-1', 'Id': '1', 'ResourceRecordSetCount': 1},
+        {'Name': 'zone-2', 'Id': '2', 'ResourceRecordSetCount': 1},
+        {'Name': 'zone-3', 'Id': '3', 'ResourceRecordSetCount': 1},
+    ]
+
+    records = {
+        '1': [{'SetIdentifier': 'r-1', 'Weight': '100', 'Type': 'CNAME'}],
+        '2': [{'SetIdentifier': 'r-2', 'Weight': '100', 'Type': 'CNAME'}],
+        '3': [{'SetIdentifier': 'r-3', 'Weight': '100', 'Type': 'CNAME'}],
+    }
+
+    route53_client = get_route53_client(records)
+    get_boto_client(monkeypatch, route53_client)
 
-    boto.assert_called_with('route53')
+    now = 1000
+    monkeypatch.setattr('zmon_aws_agent.aws.time.time', lambda: now)
+    monkeypatch.setattr('zmon_aws_agent.aws.DNS_ZONE_MAX_AGE', 300)
+
+    inventory = RegionInventory(None)
+    inventory._data['hosted_zones'] = zones
+
+    aws.populate_dns_data(inventory=inventory)
+
+    assert route53_client.get_paginator.return_value.paginate.call_count == 3
+
+    # zone-1 changed, zone-3 was deleted
+    records['1'].append({'SetIdentifier': 'r-1-2', 'Weight': '0', 'Type': 'CNAME'})
+    zones[0]['ResourceRecordSetCount'] = 2
+    zones.pop()
+    route53_client.get_paginator.return_value.paginate.reset_mock()
+    now = 1100
+
+    aws.populate_dns_data(inventory=inventory)
+
+    route53_client.get_paginator.return_value.paginate.assert_called_once_with(HostedZoneId='1')
+    assert sorted(aws.DNS_RR_CACHE_ZONE) == ['1', '2']
+    assert aws.DNS_WEIGHT_INDEX == {'r-1': '100', 'r-1-2': '0', 'r-2': '100'}
+
+    # weight changes do not change the record count, old snapshots are listed again
+    route53_client.get_paginator.return_value.paginate.reset_mock()
+    now = 1350
+
+    aws.populate_dns_data(inventory=inventory)
+
+    route53_client.get_paginator.return_value.paginate.assert_called_once_with(HostedZoneId='2')
+
+
+def test_aws_populate_dns_split_horizon(monkeypatch):
+    zones = [
+        {'Name': 'zone-1', 'Id': '1', 'ResourceRecordSetCount': 1},
+        {'Name': 'zone-1', 'Id': '2', 'ResourceRecordSetCount': 2},
+    ]
+
+    records = {
+        '1': [{'SetIdentifier': 'r-1', 'Weight': '100', 'Type': 'CNAME'}],
+        '2': [{'SetIdentifier': 'r-1', 'Weight': '0', 'Type': 'CNAME'},
+              {'SetIdentifier': 'r-2', 'Weight': '100', 'Type': 'CNAME'}],
+    }
+
+    route53_client = get_route53_client(records)
+    get_boto_client(monkeypatch, route53_client)
+
+    monkeypatch.setattr('zmon_aws_agent.aws.time.time', lambda: 1000)
+
+    inventory = RegionInventory(None)
+    inventory._data['hosted_zones'] = zones
+
+    # zones sharing their name do not invalidate each other's snapshot
+    for _ in range(3):
+        aws.populate_dns_data(inventory=inventory)
+
+    assert route53_client.get_paginator.return_value.paginate.call_count == 2
+    assert aws.DNS_WEIGHT_INDEX == {'r-1': '100', 'r-2': '100'}
+
+
+def test_aws_populate_dns_persisted(monkeypatch, tmpdir):
+    zones = [{'Name': 'zone-1', 'Id': '1', 'ResourceRecordSetCount': 1}]
+    records = {'1': [{'SetIdentifier': 'r-1', 'Weight': '100', 'Type': 'CNAME'}]}
+
+    route53_client = get_route53_client(records)
+    get_boto_client(monkeypatch, route53_client, route53_client)
+
+    monkeypatch.setattr('zmon_aws_agent.common.CACHE_DIR', str(tmpdir))
+
+    inventory = RegionInventory(None)
+    inventory._data['hosted_zones'] = zones
+
+    aws.populate_dns_data(inventory=inventory)
+
+    # a restarted agent starts from the persisted snapshot
+    aws.DNS_ZONE_SNAPSHOTS.clear()
+    aws.DNS_RR_CACHE_ZONE.clear()
+    aws.DNS_ZONE_CACHE.clear()
+
+    aws.populate_dns_data(inventory=inventory)
+
+    route53_client.get_paginator.return_value.paginate.assert_called_once_with(HostedZoneId='1')
+    assert aws.DNS_WEIGHT_INDEX == {'r-1': '100'}
+
+
+def test_aws_get_weight_for_stack(monkeypatch):
+    monkeypatch.setattr('zmon_aws_agent.aws.DNS_RR_CACHE_ZONE', {
+        '1': [
+            {'SetIdentifier': 'app-1', 'Weight': '100'},
+            {'SetIdentifier': 'app-2', 'Weight': '0'},
+            {'SetIdentifier': 'app-2', 'Weight': '50'},
+        ],
+        '2': [
+            {'SetIdentifier': 'app-1', 'Weight': '10'},
+            {'SetIdentifier': 'app-2', 'Weight': '10'},
+            {'SetIdentifier': 'app-3', 'Weight': '20'},
+        ],
+    })
+    monkeypatch.setattr('zmon_aws_agent.aws.DNS_WEIGHT_INDEX', {})
+    monkeypatch.setattr('zmon_aws_agent.aws.DNS_CNAME_INDEX', {})
+
+    aws.index_dns_data([{'Name': 'zone-1', 'Id': '1'}, {'Name': 'zone-2', 'Id': '2'}])
+
+    assert aws.get_weight_for_stack('app', '1') == '100'
+    assert aws.get_weight_for_stack('app', '2') is None
+    assert aws.get_weight_for_stack('app', '3') == '20'
+    assert aws.get_weight_for_stack('app', '4') is None
+
+    entity = {'stack_name': 'app', 'stack_version': '1'}
+    aws.add_traffic_tags_to_entity(entity)
+    assert entity == {'stack_name': 'app', 'stack_version': '1', 'dns_weight': '100', 'dns_traffic': 'true'}
 
 
 @pytest.mark.parametrize('fail', [False, True])
@@ -557,117 +1066,170 @@ def test_aws_get_limits(monkeypatch, fail):
     assert expected == limits
 
     calls = [
-        call('ec2', region_name=REGION),
-        call('rds', region_name=REGION),
-        call('autoscaling', region_name=REGION),
-        call('iam', region_name=REGION),
+        call('ec2', region_name=REGION, config=ANY),
+        call('rds', region_name=REGION, config=ANY),
+        call('autoscaling', region_name=REGION, config=ANY),
+        call('iam', region_name=REGION, config=ANY),
     ]
     boto.assert_has_calls(calls)
 
 
+def get_sqs_client(urls, attributes, dead_letter_sources):
+    attributes = dict(zip(urls.get('QueueUrls', []), attributes))
+    dead_letter_sources = dict(zip(urls.get('QueueUrls', []), dead_letter_sources))
+
+    def get_queue_attributes(QueueUrl, AttributeNames):
+        if isinstance(attributes[QueueUrl], Exception):
+            raise attributes[QueueUrl]
+        return attributes[QueueUrl]
+
+    sqs_client = MagicMock()
+    sqs_client.get_paginator.return_value.paginate.return_value.build_full_result.return_value = urls
+    sqs_client.get_queue_attributes.side_effect = get_queue_attributes
+    sqs_client.list_dead_letter_source_queues.side_effect = lambda QueueUrl: dead_letter_sources[QueueUrl]
+
+    return sqs_client
+
+
 def test_aws_get_sqs_queues(monkeypatch):
     urls, attributes, dead_letter_sources, result = get_sqs_queues()
 
-    sqs_client = MagicMock()
-    sqs_client.list_queues.return_value = urls
-    sqs_client.get_queue_attributes.side_effect = attributes
-    sqs_client.list_dead_letter_source_queues.side_effect = dead_letter_sources
+    sqs_client = get_sqs_client(urls, attributes, dead_letter_sources)
 
     boto = get_boto_client(monkeypatch, sqs_client)
 
     res = aws.get_sqs_queues(REGION, ACCOUNT)
 
     assert res == result
-    boto.assert_called_with('sqs', region_name=REGION)
-    sqs_client.list_queues.assert_called()
+    boto.assert_called_with('sqs', region_name=REGION, config=ANY)
+    sqs_client.get_paginator.assert_called_with('list_queues')
+
+    attribute_calls = [call(QueueUrl=url, AttributeNames=aws.SQS_QUEUE_ATTRIBUTES) for url in urls['QueueUrls']]
+    sqs_client.get_queue_attributes.assert_has_calls(attribute_calls, any_order=True)
+
+    sqs_client.list_dead_letter_source_queues.assert_not_called()
+
+
+def test_aws_get_sqs_queues_dead_letter_source_lookup(monkeypatch):
+    urls, attributes, dead_letter_sources, result = get_sqs_queues()
+
+    sqs_client = get_sqs_client(urls, attributes, dead_letter_sources)
+
+    get_boto_client(monkeypatch, sqs_client)
+    monkeypatch.setattr('zmon_aws_agent.aws.SQS_DEAD_LETTER_SOURCE_LOOKUP', True)
+
+    res = aws.get_sqs_queues(REGION, ACCOUNT)
 
-    attribute_calls = [call(QueueUrl=url, AttributeNames=['All']) for url in urls['QueueUrls']]
-    sqs_client.get_queue_attributes.assert_has_calls(attribute_calls)
+    assert res == result
 
     dl_sources_calls = [call(QueueUrl=url) for url in urls['QueueUrls']]
-    sqs_client.list_dead_letter_source_queues.assert_has_calls(dl_sources_calls)
+    sqs_client.list_dead_letter_source_queues.assert_has_calls(dl_sources_calls, any_order=True)
+
+
+def test_aws_add_dead_letter_sources():
+    queue1 = {'url': 'url1', 'arn': 'arn1', 'redrive_policy_dead_letter_target_arn': 'arn3'}
+    queue2 = {'url': 'url2', 'arn': 'arn2', 'redrive_policy_dead_letter_target_arn': 'arn3'}
+    queue3 = {'url': 'url3', 'arn': 'arn3'}
+    queue4 = {'url': 'url4', 'arn': 'arn4', 'redrive_policy_dead_letter_source_urls': ['url5']}
+
+    res = aws.add_dead_letter_sources([queue1, queue2, queue3, queue4])
+
+    assert res == [queue1, queue2, dict(queue3, redrive_policy_dead_letter_source_urls=['url1', 'url2']),
+                   {'url': 'url4', 'arn': 'arn4'}]
+    assert 'redrive_policy_dead_letter_source_urls' in queue4
+
+
+def test_aws_get_sqs_queues_reuses_existing(monkeypatch):
+    urls, attributes, dead_letter_sources, result = get_sqs_queues()
+
+    sqs_client = get_sqs_client(urls, attributes, dead_letter_sources)
+
+    get_boto_client(monkeypatch, sqs_client)
+
+    now = MagicMock()
+    now.now.return_value.minute = 7
+    monkeypatch.setattr('zmon_aws_agent.aws.datetime', now)
+
+    res = aws.get_sqs_queues(REGION, ACCOUNT, all_entities=result[:1])
+
+    assert res == result
+    sqs_client.get_queue_attributes.assert_called_once_with(QueueUrl=urls['QueueUrls'][1],
+                                                            AttributeNames=aws.SQS_QUEUE_ATTRIBUTES)
 
 
 def test_aws_get_sqs_queues_fails_to_list_queues(monkeypatch):
     sqs_client = MagicMock()
-    sqs_client.list_queues.side_effect = RuntimeError('Oops')
+    sqs_client.get_paginator.return_value.paginate.return_value.build_full_result.side_effect = RuntimeError('Oops')
 
     boto = get_boto_client(monkeypatch, sqs_client)
+    monkeypatch.setattr('zmon_aws_agent.aws.call_and_retry', lambda f, *args, **kwargs: f(*args, **kwargs))
 
     assert aws.get_sqs_queues(REGION, ACCOUNT) == []
 
-    boto.assert_called_with('sqs', region_name=REGION)
-    sqs_client.list_queues.assert_called()
+    boto.assert_called_with('sqs', region_name=REGION, config=ANY)
+    sqs_client.get_queue_attributes.assert_not_called()
 
 
 def test_aws_get_sqs_queues_list_queues_is_empty(monkeypatch):
-    sqs_client = MagicMock()
-    sqs_client.list_queues.return_value = {}
+    sqs_client = get_sqs_client({}, [], [])
 
     boto = get_boto_client(monkeypatch, sqs_client)
 
     assert aws.get_sqs_queues(REGION, ACCOUNT) == []
 
-    boto.assert_called_with('sqs', region_name=REGION)
-    sqs_client.list_queues.assert_called()
+    boto.assert_called_with('sqs', region_name=REGION, config=ANY)
+    sqs_client.get_queue_attributes.assert_not_called()
 
 
 def test_aws_get_sqs_queues_access_denied(monkeypatch):
     sqs_client = MagicMock()
-    sqs_client.list_queues.side_effect = ClientError(operation_name='foo',
-                                                     error_response={'Error': {'Code': 'AccessDenied'}})
+    sqs_client.get_paginator.return_value.paginate.return_value.build_full_result.side_effect = ClientError(
+        operation_name='foo', error_response={'Error': {'Code': 'AccessDenied'}})
 
     boto = get_boto_client(monkeypatch, sqs_client)
 
     assert aws.get_sqs_queues(REGION, ACCOUNT) == []
 
-    boto.assert_called_with('sqs', region_name=REGION)
-    sqs_client.list_queues.assert_called()
+    boto.assert_called_with('sqs', region_name=REGION, config=ANY)
+    sqs_client.get_queue_attributes.assert_not_called()
 
 
 def test_aws_get_sqs_queues_fails_to_get_details(monkeypatch):
     urls, attributes, dead_letter_sources, result = get_sqs_queues()
 
     attributes[0] = RuntimeError("Oops")
-    dead_letter_sources.pop(0)
     result.pop(0)
+    result[0].pop('redrive_policy_dead_letter_source_urls')
 
-    sqs_client = MagicMock()
-    sqs_client.list_queues.return_value = urls
-    sqs_client.get_queue_attributes.side_effect = attributes
-    sqs_client.list_dead_letter_source_queues.side_effect = dead_letter_sources
+    sqs_client = get_sqs_client(urls, attributes, dead_letter_sources)
 
     boto = get_boto_client(monkeypatch, sqs_client)
+    monkeypatch.setattr('zmon_aws_agent.aws.call_and_retry', lambda f, *args, **kwargs: f(*args, **kwargs))
 
     res = aws.get_sqs_queues(REGION, ACCOUNT)
 
     assert res == result
-    boto.assert_called_with('sqs', region_name=REGION)
-    sqs_client.list_queues.assert_called()
+    boto.assert_called_with('sqs', region_name=REGION, config=ANY)
 
-    calls = [call(QueueUrl=url, AttributeNames=['All']) for url in urls['QueueUrls']]
-    sqs_client.get_queue_attributes.assert_has_calls(calls)
+    calls = [call(QueueUrl=url, AttributeNames=aws.SQS_QUEUE_ATTRIBUTES) for url in urls['QueueUrls']]
+    sqs_client.get_queue_attributes.assert_has_calls(calls, any_order=True)
 
 
 def test_aws_get_sqs_queues_fails_on_weird_arn(monkeypatch):
     urls, attributes, dead_letter_sources, result = get_sqs_queues()
 
     attributes[0]['Attributes']['QueueArn'] = 'arn:aws:i-am-not-a-valid-arn'
-    dead_letter_sources.pop(0)
     result.pop(0)
+    result[0].pop('redrive_policy_dead_letter_source_urls')
 
-    sqs_client = MagicMock()
-    sqs_client.list_queues.return_value = urls
-    sqs_client.get_queue_attributes.side_effect = attributes
-    sqs_client.list_dead_letter_source_queues.side_effect = dead_letter_sources
+    sqs_client = get_sqs_client(urls, attributes, dead_letter_sources)
 
     boto = get_boto_client(monkeypatch, sqs_client)
 
     res = aws.get_sqs_queues(REGION, ACCOUNT)
 
     assert res == result
-    boto.assert_called_with('sqs', region_name=REGION)
-    sqs_client.list_queues.assert_called()
+    boto.assert_called_with('sqs', region_name=REGION, config=ANY)
 
-    calls = [call(QueueUrl=url, AttributeNames=['All']) for url in urls['QueueUrls']]
-    sqs_client.get_queue_attributes.assert_has_calls(calls)
+    calls = [call(QueueUrl=url, AttributeNames=aws.SQS_QUEUE_ATTRIBUTES) for url in urls['QueueUrls']]
+    sqs_client.get_queue_attributes.assert_has_calls(calls, any_order=True)
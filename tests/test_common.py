@@ -1,11 +1,14 @@
+import threading
+
 import pytest
 
-from mock import MagicMock
+from mock import MagicMock, ANY
 
 import opentracing
 
 from zmon_aws_agent import __version__
-from zmon_aws_agent.common import get_user_agent, call_and_retry, clean_opentracing_span
+from zmon_aws_agent.common import get_user_agent, call_and_retry, clean_opentracing_span, get_client, load_cache, \
+    save_cache, parallel_map
 
 from conftest import ThrottleError
 
@@ -65,3 +68,76 @@ def test_clean_opentracing_span(monkeypatch):
     clean_kwargs = clean_opentracing_span(**kwargs)
 
     assert clean_kwargs == {'not_span': 1, 'also_not_span': 'no span'}
+
+
+def test_common_get_client(monkeypatch):
+    client = MagicMock()
+    client.side_effect = lambda service, **kwargs: MagicMock(name=service)
+    monkeypatch.setattr('boto3.client', client)
+    monkeypatch.setattr('zmon_aws_agent.common.AWS_MAX_POOL_CONNECTIONS', 42)
+
+    ec2 = get_client('ec2', 'eu-central-1')
+
+    assert get_client('ec2', 'eu-central-1') is ec2
+    assert get_client('ec2', 'eu-west-1') is not ec2
+    assert get_client('route53') is not ec2
+
+    assert client.call_count == 3
+
+    config = client.call_args_list[0][1]['config']
+    assert config.max_pool_connections == 42
+    client.assert_called_with('route53', region_name=None, config=ANY)
+
+
+def test_common_load_save_cache(monkeypatch, tmpdir):
+    monkeypatch.setattr('zmon_aws_agent.common.CACHE_DIR', None)
+
+    save_cache('test', {'k': 'v'})
+    assert load_cache('test', {}) == {}
+
+    monkeypatch.setattr('zmon_aws_agent.common.CACHE_DIR', str(tmpdir.join('cache')))
+
+    assert load_cache('test', {}) == {}
+
+    save_cache('test', {'k': ('v', {1: 2})})
+    assert load_cache('test', {}) == {'k': ('v', {1: 2})}
+
+    tmpdir.join('cache', 'test.pickle').write('garbage')
+    assert load_cache('test') is None
+
+
+def test_common_load_cache_writable_by_others(monkeypatch, tmpdir):
+    monkeypatch.setattr('zmon_aws_agent.common.CACHE_DIR', str(tmpdir.join('cache')))
+
+    save_cache('test', {'k': 'v'})
+    assert tmpdir.join('cache', 'test.pickle').stat().mode & 0o777 == 0o600
+    assert load_cache('test', {}) == {'k': 'v'}
+
+    tmpdir.join('cache', 'test.pickle').chmod(0o666)
+    assert load_cache('test', {}) == {}
+
+
+def test_common_parallel_map():
+    assert parallel_map(lambda x: x * 2, [3, 1, 2], max_workers=2) == [6, 2, 4]
+    assert parallel_map(lambda x: x, []) == []
+
+    def fail(x):
+        if x == 2:
+            raise RuntimeError
+        return x
+
+    with pytest.raises(RuntimeError):
+        parallel_map(fail, [1, 2, 3])
+
+
+def test_common_parallel_map_timeout():
+    event = threading.Event()
+
+    def hangs(x):
+        if x == 2:
+            event.wait(5)
+        return x
+
+    assert parallel_map(hangs, [1, 2, 3], timeout=0.1, default='timeout') == [1, 'timeout', 3]
+
+    event.set()
@@ -11,9 +11,10 @@ from zmon_aws_agent.elastigroup import Elastigroup, extract_instance_details
 
 
 def test_get_elastigroup_entities(monkeypatch):
-    stack_names = MagicMock()
-    stack_names.return_value = ['foo', 'bar']
-    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_all_stack_names', stack_names)
+    stacks = MagicMock()
+    stacks.return_value = [{'StackId': 'foo-id', 'StackName': 'foo', 'CreationTime': 1},
+                           {'StackId': 'bar-id', 'StackName': 'bar', 'CreationTime': 1}]
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_all_stacks', stacks)
     elastigroup_resources = MagicMock()
     elastigroup_resources.return_value = [Elastigroup('42', 'test', 'acct-id', 'acc-tkn')]
     monkeypatch.setattr('zmon_aws_agent.elastigroup.get_elastigroup_resources', elastigroup_resources)
@@ -44,9 +45,10 @@ def test_get_elastigroup_entities(monkeypatch):
 
 
 def test_get_elastigroup_entities_missing_attributes(monkeypatch):
-    stack_names = MagicMock()
-    stack_names.return_value = ['foo', 'bar']
-    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_all_stack_names', stack_names)
+    stacks = MagicMock()
+    stacks.return_value = [{'StackId': 'foo-id', 'StackName': 'foo', 'CreationTime': 1},
+                           {'StackId': 'bar-id', 'StackName': 'bar', 'CreationTime': 1}]
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_all_stacks', stacks)
     elastigroup_resources = MagicMock()
     elastigroup_resources.return_value = [Elastigroup('42', 'test', 'acct-id', 'acc-tkn')]
     monkeypatch.setattr('zmon_aws_agent.elastigroup.get_elastigroup_resources', elastigroup_resources)
@@ -98,7 +100,7 @@ def test_get_elastigroup_entities_missing_attributes(monkeypatch):
             (None,
              None,
              ClientError({'Error': {'Code': '500', 'Message': 'Somebody Set Us Up The Bomb'}}, "dont-care"),
-             []),
+             None),
 
     )
 )
@@ -122,12 +124,14 @@ def test_get_elastigroup_resources(lsr, gt, err, out):
 @pytest.mark.parametrize(
     'resp,err,out',
     (
-            ({'StackSummaries': [{'StackName': 'foo'}]}, None, ['foo']),
-            ({'StackSummaries': [{'StackName': 'foo'}, {'StackName': 'bar'}]}, None, ['foo', 'bar']),
-            (None, ClientError({'Error': {'Code': '500', 'Message': 'Somebody Set Us Up The Bomb'}}, "dont-care"), []),
+            ({'StackSummaries': [{'StackName': 'foo'}]}, None, [{'StackName': 'foo'}]),
+            ({'StackSummaries': [{'StackName': 'foo'}, {'StackName': 'bar'}]}, None,
+             [{'StackName': 'foo'}, {'StackName': 'bar'}]),
+            (None, ClientError({'Error': {'Code': '500', 'Message': 'Somebody Set Us Up The Bomb'}}, "dont-care"),
+             None),
     )
 )
-def test_get_all_stack_names(resp, err, out):
+def test_get_all_stacks(resp, err, out):
     def mock_make_api_call(self, operation_name, kwarg):
         if operation_name == 'ListStacks':
             if err:
@@ -137,7 +141,37 @@ def test_get_all_stack_names(resp, err, out):
 
     with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
         cf = boto3.client('cloudformation', region_name='eu-central-1')
-        assert zmon_aws_agent.elastigroup.get_all_stack_names(cf) == out
+        assert zmon_aws_agent.elastigroup.get_all_stacks(cf) == out
+
+
+def test_get_all_elastigroup_resources(monkeypatch):
+    stacks = [
+        {'StackId': 'eg-id', 'StackName': 'eg', 'CreationTime': 1},
+        {'StackId': 'plain-id', 'StackName': 'plain', 'CreationTime': 1},
+        {'StackId': 'failing-id', 'StackName': 'failing', 'CreationTime': 1},
+    ]
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_all_stacks', MagicMock(return_value=stacks))
+
+    group = Elastigroup('42', 'test', 'acct-id', 'acc-tkn')
+    results = {'eg': [group], 'plain': [], 'failing': None}
+    resources = MagicMock(side_effect=lambda cf, stack_name: results[stack_name])
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_elastigroup_resources', resources)
+
+    assert zmon_aws_agent.elastigroup.get_all_elastigroup_resources(MagicMock()) == [group]
+    assert resources.call_count == 3
+
+    # unchanged stacks are not read again, failed and updated ones are
+    resources.reset_mock()
+    stacks[0] = dict(stacks[0], LastUpdatedTime=2)
+
+    assert zmon_aws_agent.elastigroup.get_all_elastigroup_resources(MagicMock()) == [group]
+    assert sorted(c[0][1] for c in resources.call_args_list) == ['eg', 'failing']
+
+    # deleted stacks are dropped
+    stacks.pop(0)
+
+    assert zmon_aws_agent.elastigroup.get_all_elastigroup_resources(MagicMock()) == []
+    assert sorted(zmon_aws_agent.elastigroup.STACK_ELASTIGROUPS_CACHE) == ['plain-id']
 
 
 @pytest.mark.parametrize(
@@ -194,3 +228,78 @@ def test_extract_instance_details():
         assert inst2['type'] == 't2.medium'
         assert inst2['spot'] is False
         assert inst2['availability_zone'] == 'us-west-2a'
+
+
+def test_spotinst_client_pool():
+    first = zmon_aws_agent.elastigroup.get_spotinst_client("12345", "fake")
+    second = zmon_aws_agent.elastigroup.get_spotinst_client("12345", "fake")
+    other = zmon_aws_agent.elastigroup.get_spotinst_client("12345", "other-token")
+
+    assert first is second
+    assert first is not other
+
+
+def test_get_elastigroup_instances_rate_limited(monkeypatch):
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_sleep_duration', lambda count: 0)
+
+    resp = '{"response": {"items": [{"instanceId": "i-1"}]}}'
+    with requests_mock.Mocker() as m:
+        m.get("https://api.spotinst.io/aws/ec2/group/42/status",
+              [{'status_code': 429, 'text': '{"response": {}}'}, {'status_code': 200, 'text': resp}])
+        got = zmon_aws_agent.elastigroup.get_elastigroup_instances(Elastigroup("42", "name", "12345", "fake"))
+
+        assert got == [{'instance_id': 'i-1'}]
+        assert m.call_count == 2
+
+
+def test_get_elastigroup_instances_rate_limit_exceeded(monkeypatch):
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_sleep_duration', lambda count: 0)
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.SPOTINST_MAX_RETRIES', 2)
+
+    with requests_mock.Mocker() as m:
+        m.get("https://api.spotinst.io/aws/ec2/group/42/status", status_code=429, text='{"response": {}}')
+        got = zmon_aws_agent.elastigroup.get_elastigroup_instances(Elastigroup("42", "name", "12345", "fake"))
+
+        assert got == []
+        assert m.call_count == 3
+
+
+def test_get_elastigroup_entities_account_listing(monkeypatch):
+    resources = [Elastigroup('sig-1', 'first', 'act-1', 'tkn-1'), Elastigroup('sig-2', 'second', 'act-1', 'tkn-1'),
+                 Elastigroup('sig-3', 'third', 'act-2', 'tkn-2')]
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_all_elastigroup_resources', MagicMock(return_value=resources))
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.ELASTIGROUP_ACCOUNT_LISTING', True)
+
+    listings = {
+        ('act-1', 'tkn-1'): {('act-1', 'sig-1'): {'id': 'sig-1', 'name': 'listed-1'},
+                             ('act-1', 'sig-2'): {'id': 'sig-2', 'name': 'listed-2'}},
+        ('act-2', 'tkn-2'): {},
+    }
+    account_elastigroups = MagicMock(side_effect=lambda account_id, token: listings[(account_id, token)])
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_account_elastigroups', account_elastigroups)
+
+    elastigroup = MagicMock(return_value={'id': 'sig-3', 'name': 'fetched-3'})
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_elastigroup', elastigroup)
+    monkeypatch.setattr('zmon_aws_agent.elastigroup.get_elastigroup_instances', MagicMock(return_value=[]))
+
+    entities = zmon_aws_agent.elastigroup.get_elastigroup_entities('region1', 'acc1')
+
+    assert [e['name'] for e in entities] == ['listed-1', 'listed-2', 'fetched-3']
+    assert account_elastigroups.call_count == 2
+    elastigroup.assert_called_once_with(resources[2])
+
+
+def test_get_account_elastigroups():
+    resp = '{"response": {"items": [{"id": "sig-1", "name": "first"}, {"id": "sig-2", "name": "second"}]}}'
+    with requests_mock.Mocker() as m:
+        m.get("https://api.spotinst.io/aws/ec2/group", text=resp)
+        got = zmon_aws_agent.elastigroup.get_account_elastigroups("act-1", "fake")
+
+    assert got == {('act-1', 'sig-1'): {'id': 'sig-1', 'name': 'first'},
+                   ('act-1', 'sig-2'): {'id': 'sig-2', 'name': 'second'}}
+
+
+def test_get_account_elastigroups_fails():
+    with patch('spotinst_sdk.SpotinstClient.get_elastigroups') as elastigroups_mock:
+        elastigroups_mock.side_effect = SpotinstClientException("test", "fake")
+        assert zmon_aws_agent.elastigroup.get_account_elastigroups("act-1", "fake") == {}
@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+from mock import MagicMock
+
+from zmon_aws_agent.inventory import RegionInventory, index_by
+
+
+REGION = 'eu-central-1'
+
+
+def get_boto_client(monkeypatch, *args):
+    client = MagicMock()
+    client.side_effect = args
+
+    monkeypatch.setattr('boto3.client', client)
+
+    return client
+
+
+def test_index_by():
+    items = [{'id': 'a', 'n': 1}, {'id': 'b', 'n': 2}, {'id': 'a', 'n': 3}, {'n': 4}]
+
+    assert index_by(items, 'id') == {'a': {'id': 'a', 'n': 1}, 'b': {'id': 'b', 'n': 2}}
+
+
+def test_inventory_loads_once(monkeypatch):
+    reservations = {'Reservations': [{'Instances': [{'InstanceId': 'i-1'}, {'InstanceId': 'i-2'}]}]}
+
+    ec2 = MagicMock()
+    ec2.get_paginator.return_value.paginate.return_value.build_full_result.return_value = reservations
+
+    boto = get_boto_client(monkeypatch, ec2)
+
+    inventory = RegionInventory(REGION)
+
+    assert inventory.reservations == reservations['Reservations']
+    assert inventory.reservations == reservations['Reservations']
+    assert sorted(inventory.instances_by_id) == ['i-1', 'i-2']
+
+    ec2.get_paginator.return_value.paginate.assert_called_once()
+    boto.assert_called_once()
+
+
+def test_inventory_loads_once_concurrently(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def describe_addresses():
+        started.set()
+        release.wait(5)
+        return {'Addresses': [{'InstanceId': 'i-1', 'AllocationId': 'eipalloc-1', 'PublicIp': '1.2.3.4'}]}
+
+    ec2 = MagicMock()
+    ec2.describe_addresses.side_effect = describe_addresses
+
+    get_boto_client(monkeypatch, ec2)
+
+    inventory = RegionInventory(REGION)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(inventory.addresses)) for _ in range(3)]
+    for t in threads:
+        t.start()
+
+    started.wait(5)
+    release.set()
+
+    for t in threads:
+        t.join(5)
+
+    assert [[a['InstanceId'] for a in r] for r in results] == [['i-1']] * 3
+
+    ec2.describe_addresses.assert_called_once_with()
+
+
+def test_inventory_retries_after_failure(monkeypatch):
+    zones = {'HostedZones': [{'Id': 'zone-1', 'Name': 'zone.'}], 'IsTruncated': False}
+
+    route53 = MagicMock()
+    route53.list_hosted_zones.side_effect = [RuntimeError('Failed'), zones]
+
+    get_boto_client(monkeypatch, route53)
+    monkeypatch.setattr('zmon_aws_agent.inventory.call_and_retry', lambda f, *args, **kwargs: f(*args, **kwargs))
+
+    inventory = RegionInventory(REGION)
+
+    with pytest.raises(RuntimeError):
+        inventory.hosted_zones
+
+    assert inventory.hosted_zones == zones['HostedZones']
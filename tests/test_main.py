@@ -1,10 +1,15 @@
+import threading
+
 import pytest
 
-from mock import MagicMock, call
+from mock import MagicMock, ANY, call
 
 from requests.exceptions import HTTPError
 
-from zmon_aws_agent.main import remove_missing_entities, add_new_entities
+from concurrent.futures import Future
+
+from zmon_aws_agent.main import remove_missing_entities, add_new_entities, run_daemon, discover
+from zmon_aws_agent.scheduler import TasksTimeout
 
 
 @pytest.mark.parametrize('json', [True, False])
@@ -92,3 +97,168 @@ def test_remove_missing_entities_exception(monkeypatch):
     assert count == 1
 
     exception.assert_called()
+
+
+def test_run_daemon(monkeypatch):
+    discover = MagicMock()
+    discover.side_effect = [RuntimeError, None, KeyboardInterrupt]
+    monkeypatch.setattr('zmon_aws_agent.main.discover', discover)
+
+    sleep = MagicMock()
+    monkeypatch.setattr('zmon_aws_agent.main.time.sleep', sleep)
+
+    now = MagicMock()
+    now.return_value = 100
+    monkeypatch.setattr('zmon_aws_agent.main.time.time', now)
+
+    args = MagicMock()
+    args.interval = 60
+    args.cycle_timeout = 540
+
+    with pytest.raises(KeyboardInterrupt):
+        run_daemon(args, 'eu-central-1')
+
+    assert discover.call_count == 3
+    discover.assert_called_with(args, 'eu-central-1', deadline=640)
+    sleep.assert_has_calls([call(60), call(60)])
+
+
+@pytest.mark.parametrize('error', [TasksTimeout('Tasks did not finish in time: apps', []), RuntimeError('Failed')])
+def test_run_daemon_waits_for_running_collectors(monkeypatch, error):
+    running = Future()
+    finished = []
+
+    def finish():
+        finished.append(True)
+        running.set_result(None)
+
+    def discover(args, region, deadline=None):
+        if discover.calls == 0:
+            discover.calls += 1
+            threading.Timer(0.1, finish).start()
+            error.futures = [running]
+            raise error
+
+        # the next cycle only starts after the collectors of the timed out one are done
+        assert finished == [True]
+        raise KeyboardInterrupt
+
+    discover.calls = 0
+    monkeypatch.setattr('zmon_aws_agent.main.discover', discover)
+    monkeypatch.setattr('zmon_aws_agent.main.time.sleep', MagicMock())
+
+    exit = MagicMock()
+    monkeypatch.setattr('zmon_aws_agent.main.os._exit', exit)
+
+    args = MagicMock()
+    args.interval = 60
+    args.cycle_timeout = 5
+
+    with pytest.raises(KeyboardInterrupt):
+        run_daemon(args, 'eu-central-1')
+
+    exit.assert_not_called()
+
+
+def test_run_daemon_exits_on_hanging_collectors(monkeypatch):
+    discover = MagicMock()
+    discover.side_effect = TasksTimeout('Tasks did not finish in time: apps', [Future()])
+    monkeypatch.setattr('zmon_aws_agent.main.discover', discover)
+
+    exit = MagicMock()
+    exit.side_effect = SystemExit
+    monkeypatch.setattr('zmon_aws_agent.main.os._exit', exit)
+
+    args = MagicMock()
+    args.interval = 60
+    args.cycle_timeout = 0.1
+
+    with pytest.raises(SystemExit):
+        run_daemon(args, 'eu-central-1')
+
+    discover.assert_called_once()
+    exit.assert_called_once_with(1)
+
+
+def get_discover_mocks(monkeypatch, apps):
+    """Mock the ZMON client and all collectors used by ``discover``, each returning a single named entity."""
+    def entity(name):
+        return {'id': name, 'type': name}
+
+    existing = [entity('existing')]
+    zmon_client = MagicMock()
+    zmon_client.get_entities.return_value = existing
+    monkeypatch.setattr('zmon_aws_agent.main.Zmon', MagicMock(return_value=zmon_client))
+
+    collectors = {
+        'aws.get_account_id': '123',
+        'aws.populate_dns_data': None,
+        'aws.get_running_apps': apps,
+        'aws.get_apps_from_entities': [],
+        'aws.get_running_elbs': [entity('elb')],
+        'aws.get_auto_scaling_groups': [entity('asg')],
+        'elastigroup.get_elastigroup_entities': [entity('elastigroup')],
+        'aws.get_rds_instances': [entity('rds')],
+        'aws.get_elasticache_nodes': [entity('elc')],
+        'aws.get_dynamodb_tables': [entity('dynamodb')],
+        'aws.get_certificates': [entity('certificate')],
+        'aws.get_limits': entity('aws_limits'),
+        'aws.get_sqs_queues': [entity('sqs')],
+        'postgresql.get_postgresql_clusters': [entity('postgresql_cluster')],
+        'postgresql.get_databases_from_clusters': [entity('postgresql_database')],
+        'aws.get_account_alias': 'alias',
+    }
+    mocks = {}
+    for name, result in collectors.items():
+        mocks[name] = MagicMock(return_value=result)
+        monkeypatch.setattr('zmon_aws_agent.main.{}'.format(name), mocks[name])
+
+    monkeypatch.setenv('ZMON_TOKEN', 'token')
+    args = MagicMock(disable_oauth2=False, json=False, workers=4, postgresql_user='user', postgresql_pass='pass')
+
+    return args, zmon_client, existing, mocks
+
+
+def test_discover_task_results(monkeypatch):
+    apps = [{'id': 'app', 'type': 'instance'}]
+    args, zmon_client, existing, mocks = get_discover_mocks(monkeypatch, apps)
+
+    discover(args, 'r1')
+
+    account = 'aws:123'
+    mocks['aws.get_running_apps'].assert_called_once_with('r1', existing, inventory=ANY)
+    mocks['aws.get_rds_instances'].assert_called_once_with('r1', account, existing)
+    mocks['aws.get_sqs_queues'].assert_called_once_with('r1', account, existing)
+    mocks['aws.get_limits'].assert_called_once_with('r1', account, apps, [{'id': 'elb', 'type': 'elb'}], existing)
+    mocks['postgresql.get_postgresql_clusters'].assert_called_once_with(
+        'r1', account, [{'id': 'asg', 'type': 'asg'}], apps, inventory=ANY)
+    mocks['postgresql.get_databases_from_clusters'].assert_called_once_with(
+        [{'id': 'postgresql_cluster', 'type': 'postgresql_cluster'}], account, 'r1', 'user', 'pass',
+        existing_entities=existing)
+
+    added = {c[0][0]['id'] for c in zmon_client.add_entity.call_args_list}
+    assert added == {'app', 'elb', 'asg', 'elastigroup', 'rds', 'elc', 'dynamodb', 'certificate', 'aws_limits',
+                     'sqs', 'postgresql_cluster', 'postgresql_database', 'aws-ac[aws:123:r1]'}
+    zmon_client.delete_entity.assert_called_once_with('existing')
+
+
+def test_discover_no_apps_ignores_collector_failures(monkeypatch):
+    args, zmon_client, existing, mocks = get_discover_mocks(monkeypatch, [])
+    mocks['aws.get_running_elbs'].side_effect = RuntimeError('failed')
+
+    discover(args, 'r1')
+
+    # dependent collectors are skipped, the local entity is still updated
+    mocks['aws.get_limits'].assert_not_called()
+    added = {c[0][0]['id'] for c in zmon_client.add_entity.call_args_list}
+    assert added == {'aws-ac[aws:123:r1]'}
+
+
+def test_discover_collector_failure(monkeypatch):
+    args, zmon_client, existing, mocks = get_discover_mocks(monkeypatch, [{'id': 'app', 'type': 'instance'}])
+    mocks['aws.get_running_elbs'].side_effect = RuntimeError('failed')
+
+    with pytest.raises(RuntimeError):
+        discover(args, 'r1')
+
+    zmon_client.add_entity.assert_not_called()
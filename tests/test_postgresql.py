@@ -1,12 +1,18 @@
-from mock import MagicMock
+import threading
+
+from mock import MagicMock, ANY, call
 import pytest
 
+from botocore.exceptions import ClientError
+
 from test_aws import get_boto_client
 import conftest
 import zmon_aws_agent.postgresql as postgresql
 
+from zmon_aws_agent.inventory import RegionInventory
+
 
-def test_get_databases_from_clusters():
+def test_get_databases_from_clusters(monkeypatch):
     pgclusters = [
         {
             'id': 'test-1',
@@ -16,8 +22,7 @@ def test_get_databases_from_clusters():
     acc = 'aws:1234567890'
     region = 'eu-xxx-1'
 
-    postgresql.list_postgres_databases = MagicMock()
-    postgresql.list_postgres_databases.return_value = ['db1', 'db2']
+    monkeypatch.setattr('zmon_aws_agent.postgresql.list_postgres_databases', MagicMock(return_value=['db1', 'db2']))
 
     databases = postgresql.get_databases_from_clusters(pgclusters, acc, region,
                                                        'pguser', 'pgpass')
@@ -49,6 +54,129 @@ def test_get_databases_from_clusters():
     ]
 
 
+def test_get_databases_from_clusters_concurrent(monkeypatch):
+    pgclusters = [{'id': 'pg-{}'.format(i), 'dnsname': 'pg-{}.db.zalan.do'.format(i)} for i in range(4)]
+    pgclusters.append({'id': 'pg-no-dns'})
+
+    hangs = threading.Event()
+
+    def list_databases(host, **kwargs):
+        if host == 'pg-1.db.zalan.do':
+            hangs.wait(5)
+        if host == 'pg-2.db.zalan.do':
+            raise RuntimeError('Failed')
+        if host == 'pg-3.db.zalan.do':
+            return None
+        return ['db-' + host.split('.')[0]]
+
+    monkeypatch.setattr('zmon_aws_agent.postgresql.list_postgres_databases', list_databases)
+    monkeypatch.setattr('zmon_aws_agent.postgresql.POSTGRESQL_DISCOVERY_TIMEOUT', 0.2)
+
+    existing = [{'id': 'db-pg-3', 'type': 'postgresql_database', 'postgresql_cluster': 'pg-3',
+                 'database_name': 'db-pg-3'}]
+
+    databases = postgresql.get_databases_from_clusters(pgclusters, 'aws:1234567890', 'eu-xxx-1', 'pguser', 'pgpass',
+                                                       existing_entities=existing)
+
+    hangs.set()
+
+    # the hanging and the failing clusters keep their existing entities, the others keep the order of the clusters
+    assert [db['database_name'] for db in databases] == ['db-pg-0', 'db-pg-3']
+    assert databases[1] is existing[0]
+    assert list(postgresql.POSTGRESQL_DATABASES_CACHE) == ['pg-0.db.zalan.do']
+
+
+def test_get_databases_from_clusters_timeout_keeps_databases(monkeypatch):
+    pgclusters = [{'id': 'pg-{}'.format(i), 'dnsname': 'pg-{}.db.zalan.do'.format(i)} for i in range(3)]
+
+    existing = [
+        {'id': 'db-pg-1', 'type': 'postgresql_database', 'postgresql_cluster': 'pg-1', 'database_name': 'db-pg-1'},
+        {'id': 'db-pg-2', 'type': 'postgresql_database', 'postgresql_cluster': 'pg-2', 'database_name': 'db-pg-2'},
+        {'id': 'pg-1', 'type': 'postgresql_cluster'},
+    ]
+
+    hangs = threading.Event()
+
+    def list_databases(host, **kwargs):
+        if host != 'pg-0.db.zalan.do':
+            hangs.wait(5)
+        return ['db-' + host.split('.')[0]]
+
+    monkeypatch.setattr('zmon_aws_agent.postgresql.list_postgres_databases', list_databases)
+    monkeypatch.setattr('zmon_aws_agent.postgresql.POSTGRESQL_DISCOVERY_TIMEOUT', 0.2)
+
+    # the expired list of pg-2 is used when it times out
+    postgresql.POSTGRESQL_DATABASES_CACHE['pg-2.db.zalan.do'] = (0, ['db-pg-2-cached'])
+
+    databases = postgresql.get_databases_from_clusters(pgclusters, 'aws:1234567890', 'eu-xxx-1', 'pguser', 'pgpass',
+                                                       existing_entities=existing)
+
+    hangs.set()
+
+    # pg-1 has no known databases, so its existing entities are kept
+    assert [db['database_name'] for db in databases] == ['db-pg-0', 'db-pg-1', 'db-pg-2-cached']
+    assert databases[1] is existing[0]
+
+
+def test_get_databases_from_clusters_cache(monkeypatch):
+    pgclusters = [{'id': 'pg-1', 'dnsname': 'pg-1.db.zalan.do'}, {'id': 'pg-2', 'dnsname': 'pg-2.db.zalan.do'}]
+
+    list_databases = MagicMock()
+    list_databases.side_effect = lambda host, **kwargs: ['db1'] if host == 'pg-1.db.zalan.do' else []
+    monkeypatch.setattr('zmon_aws_agent.postgresql.list_postgres_databases', list_databases)
+
+    now = MagicMock()
+    now.return_value = 1000
+    monkeypatch.setattr('zmon_aws_agent.postgresql.time.time', now)
+    monkeypatch.setattr('zmon_aws_agent.postgresql.POSTGRESQL_DATABASES_TTL', 600)
+
+    postgresql.get_databases_from_clusters(pgclusters, 'aws:1234567890', 'eu-xxx-1', 'pguser', 'pgpass')
+    databases = postgresql.get_databases_from_clusters(pgclusters, 'aws:1234567890', 'eu-xxx-1', 'pguser', 'pgpass')
+
+    assert [db['database_name'] for db in databases] == ['db1']
+
+    # clusters without databases are cached as well
+    assert [c[1]['host'] for c in list_databases.call_args_list] == ['pg-1.db.zalan.do', 'pg-2.db.zalan.do']
+
+    now.return_value = 1600
+    list_databases.reset_mock()
+
+    postgresql.get_databases_from_clusters(pgclusters[:1], 'aws:1234567890', 'eu-xxx-1', 'pguser', 'pgpass')
+
+    assert list_databases.call_count == 1
+    assert list(postgresql.POSTGRESQL_DATABASES_CACHE) == ['pg-1.db.zalan.do']
+
+
+def get_connection_mock(rows=None):
+    conn = MagicMock()
+    conn.cursor.return_value.__enter__.return_value.fetchall.return_value = rows or []
+    return conn
+
+
+def test_list_postgres_databases(monkeypatch):
+    conn = get_connection_mock([('db1',), ('db2',)])
+    connect = MagicMock(return_value=conn)
+    monkeypatch.setattr('zmon_aws_agent.postgresql.psycopg2.connect', connect)
+
+    kwargs = {'host': 'pg-1.db.zalan.do', 'port': 5432, 'user': 'pguser', 'password': 'pgpass', 'dbname': 'postgres'}
+
+    assert postgresql.list_postgres_databases(**kwargs) == ['db1', 'db2']
+
+    connect.assert_called_once_with(connect_timeout=postgresql.POSTGRESQL_CONNECT_TIMEOUT, **kwargs)
+    conn.close.assert_called_once_with()
+
+
+def test_list_postgres_databases_fails(monkeypatch):
+    conn = get_connection_mock()
+    conn.cursor.return_value.__enter__.return_value.execute.side_effect = postgresql.psycopg2.ProgrammingError
+    monkeypatch.setattr('zmon_aws_agent.postgresql.psycopg2.connect', MagicMock(return_value=conn))
+
+    # failures are told apart from clusters without databases
+    assert postgresql.list_postgres_databases(host='pg-1.db.zalan.do', port=5432) is None
+
+    conn.close.assert_called_once_with()
+
+
 def test_collect_eip_addresses(monkeypatch, fx_addresses):
     ec2 = MagicMock()
     ec2.describe_addresses.return_value = fx_addresses
@@ -64,7 +192,7 @@ def test_collect_eip_addresses(monkeypatch, fx_addresses):
                     'PublicIp': '22.33.44.55',
                     'AllocationId': 'eipalloc-22334455'}]
 
-    boto.assert_called_with('ec2', region_name=conftest.pg_region)
+    boto.assert_called_with('ec2', region_name=conftest.pg_region, config=ANY)
 
 
 def test_filter_asgs(fx_asgs, fx_asgs_expected):
@@ -75,43 +203,100 @@ def test_filter_instances(fx_pg_instances, fx_pg_instances_expected):
     assert postgresql.filter_instances(conftest.pg_infrastructure_account, fx_pg_instances) == fx_pg_instances_expected
 
 
-def test_collect_launch_configurations(monkeypatch, fx_launch_configuration, fx_launch_configuration_expected):
+def test_collect_eip_allocations(monkeypatch, fx_launch_configuration, fx_eip_allocation):
+    lcs = fx_launch_configuration['LaunchConfigurations']
+    user_data = lcs[0]['UserData']
+
+    raw_asgs = [
+        {'AutoScalingGroupName': 'spilo-malm', 'LaunchConfigurationName': lcs[0]['LaunchConfigurationName']},
+        {'AutoScalingGroupName': 'spilo-lt', 'LaunchTemplate': {'LaunchTemplateId': 'lt-1', 'Version': '3'}},
+        {'AutoScalingGroupName': 'spilo-latest', 'MixedInstancesPolicy': {'LaunchTemplate': {
+            'LaunchTemplateSpecification': {'LaunchTemplateName': 'spilo-latest', 'Version': '$Latest'}}}},
+        {'AutoScalingGroupName': 'spilo-none'},
+    ]
+
+    inventory = RegionInventory(conftest.pg_region)
+    inventory._data['auto_scaling_groups'] = raw_asgs
+
     asg = MagicMock()
-    asg.get_paginator.return_value.paginate.return_value.build_full_result.return_value = fx_launch_configuration
-    boto = get_boto_client(monkeypatch, asg)
+    asg.describe_launch_configurations.return_value = {'LaunchConfigurations': lcs[:1]}
 
-    res = postgresql.collect_launch_configurations(conftest.pg_infrastructure_account, conftest.pg_region)
+    ec2 = MagicMock()
+    ec2.describe_launch_template_versions.return_value = {
+        'LaunchTemplateVersions': [{'LaunchTemplateData': {'UserData': user_data}}]}
 
-    assert res == fx_launch_configuration_expected
+    boto = get_boto_client(monkeypatch, asg, ec2)
 
-    asg.get_paginator.assert_called_with('describe_launch_configurations')
-    boto.assert_called_with('autoscaling', region_name=conftest.pg_region)
+    names = [a['AutoScalingGroupName'] for a in raw_asgs] + ['spilo-unknown']
 
+    res = postgresql.collect_eip_allocations(conftest.pg_infrastructure_account, conftest.pg_region, names,
+                                             inventory=inventory)
 
-def test_extract_eipalloc_from_lc(fx_eip_allocation, fx_launch_configuration_expected):
-    postgresql.collect_launch_configurations = MagicMock(return_value=fx_launch_configuration_expected)
+    expected = {'spilo-malm': fx_eip_allocation, 'spilo-lt': fx_eip_allocation, 'spilo-latest': fx_eip_allocation}
+    assert res == expected
 
-    res = postgresql.extract_eipalloc_from_lc(
-        postgresql.collect_launch_configurations(conftest.pg_infrastructure_account), conftest.PG_CLUSTER)
+    asg.describe_launch_configurations.assert_called_once_with(
+        LaunchConfigurationNames=[lcs[0]['LaunchConfigurationName']])
+    ec2.describe_launch_template_versions.assert_has_calls([
+        call(LaunchTemplateId='lt-1', Versions=['3']),
+        call(LaunchTemplateName='spilo-latest', Versions=['$Latest']),
+    ], any_order=True)
 
-    assert res == fx_eip_allocation
+    calls = [call('autoscaling', region_name=conftest.pg_region, config=ANY),
+             call('ec2', region_name=conftest.pg_region, config=ANY)]
+    boto.assert_has_calls(calls)
 
+    # only the symbolic template version is looked up again
+    assert postgresql.collect_eip_allocations(conftest.pg_infrastructure_account, conftest.pg_region, names,
+                                              inventory=inventory) == expected
 
-def test_collect_hostedzones(monkeypatch, fx_hosted_zones, fx_hosted_zones_expected):
-    route53 = MagicMock()
-    route53.list_hosted_zones.return_value = fx_hosted_zones
-    boto = get_boto_client(monkeypatch, route53)
+    asg.describe_launch_configurations.assert_called_once()
+    assert ec2.describe_launch_template_versions.call_count == 3
+    ec2.describe_launch_template_versions.assert_called_with(LaunchTemplateName='spilo-latest', Versions=['$Latest'])
+
+
+def test_collect_eip_allocations_missing_template(monkeypatch, fx_launch_configuration, fx_eip_allocation):
+    user_data = fx_launch_configuration['LaunchConfigurations'][0]['UserData']
 
-    res = postgresql.collect_hosted_zones(conftest.pg_infrastructure_account, conftest.pg_region)
+    raw_asgs = [
+        {'AutoScalingGroupName': 'spilo-deleted', 'LaunchTemplate': {'LaunchTemplateId': 'lt-1', 'Version': '3'}},
+        {'AutoScalingGroupName': 'spilo-lt', 'LaunchTemplate': {'LaunchTemplateId': 'lt-2', 'Version': '1'}},
+    ]
+
+    inventory = RegionInventory(conftest.pg_region)
+    inventory._data['auto_scaling_groups'] = raw_asgs
+
+    def describe_launch_template_versions(Versions, LaunchTemplateId):
+        if LaunchTemplateId == 'lt-1':
+            raise ClientError(operation_name='DescribeLaunchTemplateVersions',
+                              error_response={'Error': {'Code': 'InvalidLaunchTemplateId.NotFound'}})
+        return {'LaunchTemplateVersions': [{'LaunchTemplateData': {'UserData': user_data}}]}
+
+    ec2 = MagicMock()
+    ec2.describe_launch_template_versions.side_effect = describe_launch_template_versions
 
-    assert res == fx_hosted_zones_expected
+    get_boto_client(monkeypatch, ec2)
+    monkeypatch.setattr('zmon_aws_agent.postgresql.call_and_retry', lambda f, *args, **kwargs: f(*args, **kwargs))
 
-    boto.assert_called_with('route53', region_name=conftest.pg_region)
+    res = postgresql.collect_eip_allocations(conftest.pg_infrastructure_account, conftest.pg_region,
+                                             ['spilo-deleted', 'spilo-lt'], inventory=inventory)
 
+    assert res == {'spilo-deleted': '', 'spilo-lt': fx_eip_allocation}
+    assert list(postgresql.EIP_ALLOCATION_CACHE) == [('lt', 'LaunchTemplateId', 'lt-2', '1')]
 
-def test_collect_recordsets(monkeypatch, fx_recordsets, fx_ips_dnsnames, fx_hosted_zones_expected):
-    postgresql.collect_hosted_zones = MagicMock(return_value=fx_hosted_zones_expected)
+
+@pytest.mark.parametrize('user_data,expected', [
+    ('ZW52aXJvbm1lbnQ6IHtFSVBfQUxMT0NBVElPTjogZWlwYWxsb2MtMjIzMzQ0NTV9Cg==', 'eipalloc-22334455'),
+    ('ZW52aXJvbm1lbnQ6IHt9Cg==', ''),
+    (None, ''),
+])
+def test_extract_eipalloc_from_user_data(user_data, expected):
+    assert postgresql.extract_eipalloc_from_user_data(user_data) == expected
+
+
+def test_collect_recordsets(monkeypatch, fx_hosted_zones, fx_recordsets, fx_ips_dnsnames):
     route53 = MagicMock()
+    route53.list_hosted_zones.return_value = fx_hosted_zones
     route53.get_paginator.return_value.paginate.return_value.build_full_result.return_value = fx_recordsets
     boto = get_boto_client(monkeypatch, route53)
 
@@ -119,18 +304,22 @@ def test_collect_recordsets(monkeypatch, fx_recordsets, fx_ips_dnsnames, fx_host
 
     assert res == fx_ips_dnsnames
 
-    route53.get_paginator.assert_called_with('list_resource_record_sets')
-    boto.assert_called_with('route53', region_name=conftest.pg_region)
+    # the DNS data is shared with the other collectors and not listed again
+    assert postgresql.collect_recordsets(conftest.pg_infrastructure_account, conftest.pg_region) == fx_ips_dnsnames
+
+    route53.get_paginator.assert_called_once_with('list_resource_record_sets')
+    route53.get_paginator.return_value.paginate.assert_called_once_with(HostedZoneId='/hostedzone/Z1FLVOF8MF971S')
+    boto.assert_called_once_with('route53', region_name=None, config=ANY)
 
 
 def test_get_postgresql_clusters(
         fx_addresses_expected, fx_asgs_expected, fx_pg_instances_expected,
-        fx_eip_allocation, fx_launch_configuration_expected, fx_ips_dnsnames
+        fx_eip_allocation, fx_ips_dnsnames, monkeypatch
 ):
-    postgresql.collect_eip_addresses = MagicMock(return_value=fx_addresses_expected)
-    postgresql.collect_launch_configurations = MagicMock(return_value=fx_launch_configuration_expected)
-    postgresql.extract_eipalloc_from_lc = MagicMock(return_value=fx_eip_allocation)
-    postgresql.collect_recordsets = MagicMock(return_value=fx_ips_dnsnames)
+    monkeypatch.setattr(postgresql, 'collect_eip_addresses', MagicMock(return_value=fx_addresses_expected))
+    monkeypatch.setattr(postgresql, 'collect_eip_allocations',
+                        MagicMock(return_value={'spilo-bla': fx_eip_allocation, 'spilo-malm': fx_eip_allocation}))
+    monkeypatch.setattr(postgresql, 'collect_recordsets', MagicMock(return_value=fx_ips_dnsnames))
 
     entities = postgresql.get_postgresql_clusters(conftest.REGION, conftest.pg_infrastructure_account,
                                                   fx_asgs_expected, fx_pg_instances_expected)
@@ -169,12 +358,28 @@ def test_get_postgresql_clusters(
                          'shards': {'postgres': 'other.cluster.co.uk:5432/postgres'}}]
 
 
+def test_get_postgresql_clusters_missing_instance(
+        fx_addresses_expected, fx_asgs_expected, fx_pg_instances_expected,
+        fx_eip_allocation, fx_ips_dnsnames, monkeypatch
+):
+    monkeypatch.setattr(postgresql, 'collect_eip_addresses', MagicMock(return_value=fx_addresses_expected))
+    monkeypatch.setattr(postgresql, 'collect_eip_allocations',
+                        MagicMock(return_value={'spilo-bla': fx_eip_allocation, 'spilo-malm': fx_eip_allocation}))
+    monkeypatch.setattr(postgresql, 'collect_recordsets', MagicMock(return_value=fx_ips_dnsnames))
+
+    instances = [i for i in fx_pg_instances_expected if i['aws_id'] != 'i-02e0']
+
+    entities = postgresql.get_postgresql_clusters(conftest.REGION, conftest.pg_infrastructure_account,
+                                                  fx_asgs_expected, instances)
+
+    assert [[i['instance_id'] for i in e['instances']] for e in entities] == [['i-1234'], ['i-4444', 'i-5555']]
+
+
 # If any of the utility functions fail, we expect an empty list
 fx_something_fails = ['collect_eip_addresses',
                       'filter_asgs',
                       'filter_instances',
-                      'collect_launch_configurations',
-                      'extract_eipalloc_from_lc']
+                      'collect_eip_allocations']
 
 
 @pytest.mark.parametrize('func', fx_something_fails)
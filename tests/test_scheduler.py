@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+from concurrent.futures import TimeoutError
+
+from zmon_aws_agent.scheduler import Task, TasksTimeout, run_tasks
+
+
+def test_run_tasks_passes_required_results():
+    tasks = [
+        Task('apps', lambda r: ['app-1']),
+        Task('elbs', lambda r: ['elb-1']),
+        Task('limits', lambda r: {'apps': len(r['apps']), 'elbs': len(r['elbs']), 'keys': sorted(r)},
+             requires=['apps', 'elbs']),
+    ]
+
+    res = run_tasks(tasks, max_workers=2)
+
+    assert res == {'apps': ['app-1'], 'elbs': ['elb-1'], 'limits': {'apps': 1, 'elbs': 1, 'keys': ['apps', 'elbs']}}
+
+
+def test_run_tasks_runs_independent_tasks_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+
+    tasks = [
+        Task('first', lambda r: barrier.wait() is not None),
+        Task('second', lambda r: barrier.wait() is not None),
+    ]
+
+    assert run_tasks(tasks, max_workers=2) == {'first': True, 'second': True}
+
+
+def test_run_tasks_starts_dependent_task_early():
+    slow_done = threading.Event()
+    order = []
+
+    def slow(r):
+        time.sleep(0.2)
+        order.append('slow')
+        slow_done.set()
+
+    def dependent(r):
+        order.append('dependent')
+        assert not slow_done.is_set()
+
+    tasks = [
+        Task('slow', slow),
+        Task('fast', lambda r: order.append('fast')),
+        Task('dependent', dependent, requires=['fast']),
+    ]
+
+    run_tasks(tasks, max_workers=3)
+
+    assert order == ['fast', 'dependent', 'slow']
+
+
+def test_run_tasks_exception():
+    called = []
+
+    def fail(r):
+        raise RuntimeError('Oops')
+
+    tasks = [
+        Task('fail', fail),
+        Task('after', lambda r: called.append(1), requires=['fail']),
+    ]
+
+    with pytest.raises(RuntimeError):
+        run_tasks(tasks)
+
+    assert called == []
+
+
+def test_run_tasks_timeout():
+    event = threading.Event()
+
+    tasks = [Task('hangs', lambda r: event.wait(5))]
+
+    with pytest.raises(TimeoutError) as e:
+        run_tasks(tasks, timeout=0.1)
+
+    assert isinstance(e.value, TasksTimeout)
+    assert [f.done() for f in e.value.futures] == [False]
+
+    event.set()
+
+
+def test_run_tasks_exception_attaches_running_tasks():
+    started = threading.Event()
+    event = threading.Event()
+
+    def hangs(r):
+        started.set()
+        event.wait(5)
+
+    def fails(r):
+        started.wait(5)
+        raise RuntimeError('Failed')
+
+    tasks = [Task('hangs', hangs), Task('fails', fails)]
+
+    with pytest.raises(RuntimeError) as e:
+        run_tasks(tasks, max_workers=2)
+
+    assert [f.done() for f in e.value.futures] == [False]
+
+    event.set()
+
+
+@pytest.mark.parametrize('tasks', [
+    [Task('a', lambda r: 1, requires=['missing'])],
+    [Task('a', lambda r: 1, requires=['b']), Task('b', lambda r: 1, requires=['a'])],
+])
+def test_run_tasks_invalid_requirements(tasks):
+    with pytest.raises(ValueError):
+        run_tasks(tasks)
@@ -4,32 +4,93 @@ import hashlib
 import inflection
 import re
 import string
+import threading
 import json
+import os
+import time
 import traceback
 
 from datetime import datetime
 
-import boto3
 import yaml
 
 from botocore.exceptions import ClientError
 
-from zmon_aws_agent.common import call_and_retry
+from zmon_aws_agent.common import call_and_retry, get_client, load_cache, save_cache, parallel_map, MAX_PAGE
+from zmon_aws_agent.inventory import RegionInventory
 from opentracing_utils import trace, extract_span_from_kwargs
 
 BASE_LIST = string.digits + string.ascii_letters
 BASE_DICT = dict((c, i) for i, c in enumerate(BASE_LIST))
 
 DNS_ZONE_CACHE = {}
+
+# weighted records per hosted zone ID, zones of a split-horizon setup share their name
 DNS_RR_CACHE_ZONE = {}
 
+# CNAMEs pointing to public EC2 host names, per hosted zone ID: public IP -> record name
+DNS_CNAME_CACHE_ZONE = {}
+
+# weight of the weighted records by SetIdentifier, None if the identifier is not unique in its zone
+DNS_WEIGHT_INDEX = {}
+
+# public IP -> name of the CNAME pointing to it, over all zones
+DNS_CNAME_INDEX = {}
+
+# hosted zone ID -> (record count, fetch time) of the records in DNS_RR_CACHE_ZONE and DNS_CNAME_CACHE_ZONE
+DNS_ZONE_SNAPSHOTS = {}
+DNS_ZONE_MAX_AGE = int(os.environ.get('AGENT_DNS_ZONE_MAX_AGE', 300))
+
+# listeners of application/network load balancers: ARN -> (expiry, listeners)
+ELB_LISTENERS_CACHE = {}
+ELB_LISTENERS_TTL = int(os.environ.get('AGENT_ELB_LISTENERS_TTL', 3600))
+
+# status, name and ARN of DynamoDB tables: (region, table name) -> (expiry, table)
+DYNAMODB_TABLES_CACHE = {}
+DYNAMODB_TABLES_TTL = int(os.environ.get('AGENT_DYNAMODB_TABLES_TTL', 3600))
+# tables which are not ACTIVE (e.g. CREATING, UPDATING) are described again sooner
+DYNAMODB_TABLES_TRANSITION_TTL = int(os.environ.get('AGENT_DYNAMODB_TABLES_TRANSITION_TTL', 60))
+
+# ACM certificate details: (region, certificate ARN) -> (expiry, certificate)
+ACM_CERTIFICATE_CACHE = {}
+ACM_CERTIFICATE_TTL = int(os.environ.get('AGENT_ACM_CERTIFICATE_TTL', 3600))
+# certificates which are not ISSUED or expire within the renewal window are described again sooner
+ACM_CERTIFICATE_TRANSITION_TTL = int(os.environ.get('AGENT_ACM_CERTIFICATE_TRANSITION_TTL', 300))
+ACM_CERTIFICATE_RENEWAL_WINDOW = int(os.environ.get('AGENT_ACM_CERTIFICATE_RENEWAL_WINDOW', 30 * 24 * 3600))
+
+# account ID, alias and limits, which change rarely: (region, field) or (account, region, field) -> (expiry, value)
+# only entries keyed by account are persisted, the account ID itself is looked up again after a restart
+ACCOUNT_METADATA_CACHE = {}
+ACCOUNT_METADATA_LOCK = threading.Lock()
+ACCOUNT_ID_TTL = int(os.environ.get('AGENT_ACCOUNT_ID_TTL', 24 * 3600))
+ACCOUNT_ALIAS_TTL = int(os.environ.get('AGENT_ACCOUNT_ALIAS_TTL', 24 * 3600))
+ACCOUNT_LIMITS_TTL = int(os.environ.get('AGENT_ACCOUNT_LIMITS_TTL', 3600))
+
+# parsed userData of running instances: instance ID -> (launch time, user data)
+# only USER_DATA_KEYS are kept, userData often carries secrets and the cache is persisted
+USER_DATA_CACHE = {}
+USER_DATA_KEYS = ('application_id', 'application_version', 'source', 'ports', 'runtime', 'logging')
+
+# name and creation date of AMIs, which never change: image ID -> {'name': ..., 'date': ...}
+IMAGE_CACHE = {}
+IMAGE_CHUNK_SIZE = 100
+
 INVALID_ENTITY_FIRST_CHAR = re.compile(r'^[^a-z]+')
 INVALID_ENTITY_CHARS_PATTERN = re.compile(r'[^a-zA-Z0-9@._:\[\]-]')
 
 # hack, to identify kubernetes ELBs
 KUBE_SERVICE_TAG = 'kubernetes.io/service_name'
 
-MAX_PAGE = 10000
+# queue attributes used by SQS entities
+SQS_QUEUE_ATTRIBUTES = ['QueueArn', 'MessageRetentionPeriod', 'MaximumMessageSize', 'ReceiveMessageWaitTimeSeconds',
+                        'DelaySeconds', 'VisibilityTimeout', 'RedrivePolicy']
+SQS_MAX_WORKERS = int(os.environ.get('AGENT_SQS_MAX_WORKERS', 10))
+# ask SQS for the dead letter sources of every queue instead of deriving them from the listed redrive policies,
+# e.g. to also cover source queues in other accounts or regions
+SQS_DEAD_LETTER_SOURCE_LOOKUP = os.environ.get('AGENT_SQS_DEAD_LETTER_SOURCE_LOOKUP', 'false').lower() == 'true'
+
+# limit instance event retrieval to these event codes, e.g. "instance-retirement,system-reboot"
+INSTANCE_EVENT_CODES = [c for c in os.environ.get('AGENT_INSTANCE_EVENT_CODES', '').split(',') if c]
 
 logger = logging.getLogger(__name__)
 
@@ -57,59 +118,121 @@ def base_encode(integer, base=BASE_LIST):
     return ret
 
 
+def is_weighted_record(r):
+    return (
+        ('SetIdentifier' in r and 'Weight' in r) and
+        (r['Type'] == 'CNAME' or r.get('AliasTarget', {}).get('DNSName'))
+    )
+
+
+def get_public_ip_cnames(records):
+    cnames = {}
+    for r in records:
+        if r['Type'] == 'CNAME' and r.get('ResourceRecords'):
+            # ec2-11-22-33-44.eu-central-1.compute.amazonaws.com. -> 11.22.33.44
+            host = r['ResourceRecords'][0]['Value'].split('.')[0]
+            if host.startswith('ec2-'):
+                cnames[host.replace('ec2-', '').replace('-', '.')] = r.get('Name', '')[0:-1]  # cut off the final .
+
+    return cnames
+
+
+def get_zone_records(route53, zone):
+    """Return the weighted records and the public IP CNAMEs of a hosted zone."""
+    paginator = route53.get_paginator('list_resource_record_sets')
+    records = call_and_retry(
+        lambda: paginator.paginate(HostedZoneId=zone['Id']).build_full_result()['ResourceRecordSets'])
+
+    return [r for r in records if is_weighted_record(r)], get_public_ip_cnames(records)
+
+
+def is_zone_snapshot_current(zone, now):
+    snapshot = DNS_ZONE_SNAPSHOTS.get(zone['Id'])
+    if not snapshot or zone['Id'] not in DNS_RR_CACHE_ZONE or zone['Id'] not in DNS_CNAME_CACHE_ZONE:
+        return False
+
+    record_count, fetched = snapshot
+
+    # changing a weight does not change the record count, so snapshots are refreshed after some time anyway
+    return record_count == zone.get('ResourceRecordSetCount') and now - fetched < DNS_ZONE_MAX_AGE
+
+
 @trace(tags={'aws': 'dns'})
-def populate_dns_data():
-    route53 = boto3.client('route53')
-    result = route53.list_hosted_zones()
-    zones = result['HostedZones']
+def populate_dns_data(inventory=None):
+    inventory = inventory or RegionInventory(None)
 
-    while result.get('IsTruncated', False):
-        recordfilter = {'Marker': result['NextMarker']}
-        result = route53.list_hosted_zones(**recordfilter)
-        zones.extend(result['HostedZones'])
+    route53 = get_client('route53')
+    zones = inventory.hosted_zones
 
     if len(zones) == 0:
         raise ValueError('No Zones are configured!')
 
+    if not DNS_ZONE_SNAPSHOTS:
+        persisted = load_cache('dns_zones', {})
+        DNS_ZONE_SNAPSHOTS.update(persisted.get('snapshots', {}))
+        DNS_RR_CACHE_ZONE.update(persisted.get('records', {}))
+        DNS_CNAME_CACHE_ZONE.update(persisted.get('cnames', {}))
+
+    # drop zones which were deleted since the last run of a long running agent
+    for name in set(DNS_ZONE_CACHE.keys()) - {zone['Name'] for zone in zones}:
+        del DNS_ZONE_CACHE[name]
+
+    for zone_id in (set(DNS_ZONE_SNAPSHOTS.keys()) | set(DNS_RR_CACHE_ZONE.keys())) - {zone['Id'] for zone in zones}:
+        DNS_RR_CACHE_ZONE.pop(zone_id, None)
+        DNS_CNAME_CACHE_ZONE.pop(zone_id, None)
+        DNS_ZONE_SNAPSHOTS.pop(zone_id, None)
+
+    now = time.time()
+
     for zone in zones:
         DNS_ZONE_CACHE[zone['Name']] = zone
 
-        result = route53.list_resource_record_sets(HostedZoneId=zone['Id'])
-        records = result['ResourceRecordSets']
+    # only zones whose record count changed or whose snapshot is too old are listed again
+    stale = [zone for zone in zones if not is_zone_snapshot_current(zone, now)]
 
-        while result.get('IsTruncated', False):
-            recordfilter = {
-                'HostedZoneId': zone['Id'],
-                'StartRecordName': result['NextRecordName'],
-                'StartRecordType': result['NextRecordType']
-            }
-            if result.get('NextRecordIdentifier'):
-                recordfilter['StartRecordIdentifier'] = result.get('NextRecordIdentifier')
+    for zone, (records, cnames) in zip(stale, parallel_map(lambda zone: get_zone_records(route53, zone), stale)):
+        DNS_RR_CACHE_ZONE[zone['Id']] = records
+        DNS_CNAME_CACHE_ZONE[zone['Id']] = cnames
+        DNS_ZONE_SNAPSHOTS[zone['Id']] = (zone.get('ResourceRecordSetCount'), now)
 
-            result = route53.list_resource_record_sets(**recordfilter)
-            records.extend(result['ResourceRecordSets'])
+    if stale:
+        save_cache('dns_zones',
+                   {'snapshots': DNS_ZONE_SNAPSHOTS, 'records': DNS_RR_CACHE_ZONE, 'cnames': DNS_CNAME_CACHE_ZONE})
 
-        DNS_RR_CACHE_ZONE[zone['Name']] = [
-            r for r in records if (
-                ('SetIdentifier' in r and 'Weight' in r) and
-                (r['Type'] == 'CNAME' or r.get('AliasTarget', {}).get('DNSName'))
-            )
-        ]
+    index_dns_data(zones)
 
 
-def get_weight_for_stack(stack_name, stack_version):
-    records = []
+def index_dns_data(zones):
+    """
+    Rebuild DNS_WEIGHT_INDEX and DNS_CNAME_INDEX from the cached record sets of ``zones``.
 
-    for zone in DNS_ZONE_CACHE.keys():
-        records = [r for r in DNS_RR_CACHE_ZONE[zone] if r['SetIdentifier'] == stack_name + '-' + stack_version]
+    The first zone containing a SetIdentifier wins, an identifier occurring more than once in that zone has no weight.
+    Likewise the first zone with a CNAME to a public IP determines its name.
+    """
+    index = {}
+    cnames = {}
 
-        if records:
-            break
+    for zone in zones:
+        zone_index = {}
+        for r in DNS_RR_CACHE_ZONE.get(zone['Id'], []):
+            set_id = r['SetIdentifier']
+            zone_index[set_id] = None if set_id in zone_index else r['Weight']
 
-    if len(records) != 1:
-        return None
+        for set_id, weight in zone_index.items():
+            index.setdefault(set_id, weight)
+
+        for ip, name in DNS_CNAME_CACHE_ZONE.get(zone['Id'], {}).items():
+            cnames.setdefault(ip, name)
 
-    return records[0]['Weight']
+    DNS_WEIGHT_INDEX.clear()
+    DNS_WEIGHT_INDEX.update(index)
+
+    DNS_CNAME_INDEX.clear()
+    DNS_CNAME_INDEX.update(cnames)
+
+
+def get_weight_for_stack(stack_name, stack_version):
+    return DNS_WEIGHT_INDEX.get(stack_name + '-' + stack_version)
 
 
 def add_traffic_tags_to_entity(entity):
@@ -156,30 +279,100 @@ def get_instance_devices(aws_client, instance):
     return devices
 
 
+def get_user_data(aws_client, instance):
+    """
+    Return the ``USER_DATA_KEYS`` of the parsed userData of a running instance.
+
+    userData can not change while an instance is running, so it is fetched only once per instance launch.
+    """
+    instance_id = instance['InstanceId']
+    launch_time = str(instance.get('LaunchTime', ''))
+
+    cached = USER_DATA_CACHE.get(instance_id)
+    if cached and cached[0] == launch_time:
+        return cached[1]
+
+    user_data_response = call_and_retry(aws_client.describe_instance_attribute,
+                                        InstanceId=instance_id,
+                                        Attribute='userData')
+
+    try:
+        user_data = base64.b64decode(user_data_response['UserData']['Value'])
+        user_data = yaml.safe_load(user_data)
+    except Exception:
+        user_data = None
+
+    if isinstance(user_data, dict):
+        user_data = {k: v for k, v in user_data.items() if k in USER_DATA_KEYS}
+    else:
+        user_data = None
+
+    USER_DATA_CACHE[instance_id] = (launch_time, user_data)
+
+    return user_data
+
+
+def get_images(aws_client, image_ids):
+    """
+    Return name and creation date of the given AMIs, keyed by image ID.
+
+    AMIs are immutable, so only images which were not described before are fetched. Images which are not used by any
+    of the given IDs any more are dropped from the cache.
+    """
+    image_ids = set(image_ids)
+
+    if not IMAGE_CACHE:
+        IMAGE_CACHE.update(load_cache('images', {}))
+
+    for image_id in set(IMAGE_CACHE.keys()) - image_ids:
+        del IMAGE_CACHE[image_id]
+
+    missing = sorted(image_ids - set(IMAGE_CACHE.keys()))
+
+    for ids in [missing[i: i + IMAGE_CHUNK_SIZE] for i in range(0, len(missing), IMAGE_CHUNK_SIZE)]:
+        for img in call_and_retry(aws_client.describe_images, ImageIds=ids)['Images']:
+            IMAGE_CACHE[img['ImageId']] = {
+                'name': img.get('Name', 'UNKNOWN'),
+                'date': img.get('CreationDate', '1970-01-01T00:00:00.000+00:00').replace('Z', '+00:00'),
+            }
+
+    if missing:
+        save_cache('images', IMAGE_CACHE)
+
+    return {image_id: IMAGE_CACHE[image_id] for image_id in image_ids if image_id in IMAGE_CACHE}
+
+
 @trace(tags={'aws': 'events'}, pass_span=True)
-def get_instance_events(aws_client, instance, **kwargs):
+def get_instance_events(aws_client, **kwargs):
+    """Return the scheduled events of all instances in the region, keyed by instance ID."""
+    events = {}
+
     try:
-        instance_status_resp = call_and_retry(aws_client.describe_instance_status,
-                                              InstanceIds=[instance['InstanceId']])
+        filters = [{'Name': 'event.code', 'Values': INSTANCE_EVENT_CODES}] if INSTANCE_EVENT_CODES else []
 
-        if 'Events' in instance_status_resp['InstanceStatuses'][0]:
-            return instance_status_resp['InstanceStatuses'][0]['Events']
+        paginator = aws_client.get_paginator('describe_instance_status')
+        statuses = call_and_retry(
+            lambda: paginator.paginate(Filters=filters).build_full_result()['InstanceStatuses'])
+
+        for status in statuses:
+            if 'Events' in status:
+                events[status['InstanceId']] = status['Events']
     except Exception:
         current_span = extract_span_from_kwargs(**kwargs)
         current_span.set_tag('error', True)
         current_span.log_kv({'exception': traceback.format_exc()})
-        logger.exception('Failed to retrieve instance events for instance: {}'.format(instance['InstanceId']))
+        logger.exception('Failed to retrieve instance events')
 
-    return []
+    return events
 
 
 @trace(tags={'aws': 'instance'}, pass_span=True)
-def get_running_apps(region, existing_entities=None, **kwargs):
-    aws_client = boto3.client('ec2', region_name=region)
+def get_running_apps(region, existing_entities=None, inventory=None, **kwargs):
+    inventory = inventory or RegionInventory(region)
+
+    aws_client = get_client('ec2', region)
 
-    paginator = aws_client.get_paginator('describe_instances')
-    rs = call_and_retry(
-        lambda: paginator.paginate(PaginationConfig={'MaxItems': MAX_PAGE}).build_full_result()['Reservations'])
+    rs = inventory.reservations
 
     now = datetime.now()
 
@@ -187,8 +380,14 @@ def get_running_apps(region, existing_entities=None, **kwargs):
         {e['aws_id']: e for e in existing_entities if e['type'] == 'instance'} if existing_entities else {}
     )
 
+    if not USER_DATA_CACHE:
+        USER_DATA_CACHE.update(load_cache('user_data', {}))
+    cached_launches = {k: v[0] for k, v in USER_DATA_CACHE.items()}
+
     result = []
     images = set()
+    running_ids = set()
+    instance_events = None
 
     for r in rs:
 
@@ -201,6 +400,8 @@ def get_running_apps(region, existing_entities=None, **kwargs):
             if str(i['State']['Name']) != 'running':
                 continue
 
+            running_ids.add(i['InstanceId'])
+
             if (now.minute % 7) and i['InstanceId'] in existing_instances:
                 ins = existing_instances[i['InstanceId']]
                 if 'image' in ins:
@@ -209,12 +410,7 @@ def get_running_apps(region, existing_entities=None, **kwargs):
 
                 user_data = None
                 try:
-                    user_data_response = call_and_retry(aws_client.describe_instance_attribute,
-                                                        InstanceId=i['InstanceId'],
-                                                        Attribute='userData')
-
-                    user_data = base64.b64decode(user_data_response['UserData']['Value'])
-                    user_data = yaml.safe_load(user_data)
+                    user_data = get_user_data(aws_client, i)
                 except Exception:
                     pass
 
@@ -303,7 +499,9 @@ def get_running_apps(region, existing_entities=None, **kwargs):
 
             if 'application_id' in ins:
                 if not (now.minute % 10):
-                    ins['events'] = get_instance_events(aws_client, i)
+                    if instance_events is None:
+                        instance_events = get_instance_events(aws_client)
+                    ins['events'] = instance_events.get(i['InstanceId'], [])
                     ins['block_devices'] = get_instance_devices(aws_client, i)
                 else:
                     e = existing_instances.get(ins.get('aws_id', None), None)
@@ -312,20 +510,22 @@ def get_running_apps(region, existing_entities=None, **kwargs):
 
             result.append(ins)
 
-    imgs = []
+    # evict instances which are gone
+    for instance_id in set(USER_DATA_CACHE.keys()) - running_ids:
+        del USER_DATA_CACHE[instance_id]
+
+    if {k: v[0] for k, v in USER_DATA_CACHE.items()} != cached_launches:
+        save_cache('user_data', USER_DATA_CACHE)
+
     # prevent fetching all images (in case the images is empty, it will do so):
-    if list(images):
+    if images:
         try:
-            imgs = aws_client.describe_images(ImageIds=list(images))['Images']
+            imgs = get_images(aws_client, images)
             for i in result:
                 if 'image' not in i or 'id' not in i['image']:
                     continue
-                for img in imgs:
-                    if img['ImageId'] == i['image']['id']:
-                        i['image']['name'] = img.get('Name', 'UNKNOWN')
-                        date = img.get('CreationDate', '1970-01-01T00:00:00.000+00:00').replace('Z', '+00:00')
-                        i['image']['date'] = date
-                        break
+                if i['image']['id'] in imgs:
+                    i['image'].update(imgs[i['image']['id']])
         except Exception:
             current_span = extract_span_from_kwargs(**kwargs)
             current_span.set_tag('error', True)
@@ -339,9 +539,24 @@ def get_running_elbs(region, acc):
     return get_running_elbs_classic(region, acc) + get_running_elbs_application(region, acc)
 
 
+def get_instance_health(elb_client, elb):
+    # nothing to ask for if no instances are registered
+    if not elb['Instances']:
+        return []
+
+    try:
+        return call_and_retry(elb_client.describe_instance_health,
+                              LoadBalancerName=elb['LoadBalancerName'])['InstanceStates']
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('LoadBalancerNotFound', 'ValidationError', 'Throttling'):
+            raise
+
+    return []
+
+
 @trace(tags={'aws': 'elb'})
 def get_running_elbs_classic(region, acc):
-    elb_client = boto3.client('elb', region_name=region)
+    elb_client = get_client('elb', region)
 
     paginator = elb_client.get_paginator('describe_load_balancers')
 
@@ -358,15 +573,17 @@ def get_running_elbs_classic(region, acc):
     #
     name_chunks = [elb_names[i: i + 20] for i in range(0, len(elb_names), 20)]
 
-    tag_desc_chunks = [call_and_retry(elb_client.describe_tags, LoadBalancerNames=names)
-                       for names in name_chunks]
+    tag_desc_chunks = parallel_map(lambda names: call_and_retry(elb_client.describe_tags, LoadBalancerNames=names),
+                                   name_chunks)
 
     tags = {d['LoadBalancerName']: d.get('Tags', [])
             for tag_desc in tag_desc_chunks for d in tag_desc['TagDescriptions']}
 
+    instance_health = parallel_map(lambda e: get_instance_health(elb_client, e), elbs)
+
     lbs = []
 
-    for e in elbs:
+    for e, ihealth in zip(elbs, instance_health):
         name = e['LoadBalancerName']
 
         lsnr = e.get('ListenerDescriptions', [])  # work around empty listener descriptions
@@ -396,15 +613,6 @@ def get_running_elbs_classic(region, acc):
 
         lbs.append(lb)
 
-        ihealth = []
-
-        try:
-            ihealth = call_and_retry(elb_client.describe_instance_health,
-                                     LoadBalancerName=e['LoadBalancerName'])['InstanceStates']
-        except ClientError as e:
-            if e.response['Error']['Code'] not in ('LoadBalancerNotFound', 'ValidationError', 'Throttling'):
-                raise
-
         in_service = 0
         for ih in ihealth:
             if ih['State'] == 'InService':
@@ -415,9 +623,37 @@ def get_running_elbs_classic(region, acc):
     return lbs
 
 
+def get_listeners(elb_client, arns):
+    """Return the listeners of application/network load balancers keyed by ARN, cached for ``ELB_LISTENERS_TTL``."""
+    now = time.time()
+
+    for arn in set(ELB_LISTENERS_CACHE.keys()) - set(arns):
+        del ELB_LISTENERS_CACHE[arn]
+
+    def describe_listeners(arn):
+        return call_and_retry(elb_client.describe_listeners, LoadBalancerArn=arn)['Listeners']
+
+    missing = [arn for arn in arns if arn not in ELB_LISTENERS_CACHE or ELB_LISTENERS_CACHE[arn][0] < now]
+    for arn, listeners in zip(missing, parallel_map(describe_listeners, missing)):
+        ELB_LISTENERS_CACHE[arn] = (now + ELB_LISTENERS_TTL, listeners)
+
+    return {arn: ELB_LISTENERS_CACHE[arn][1] for arn in arns}
+
+
+def get_target_health(elb_client, target_group_arn):
+    try:
+        return call_and_retry(
+            elb_client.describe_target_health, TargetGroupArn=target_group_arn)['TargetHealthDescriptions']
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('LoadBalancerNotFound', 'ValidationError', 'Throttling'):
+            raise
+
+    return None
+
+
 @trace(tags={'aws': 'elb'})
 def get_running_elbs_application(region, acc):
-    elb_client = boto3.client('elbv2', region_name=region)
+    elb_client = get_client('elbv2', region)
 
     paginator = elb_client.get_paginator('describe_load_balancers')
 
@@ -432,22 +668,33 @@ def get_running_elbs_application(region, acc):
 
     tags = {d['ResourceArn']: d.get('Tags', []) for tag_desc in tag_desc_chunks for d in tag_desc['TagDescriptions']}
 
+    # list the target groups of the whole account once and join them to their load balancers
+    tg_paginator = elb_client.get_paginator('describe_target_groups')
+    try:
+        all_target_groups = call_and_retry(
+            lambda: tg_paginator.paginate(PaginationConfig={'MaxItems': MAX_PAGE}).build_full_result()['TargetGroups'])
+    except Exception:
+        all_target_groups = []
+
+    lb_target_groups = {}
+    for tg in all_target_groups:
+        for lb_arn in tg.get('LoadBalancerArns', []):
+            lb_target_groups.setdefault(lb_arn, []).append(tg)
+
+    listeners = get_listeners(elb_client, elb_arns)
+
+    tg_arns = sorted({tg['TargetGroupArn'] for arn in elb_arns for tg in lb_target_groups.get(arn, [])})
+    target_health = dict(zip(tg_arns, parallel_map(lambda tg_arn: get_target_health(elb_client, tg_arn), tg_arns)))
+
     lbs = []
 
     for e in elbs:
         arn = e['LoadBalancerArn']
         name = e['LoadBalancerName']
 
-        tg_paginator = elb_client.get_paginator('describe_target_groups')
-        try:
-            target_groups = call_and_retry(
-                lambda: tg_paginator.paginate(LoadBalancerArn=arn).build_full_result()['TargetGroups'])
-        except Exception:
-            target_groups = []
-
-        listeners = elb_client.describe_listeners(LoadBalancerArn=arn)['Listeners']
+        target_groups = lb_target_groups.get(arn, [])
 
-        protocol = listeners[0]['Protocol'] if listeners else ''
+        protocol = listeners[arn][0]['Protocol'] if listeners[arn] else ''
 
         lb = {
             'id': entity_id('elb-{}[{}:{}]'.format(name, acc, region)),
@@ -473,18 +720,15 @@ def get_running_elbs_application(region, acc):
         healthy_targets = 0
         members = 0
         for tg in target_groups:
-            try:
-                target_health = call_and_retry(
-                    elb_client.describe_target_health, TargetGroupArn=tg['TargetGroupArn'])['TargetHealthDescriptions']
+            health = target_health[tg['TargetGroupArn']]
+            if health is None:
+                continue
 
-                members += len(target_health)
+            members += len(health)
 
-                for th in target_health:
-                    if th['TargetHealth']['State'] == 'healthy':
-                        healthy_targets += 1
-            except ClientError as e:
-                if e.response['Error']['Code'] not in ('LoadBalancerNotFound', 'ValidationError', 'Throttling'):
-                    raise
+            for th in health:
+                if th['TargetHealth']['State'] == 'healthy':
+                    healthy_targets += 1
 
         lb['members'] = members
         lb['active_members'] = healthy_targets
@@ -495,16 +739,22 @@ def get_running_elbs_application(region, acc):
 
 
 @trace(tags={'aws': 'asg'}, pass_span=True)
-def get_auto_scaling_groups(region, acc, **kwargs):
-    groups = []
+def get_auto_scaling_groups(region, acc, inventory=None, **kwargs):
+    inventory = inventory or RegionInventory(region)
 
-    as_client = boto3.client('autoscaling', region_name=region)
-    ec2_client = boto3.client('ec2', region_name=region)
+    groups = []
 
-    paginator = as_client.get_paginator('describe_auto_scaling_groups')
+    asgs = inventory.auto_scaling_groups
 
-    asgs = call_and_retry(
-        lambda: paginator.paginate(PaginationConfig={'MaxItems': MAX_PAGE}).build_full_result()['AutoScalingGroups'])
+    # the instances of the region are shared with the instance collector
+    instances = {}
+    try:
+        instances = inventory.instances_by_id
+    except Exception:
+        current_span = extract_span_from_kwargs(**kwargs)
+        current_span.set_tag('error', True)
+        current_span.log_kv({'exception': traceback.format_exc()})
+        logger.exception('Failed in retrieving instances for ASGs')
 
     for g in asgs:
         sg = {
@@ -526,30 +776,13 @@ def get_auto_scaling_groups(region, acc, **kwargs):
         add_traffic_tags_to_entity(sg)
 
         sg['instances'] = []
-        instance_ids = [i['InstanceId'] for i in g['Instances'] if i['LifecycleState'] == 'InService']
-        #
-        # Avoid describing instances when there's nothing to filter
-        # for: that would claim *every* instance in the account.
-        #
-        if instance_ids:
-            ec2_paginator = ec2_client.get_paginator('describe_instances')
-
-            try:
-                reservations = call_and_retry(
-                    lambda: ec2_paginator.paginate(InstanceIds=instance_ids).build_full_result()['Reservations'])
-
-                for r in reservations:
-                    for i in r['Instances']:
-                        if 'PrivateIpAddress' in i:
-                            sg['instances'].append({
-                                'aws_id': i['InstanceId'],
-                                'ip': i['PrivateIpAddress'],
-                            })
-            except Exception:
-                current_span = extract_span_from_kwargs(**kwargs)
-                current_span.set_tag('error', True)
-                current_span.log_kv({'exception': traceback.format_exc()})
-                logger.exception('Failed in retrieving instances for ASG: {}'.format(sg['name']))
+        for asg_instance in g['Instances']:
+            i = instances.get(asg_instance['InstanceId'])
+            if asg_instance['LifecycleState'] == 'InService' and i and 'PrivateIpAddress' in i:
+                sg['instances'].append({
+                    'aws_id': i['InstanceId'],
+                    'ip': i['PrivateIpAddress'],
+                })
 
         groups.append(sg)
 
@@ -558,7 +791,7 @@ def get_auto_scaling_groups(region, acc, **kwargs):
 
 @trace(tags={'aws': 'elc'})
 def get_elasticache_nodes(region, acc):
-    elc = boto3.client('elasticache', region_name=region)
+    elc = get_client('elasticache', region)
     paginator = elc.get_paginator('describe_cache_clusters')
 
     elcs = call_and_retry(
@@ -599,13 +832,34 @@ def get_elasticache_nodes(region, acc):
     return nodes
 
 
+def get_dynamodb_table_descriptions(ddb, region, table_names):
+    """Return status, name and ARN of the tables in ``table_names``, cached per table depending on its status."""
+    now = time.time()
+
+    names = set(table_names)
+    for key in [k for k in DYNAMODB_TABLES_CACHE if k[0] == region and k[1] not in names]:
+        del DYNAMODB_TABLES_CACHE[key]
+
+    def describe_table(table_name):
+        t = call_and_retry(ddb.describe_table, TableName=table_name)['Table']
+        return {'TableStatus': t['TableStatus'], 'TableName': t['TableName'], 'TableArn': t['TableArn']}
+
+    missing = [tn for tn in table_names
+               if (region, tn) not in DYNAMODB_TABLES_CACHE or DYNAMODB_TABLES_CACHE[(region, tn)][0] < now]
+    for tn, t in zip(missing, parallel_map(describe_table, missing)):
+        ttl = DYNAMODB_TABLES_TTL if t['TableStatus'] == 'ACTIVE' else DYNAMODB_TABLES_TRANSITION_TTL
+        DYNAMODB_TABLES_CACHE[(region, tn)] = (now + ttl, t)
+
+    return [DYNAMODB_TABLES_CACHE[(region, tn)][1] for tn in table_names]
+
+
 @trace(tags={'aws': 'dynamodb'}, pass_span=True)
 def get_dynamodb_tables(region, acc, **kwargs):
     tables = []
 
     # catch exception here, original agent policy does not allow scanning dynamodb
     try:
-        ddb = boto3.client('dynamodb', region_name=region)
+        ddb = get_client('dynamodb', region)
 
         paginator = ddb.get_paginator('list_tables')
 
@@ -614,9 +868,7 @@ def get_dynamodb_tables(region, acc, **kwargs):
 
         tables = []
 
-        for tn in ts:
-            t = call_and_retry(ddb.describe_table, TableName=tn)['Table']
-
+        for t in get_dynamodb_table_descriptions(ddb, region, ts):
             if t['TableStatus'] not in ['ACTIVE', 'UPDATING']:
                 continue
 
@@ -651,7 +903,7 @@ def get_rds_instances(region, acc, existing_entities, **kwargs):
         return rds_entities
 
     try:
-        rds_client = boto3.client('rds', region_name=region)
+        rds_client = get_client('rds', region)
 
         paginator = rds_client.get_paginator('describe_db_instances')
 
@@ -695,17 +947,57 @@ def get_rds_instances(region, acc, existing_entities, **kwargs):
     return entities
 
 
+def get_acm_certificates(acm_client, region, arns):
+    """
+    Return the details of the ACM certificates in ``arns``, cached per certificate depending on status and expiration.
+
+    A certificate which can not be described keeps its cached details, or is left out if there are none.
+    """
+    now = time.time()
+
+    listed = set(arns)
+    for key in [k for k in ACM_CERTIFICATE_CACHE if k[0] == region and k[1] not in listed]:
+        del ACM_CERTIFICATE_CACHE[key]
+
+    def describe_certificate(arn):
+        try:
+            c = call_and_retry(acm_client.describe_certificate, CertificateArn=arn)['Certificate']
+            return {k: c[k] for k in ('DomainName', 'CertificateArn', 'Status', 'NotAfter', 'InUseBy') if k in c}
+        except Exception:
+            logger.exception('Failed to describe ACM certificate %s', arn)
+
+    missing = [arn for arn in arns
+               if (region, arn) not in ACM_CERTIFICATE_CACHE or ACM_CERTIFICATE_CACHE[(region, arn)][0] < now]
+    for arn, c in zip(missing, parallel_map(describe_certificate, missing)):
+        if c is None:
+            continue
+
+        ttl = ACM_CERTIFICATE_TTL
+        if c['Status'] != 'ISSUED' or (
+                'NotAfter' in c and c['NotAfter'].timestamp() - now < ACM_CERTIFICATE_RENEWAL_WINDOW):
+            ttl = ACM_CERTIFICATE_TRANSITION_TTL
+        ACM_CERTIFICATE_CACHE[(region, arn)] = (now + ttl, c)
+
+    return [ACM_CERTIFICATE_CACHE[(region, arn)][1] for arn in arns if (region, arn) in ACM_CERTIFICATE_CACHE]
+
+
 @trace(tags={'aws': 'acm'}, pass_span=True)
 def get_certificates(region, acc, **kwargs):
-    iam_client = boto3.client('iam', region_name=region)
-    acm_client = boto3.client('acm', region_name=region)
+    iam_client = get_client('iam', region)
+    acm_client = get_client('acm', region)
 
     entities = []
 
     try:
-        server_certs = iam_client.list_server_certificates()['ServerCertificateMetadataList']
+        iam_paginator = iam_client.get_paginator('list_server_certificates')
+        server_certs = call_and_retry(
+            lambda: iam_paginator.paginate(
+                PaginationConfig={'MaxItems': MAX_PAGE}).build_full_result()['ServerCertificateMetadataList'])
 
-        acm_certs = acm_client.list_certificates()['CertificateSummaryList']
+        acm_paginator = acm_client.get_paginator('list_certificates')
+        acm_certs = call_and_retry(
+            lambda: acm_paginator.paginate(
+                PaginationConfig={'MaxItems': MAX_PAGE}).build_full_result()['CertificateSummaryList'])
 
         for cert in server_certs:
             e = {
@@ -724,10 +1016,8 @@ def get_certificates(region, acc, **kwargs):
 
             entities.append(e)
 
-        for cert in acm_certs:
-            c = acm_client.describe_certificate(CertificateArn=cert['CertificateArn'])['Certificate']
-
-            cert_id = cert['CertificateArn'].split('/')[-1]
+        for c in get_acm_certificates(acm_client, region, [cert['CertificateArn'] for cert in acm_certs]):
+            cert_id = c['CertificateArn'].split('/')[-1]
             e = {
                 'id': entity_id('cert-acm-{}-{}[{}:{}]'.format(cert_id, c['DomainName'], acc, region)),
                 'type': 'certificate',
@@ -752,12 +1042,36 @@ def get_certificates(region, acc, **kwargs):
     return entities
 
 
+def get_account_metadata(key, ttl, load):
+    """Return the account metadata ``key``, calling ``load`` if it is not cached or older than ``ttl`` seconds."""
+    now = time.time()
+
+    with ACCOUNT_METADATA_LOCK:
+        if not ACCOUNT_METADATA_CACHE:
+            ACCOUNT_METADATA_CACHE.update(load_cache('account_metadata', {}))
+
+        if key in ACCOUNT_METADATA_CACHE and ACCOUNT_METADATA_CACHE[key][0] >= now:
+            return ACCOUNT_METADATA_CACHE[key][1]
+
+    value = load()
+
+    with ACCOUNT_METADATA_LOCK:
+        ACCOUNT_METADATA_CACHE[key] = (now + ttl, value)
+        if len(key) == 3:
+            save_cache('account_metadata', {k: v for k, v in ACCOUNT_METADATA_CACHE.items() if len(k) == 3})
+
+    return value
+
+
 @trace(tags={'aws': 'iam'}, pass_span=True)
 def get_account_alias(region, **kwargs):
     try:
-        iam_client = boto3.client('iam', region_name=region)
-        resp = iam_client.list_account_aliases()
-        return resp['AccountAliases'][0]
+        def load():
+            iam_client = get_client('iam', region)
+            resp = iam_client.list_account_aliases()
+            return resp['AccountAliases'][0]
+
+        return get_account_metadata((get_account_id(region), region, 'alias'), ACCOUNT_ALIAS_TTL, load)
     except Exception:
         current_span = extract_span_from_kwargs(**kwargs)
         current_span.set_tag('error', True)
@@ -765,12 +1079,14 @@ def get_account_alias(region, **kwargs):
         return None
 
 
-@trace(tags={'aws': 'iam'}, pass_span=True)
+@trace(tags={'aws': 'sts'}, pass_span=True)
 def get_account_id(region, **kwargs):
     try:
-        iam_client = boto3.client('iam', region_name=region)
-        role = iam_client.list_roles()['Roles'][0]
-        return role['Arn'].split(':')[4]
+        def load():
+            sts_client = get_client('sts', region)
+            return call_and_retry(sts_client.get_caller_identity)['Account']
+
+        return get_account_metadata((region, 'account_id'), ACCOUNT_ID_TTL, load)
     except Exception:
         current_span = extract_span_from_kwargs(**kwargs)
         current_span.set_tag('error', True)
@@ -810,58 +1126,77 @@ def get_limits(region, acc, apps, elbs, entities, **kwargs):
         'elb-used-count': len(elbs),
     })
 
-    ec2 = boto3.client('ec2', region_name=region)
-    rds = boto3.client('rds', region_name=region)
-    asg = boto3.client('autoscaling', region_name=region)
-    iam = boto3.client('iam', region_name=region)
+    ec2 = get_client('ec2', region)
+    rds = get_client('rds', region)
+    asg = get_client('autoscaling', region)
+    iam = get_client('iam', region)
 
-    try:
+    def load_ec2_limits():
+        result = {}
         attrs = ec2.describe_account_attributes()['AccountAttributes']
         for attr in attrs:
             if attr['AttributeName'] == 'max-instances':
-                limits['ec2-max-instances'] = int(attr['AttributeValues'][0]['AttributeValue'])
+                result['ec2-max-instances'] = int(attr['AttributeValues'][0]['AttributeValue'])
+        return result
+
+    try:
+        limits.update(get_account_metadata((acc, region, 'ec2-limits'), ACCOUNT_LIMITS_TTL, load_ec2_limits))
     except Exception:
         current_span.set_tag('error', True)
         current_span.log_kv({'exception': traceback.format_exc()})
         logger.exception('Failed to query EC2 account attributes!')
 
-    try:
+    def load_rds_limits():
         quota_names = ('ReservedDBInstances', 'AllocatedStorage')
         quotas = rds.describe_account_attributes()['AccountQuotas']
         q = {
             q['AccountQuotaName']: q for q in quotas if q['AccountQuotaName'] in quota_names
         }
-        limits['rds-max-reserved'] = q['ReservedDBInstances']['Max']
-        limits['rds-used-reserved'] = q['ReservedDBInstances']['Used']
-        limits['rds-max-allocated'] = q['AllocatedStorage']['Max']
-        limits['rds-used-allocated'] = q['AllocatedStorage']['Used']
+        return {
+            'rds-max-reserved': q['ReservedDBInstances']['Max'],
+            'rds-used-reserved': q['ReservedDBInstances']['Used'],
+            'rds-max-allocated': q['AllocatedStorage']['Max'],
+            'rds-used-allocated': q['AllocatedStorage']['Used'],
+        }
+
+    try:
+        limits.update(get_account_metadata((acc, region, 'rds-limits'), ACCOUNT_LIMITS_TTL, load_rds_limits))
     except Exception:
         current_span.set_tag('error', True)
         current_span.log_kv({'exception': traceback.format_exc()})
         logger.exception('Failed to query RDS account attributes!')
 
-    try:
+    def load_asg_limits():
         asg_limits = asg.describe_account_limits()
-        limits['asg-max-groups'] = asg_limits['MaxNumberOfAutoScalingGroups']
-        limits['asg-max-launch-configurations'] = asg_limits['MaxNumberOfLaunchConfigurations']
-        limits['asg-used-groups'] = asg_limits['NumberOfAutoScalingGroups']
-        limits['asg-used-launch-configurations'] = asg_limits['NumberOfLaunchConfigurations']
+        return {
+            'asg-max-groups': asg_limits['MaxNumberOfAutoScalingGroups'],
+            'asg-max-launch-configurations': asg_limits['MaxNumberOfLaunchConfigurations'],
+            'asg-used-groups': asg_limits['NumberOfAutoScalingGroups'],
+            'asg-used-launch-configurations': asg_limits['NumberOfLaunchConfigurations'],
+        }
+
+    try:
+        limits.update(get_account_metadata((acc, region, 'asg-limits'), ACCOUNT_LIMITS_TTL, load_asg_limits))
     except Exception:
         current_span.set_tag('error', True)
         current_span.log_kv({'exception': traceback.format_exc()})
         logger.exception('Failed to query ASG limits!')
 
-    try:
+    def load_iam_limits():
         iam_limits = iam.get_account_summary()['SummaryMap']
-        limits['iam-used-server-certificates'] = iam_limits['ServerCertificates']
-        limits['iam-max-server-certificates'] = iam_limits['ServerCertificatesQuota']
+        return {
+            'iam-used-server-certificates': iam_limits['ServerCertificates'],
+            'iam-max-server-certificates': iam_limits['ServerCertificatesQuota'],
 
-        limits['iam-used-instance-profiles'] = iam_limits['InstanceProfiles']
-        limits['iam-max-instance-profiles'] = iam_limits['InstanceProfilesQuota']
+            'iam-used-instance-profiles': iam_limits['InstanceProfiles'],
+            'iam-max-instance-profiles': iam_limits['InstanceProfilesQuota'],
 
-        limits['iam-used-policies'] = iam_limits['Policies']
-        limits['iam-max-policies'] = iam_limits['PoliciesQuota']
+            'iam-used-policies': iam_limits['Policies'],
+            'iam-max-policies': iam_limits['PoliciesQuota'],
+        }
 
+    try:
+        limits.update(get_account_metadata((acc, region, 'iam-limits'), ACCOUNT_LIMITS_TTL, load_iam_limits))
     except Exception:
         current_span.set_tag('error', True)
         current_span.log_kv({'exception': traceback.format_exc()})
@@ -880,6 +1215,69 @@ def get_limits(region, acc, apps, elbs, entities, **kwargs):
     return entity
 
 
+def get_sqs_queue(sqs_client, queue_url, region, acc):
+    attributes_response = call_and_retry(sqs_client.get_queue_attributes, QueueUrl=queue_url,
+                                         AttributeNames=SQS_QUEUE_ATTRIBUTES)
+    attributes = attributes_response['Attributes']
+    queue_arn = attributes['QueueArn']
+    arn_tokens = queue_arn.split(':')
+    if len(arn_tokens) == 6:
+        queue_name = arn_tokens[-1]
+    else:
+        logger.error('Illegal SQS queue ARN: "%s" while processing url %s', queue_arn, queue_url)
+        return None
+
+    sqs_entity = {
+        'id': entity_id('sqs-{}[{}:{}]'.format(queue_name, acc, region)),
+        'created_by': 'agent',
+        'infrastructure_account': acc,
+        'region': region,
+        'type': 'aws_sqs',
+        'name': queue_name,
+        'url': queue_url,
+        'arn': queue_arn,
+        'message_retention_period_seconds': int(attributes.get('MessageRetentionPeriod', 345600)),
+        'maximum_message_size_bytes': int(attributes.get('MaximumMessageSize', 262144)),
+        'receive_messages_wait_time_seconds': int(attributes.get('ReceiveMessageWaitTimeSeconds', 0)),
+        'delay_seconds': int(attributes.get('DelaySeconds', 0)),
+        'visibility_timeout_seconds': int(attributes.get('VisibilityTimeout', 30))}
+
+    redrive_policy = json.loads(attributes.get('RedrivePolicy', '{}'))
+    dead_letter_target_arn = redrive_policy.get('deadLetterTargetArn', None)
+    if dead_letter_target_arn:
+        sqs_entity['redrive_policy_dead_letter_target_arn'] = dead_letter_target_arn
+    max_receive_count = redrive_policy.get('maxReceiveCount', None)
+    if max_receive_count:
+        sqs_entity['redrive_policy_max_receive_count'] = max_receive_count
+
+    if SQS_DEAD_LETTER_SOURCE_LOOKUP:
+        dl_sources_response = call_and_retry(sqs_client.list_dead_letter_source_queues, QueueUrl=queue_url)
+        dead_letter_source_urls = dl_sources_response.get('queueUrls', None)
+        if dead_letter_source_urls:
+            sqs_entity['redrive_policy_dead_letter_source_urls'] = dead_letter_source_urls
+
+    return sqs_entity
+
+
+def add_dead_letter_sources(sqs_queues):
+    """Set the dead letter source urls of every queue from the redrive policies of the other queues."""
+    sources = {}
+    for queue in sqs_queues:
+        target_arn = queue.get('redrive_policy_dead_letter_target_arn')
+        if target_arn:
+            sources.setdefault(target_arn, []).append(queue['url'])
+
+    result = []
+    for queue in sqs_queues:
+        queue = dict(queue)
+        queue.pop('redrive_policy_dead_letter_source_urls', None)
+        if queue['arn'] in sources:
+            queue['redrive_policy_dead_letter_source_urls'] = sources[queue['arn']]
+        result.append(queue)
+
+    return result
+
+
 @trace(tags={'aws': 'sqs'}, pass_span=True)
 def get_sqs_queues(region, acc, all_entities=None, **kwargs):
     current_span = extract_span_from_kwargs(**kwargs)
@@ -888,59 +1286,28 @@ def get_sqs_queues(region, acc, all_entities=None, **kwargs):
     sqs_queues = []
 
     try:
-        sqs_client = boto3.client('sqs', region_name=region)
-        list_queues_response = call_and_retry(sqs_client.list_queues) or {}
+        sqs_client = get_client('sqs', region)
+        paginator = sqs_client.get_paginator('list_queues')
+        queue_urls = call_and_retry(
+            lambda: paginator.paginate(
+                PaginationConfig={'MaxItems': MAX_PAGE}).build_full_result().get('QueueUrls', []))
         existing_entities = {e['url']: e for e in all_entities if e['type'] == 'aws_sqs'}
-        for queue_url in list_queues_response.get('QueueUrls', []):
+
+        def get_queue(queue_url):
             try:
                 existing_entity = existing_entities.get(queue_url, None)
                 if existing_entity and (datetime.now().minute % 15):
-                    sqs_queues.append(existing_entity)
-                else:
-                    attributes_response = call_and_retry(sqs_client.get_queue_attributes, QueueUrl=queue_url,
-                                                         AttributeNames=['All'])
-                    attributes = attributes_response['Attributes']
-                    queue_arn = attributes['QueueArn']
-                    arn_tokens = queue_arn.split(':')
-                    if len(arn_tokens) == 6:
-                        queue_name = arn_tokens[-1]
-                    else:
-                        logger.error('Illegal SQS queue ARN: "%s" while processing url %s', queue_arn, queue_url)
-                        continue
-
-                    sqs_entity = {
-                        'id': entity_id('sqs-{}[{}:{}]'.format(queue_name, acc, region)),
-                        'created_by': 'agent',
-                        'infrastructure_account': acc,
-                        'region': region,
-                        'type': 'aws_sqs',
-                        'name': queue_name,
-                        'url': queue_url,
-                        'arn': queue_arn,
-                        'message_retention_period_seconds': int(attributes.get('MessageRetentionPeriod', 345600)),
-                        'maximum_message_size_bytes': int(attributes.get('MaximumMessageSize', 262144)),
-                        'receive_messages_wait_time_seconds': int(attributes.get('ReceiveMessageWaitTimeSeconds', 0)),
-                        'delay_seconds': int(attributes.get('DelaySeconds', 0)),
-                        'visibility_timeout_seconds': int(attributes.get('VisibilityTimeout', 30))}
-
-                    redrive_policy = json.loads(attributes.get('RedrivePolicy', '{}'))
-                    dead_letter_target_arn = redrive_policy.get('deadLetterTargetArn', None)
-                    if dead_letter_target_arn:
-                        sqs_entity['redrive_policy_dead_letter_target_arn'] = dead_letter_target_arn
-                    max_receive_count = redrive_policy.get('maxReceiveCount', None)
-                    if max_receive_count:
-                        sqs_entity['redrive_policy_max_receive_count'] = max_receive_count
-
-                    dl_sources_response = call_and_retry(sqs_client.list_dead_letter_source_queues, QueueUrl=queue_url)
-                    dead_letter_source_urls = dl_sources_response.get('queueUrls', None)
-                    if dead_letter_source_urls:
-                        sqs_entity['redrive_policy_dead_letter_source_urls'] = dead_letter_source_urls
-
-                    sqs_queues.append(sqs_entity)
+                    return existing_entity
+
+                return get_sqs_queue(sqs_client, queue_url, region, acc)
             except Exception:
                 current_span.set_tag('error', True)
                 current_span.log_kv({'exception': traceback.format_exc()})
                 logger.exception('Failed to obtain details about queue with url="%s"', queue_url)
+
+        sqs_queues = [q for q in parallel_map(get_queue, queue_urls, max_workers=SQS_MAX_WORKERS) if q is not None]
+        if not SQS_DEAD_LETTER_SOURCE_LOOKUP:
+            sqs_queues = add_dead_letter_sources(sqs_queues)
     except Exception as e:
         if isinstance(e, ClientError) and e.response['Error']['Code'] == 'AccessDenied':
             logger.warning('Access to AWS SQS denied. Skip queue discovery.')
@@ -1,9 +1,18 @@
+import os
 import time
+import pickle
+import stat
 import logging
+import threading
 
+import boto3
 import opentracing
 
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from opentracing_utils.span import inspect_span_from_stack
 
 from zmon_aws_agent import __version__
 
@@ -11,6 +20,22 @@ from zmon_aws_agent import __version__
 MAX_RETRIES = 10
 TIME_OUT = 0.5
 
+MAX_PAGE = 10000
+
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AGENT_AWS_MAX_POOL_CONNECTIONS', 20))
+AWS_TCP_KEEPALIVE = os.environ.get('AGENT_AWS_TCP_KEEPALIVE', 'true').lower() == 'true'
+
+# maximum number of concurrent API calls issued by a single collector
+MAX_WORKERS = int(os.environ.get('AGENT_MAX_WORKERS', 10))
+
+# directory used to persist caches across restarts, persistence is disabled if not set
+# caches are pickled, so the directory must only be writable by the agent's user
+CACHE_DIR = os.environ.get('AGENT_CACHE_DIR')
+
+# boto3 clients shared by all collectors, keyed by (service, region)
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,6 +43,39 @@ def get_user_agent():
     return 'zmon-aws-agent/{}'.format(__version__)
 
 
+def get_client_config():
+    options = {'max_pool_connections': AWS_MAX_POOL_CONNECTIONS}
+    if AWS_TCP_KEEPALIVE:
+        options['tcp_keepalive'] = True
+
+    try:
+        return Config(**options)
+    except TypeError:
+        # botocore releases before 1.27 do not support TCP keep-alive
+        options.pop('tcp_keepalive', None)
+        return Config(**options)
+
+
+def get_client(service, region=None):
+    """
+    Return a boto3 client for ``service`` in ``region``.
+
+    Clients are created once from the default boto3 session and then reused, so their service models are loaded only
+    once and their connection pools stay warm. boto3 clients are thread safe, but creating them is not.
+    """
+    key = (service, region)
+
+    client = CLIENTS.get(key)
+    if client is None:
+        with CLIENTS_LOCK:
+            client = CLIENTS.get(key)
+            if client is None:
+                client = boto3.client(service, region_name=region, config=get_client_config())
+                CLIENTS[key] = client
+
+    return client
+
+
 def get_sleep_duration(retries):
     return 2 ** retries * TIME_OUT
 
@@ -40,6 +98,91 @@ def call_and_retry(fn, *args, **kwargs):
             raise
 
 
+def _call_in_span(fn, item, parent_span):
+    # ``parent_span`` is kept as a local, so traced functions running in the worker thread find it while inspecting
+    # the call stack.
+    return fn(item)
+
+
+def parallel_map(fn, items, max_workers=MAX_WORKERS, timeout=None, default=None):
+    """
+    Call ``fn`` for every item on a bounded thread pool and return the results in the order of ``items``.
+
+    The first exception raised by ``fn`` is re-raised, calls which did not start yet are cancelled. With a
+    ``timeout``, calls which did not finish within ``timeout`` seconds yield ``default`` instead of a result.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    parent_span = inspect_span_from_stack()
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(items)))
+    futures = [executor.submit(_call_in_span, fn, item, parent_span) for item in items]
+    try:
+        if timeout is not None:
+            done, _ = wait(futures, timeout=timeout)
+            return [f.result() if f in done else default for f in futures]
+
+        return [f.result() for f in futures]
+    finally:
+        for f in futures:
+            f.cancel()
+        executor.shutdown(wait=False)
+
+
+def get_cache_path(name):
+    return os.path.join(CACHE_DIR, '{}.pickle'.format(name))
+
+
+def is_cache_file_private(path):
+    """Return whether ``path`` and its directory are owned by the current user and not writable by anyone else."""
+    for p in (path, os.path.dirname(path)):
+        st = os.stat(p)
+        if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return False
+    return True
+
+
+def load_cache(name, default=None):
+    """
+    Return the cache persisted as ``name``, or ``default`` if persistence is disabled or nothing can be loaded.
+
+    Unpickling runs arbitrary code, so caches which could have been written by another user are not loaded.
+    """
+    if not CACHE_DIR:
+        return default
+
+    path = get_cache_path(name)
+    try:
+        if not is_cache_file_private(path):
+            logger.error('Cache {} in {} is writable by other users, ignoring it'.format(name, CACHE_DIR))
+            return default
+
+        with open(path, 'rb') as fd:
+            return pickle.load(fd)
+    except FileNotFoundError:
+        return default
+    except Exception:
+        logger.exception('Failed to load cache {} from {}'.format(name, CACHE_DIR))
+        return default
+
+
+def save_cache(name, data):
+    """Persist ``data`` as cache ``name``, if persistence is enabled via ``AGENT_CACHE_DIR``."""
+    if not CACHE_DIR:
+        return
+
+    path = get_cache_path(name)
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        with open(os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as fd:
+            pickle.dump(data, fd)
+        os.replace(path + '.tmp', path)
+    except Exception:
+        logger.exception('Failed to save cache {} to {}'.format(name, CACHE_DIR))
+
+
 def clean_opentracing_span(**kwargs):
     span_k = None
     for k, v in kwargs.items():
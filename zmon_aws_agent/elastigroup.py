@@ -1,14 +1,18 @@
+import json
 import logging
+import os
+import threading
+import time
 import traceback
 
-import boto3
 import inflection
+import requests
 from botocore.exceptions import ClientError
 from opentracing_utils import extract_span_from_kwargs, trace
 from spotinst_sdk import SpotinstClient
 
 from zmon_aws_agent.aws import entity_id, add_traffic_tags_to_entity, MAX_PAGE
-from zmon_aws_agent.common import call_and_retry
+from zmon_aws_agent.common import call_and_retry, get_client, get_sleep_duration, parallel_map
 
 ELASTIGROUP_RESOURCE_TYPE = 'Custom::elastigroup'
 STACK_STATUS_FILTER = [
@@ -23,6 +27,21 @@ STACK_STATUS_FILTER = [
     "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS",
     "UPDATE_ROLLBACK_COMPLETE"
 ]
+
+# Elastigroups defined in CloudFormation stacks: stack ID -> (last update of the stack, [Elastigroup])
+STACK_ELASTIGROUPS_CACHE = {}
+
+SPOTINST_MAX_WORKERS = int(os.environ.get('AGENT_SPOTINST_MAX_WORKERS', 5))
+SPOTINST_MAX_RETRIES = int(os.environ.get('AGENT_SPOTINST_MAX_RETRIES', 5))
+SPOTINST_TIMEOUT = int(os.environ.get('AGENT_SPOTINST_TIMEOUT', 10))
+
+# list all groups of a Spotinst account at once instead of fetching every group on its own
+ELASTIGROUP_ACCOUNT_LISTING = os.environ.get('AGENT_ELASTIGROUP_ACCOUNT_LISTING', 'false').lower() == 'true'
+
+# Spotinst clients shared by all groups, keyed by (account ID, access token)
+SPOTINST_CLIENTS = {}
+SPOTINST_CLIENTS_LOCK = threading.Lock()
+
 logger = logging.getLogger(__name__)
 
 
@@ -45,6 +64,53 @@ class Elastigroup:
         return False
 
 
+class PooledSpotinstClient(SpotinstClient):
+    """
+    SpotinstClient reusing one HTTP session for all its requests and retrying rate limited ones.
+    """
+
+    def __init__(self, auth_token, account_id):
+        super().__init__(auth_token=auth_token, account_id=account_id, print_output=False)
+        self.session = requests.Session()
+
+    def send_get(self, url, entity_name, query_params=None):
+        query_params = query_params or self.build_query_params()
+        headers = {
+            'User-Agent': self.resolve_user_agent(),
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer ' + self.auth_token
+        }
+
+        count = 0
+        while True:
+            result = self.session.get(url, params=query_params, headers=headers, timeout=SPOTINST_TIMEOUT)
+            if result.status_code != requests.codes.too_many_requests or count >= SPOTINST_MAX_RETRIES:
+                break
+
+            logger.info('Throttling Spotinst API requests...')
+            time.sleep(get_sleep_duration(count))
+            count += 1
+
+        if result.status_code == requests.codes.ok:
+            return json.loads(result.content.decode('utf-8'))
+
+        self.handle_exception('getting {}'.format(entity_name), result)
+
+    def close(self):
+        self.session.close()
+
+
+def get_spotinst_client(account_id, access_token):
+    key = (account_id, access_token)
+
+    if key not in SPOTINST_CLIENTS:
+        with SPOTINST_CLIENTS_LOCK:
+            if key not in SPOTINST_CLIENTS:
+                SPOTINST_CLIENTS[key] = PooledSpotinstClient(auth_token=access_token, account_id=account_id)
+
+    return SPOTINST_CLIENTS[key]
+
+
 @trace(tags={'aws': 'elastigroup'}, pass_span=True)
 def get_elastigroup_entities(region, acc, **kwargs):
     groups = []
@@ -52,50 +118,68 @@ def get_elastigroup_entities(region, acc, **kwargs):
     current_span.set_tag("aws_region", region)
     current_span.set_tag("account_id", acc)
     try:
-        cf = boto3.client('cloudformation', region_name=region)
-
-        stack_names = get_all_stack_names(cf)
-        for stack_name in stack_names:
-            elastigroups = get_elastigroup_resources(cf, stack_name)
-            for eg_data in elastigroups:
-                eg_details = get_elastigroup(eg_data, **kwargs)
-                eg_name = eg_details.get('name', eg_details.get('id', 'unknown-elastigroup'))
-                capacity = eg_details.get('capacity', {})
-                strategy = eg_details.get('strategy', {})
-                compute = eg_details.get('compute', {})
-                eg = {
-                    'id': entity_id('elastigroup-{}[{}:{}]'.format(eg_name, acc, region)),
-                    'type': 'elastigroup',
-                    'infrastructure_account': acc,
-                    'region': region,
-                    'created_by': 'agent',
-                    'name': eg_name,
-                    'availability_zones': [az.get('name', 'unknown-az') for az in
-                                           eg_details.get('compute', {}).get('availability_zones', [])],
-                    'desired_capacity': capacity.get('target', 1),
-                    'max_size': capacity.get('maximum', 1),
-                    'min_size': capacity.get('minimum', 1),
-                    'cloud_account_id': eg_data.account_id,
-                    'elastigroup_id': eg_data.group_id,
-                    'risk': strategy.get('risk', 100),
-                    'orientation': strategy.get('availability_vs_cost', 'balanced'),
-                    'instance_types': compute.get('instance_types', None),
-                    'created_time': eg_details.get('created_at', None),
-                }
-
-                for tag in compute.get('launch_specification', {}).get('tags', []):
-                    key = inflection.underscore(tag.get('tag_key', None))
-                    val = tag.get('tag_value', None)
-                    if key and val and key not in eg:
-                        eg[key] = val
-                add_traffic_tags_to_entity(eg)
-
-                eg['instances'] = []
-                instances = get_elastigroup_instances(eg_data)
-                for instance in instances:
-                    eg['instances'].append(extract_instance_details(instance))
-
-                groups.append(eg)
+        cf = get_client('cloudformation', region)
+
+        elastigroups = get_all_elastigroup_resources(cf)
+
+        accounts = sorted({(eg_data.account_id, eg_data.access_token) for eg_data in elastigroups})
+
+        listed = {}
+        if ELASTIGROUP_ACCOUNT_LISTING:
+            for account_groups in parallel_map(lambda account: get_account_elastigroups(*account), accounts,
+                                               max_workers=SPOTINST_MAX_WORKERS):
+                listed.update(account_groups)
+
+        def fetch(eg_data):
+            # groups missing in the account listing are fetched on their own
+            eg_details = listed.get((eg_data.account_id, eg_data.group_id)) or get_elastigroup(eg_data)
+            return eg_details, get_elastigroup_instances(eg_data)
+
+        # details and instances of the groups are fetched concurrently from the Spotinst API
+        details = parallel_map(fetch, elastigroups, max_workers=SPOTINST_MAX_WORKERS)
+
+        # drop clients of accounts or tokens which are not used any more
+        with SPOTINST_CLIENTS_LOCK:
+            for key in set(SPOTINST_CLIENTS.keys()) - set(accounts):
+                SPOTINST_CLIENTS.pop(key).close()
+
+        for eg_data, (eg_details, instances) in zip(elastigroups, details):
+            eg_name = eg_details.get('name', eg_details.get('id', 'unknown-elastigroup'))
+            capacity = eg_details.get('capacity', {})
+            strategy = eg_details.get('strategy', {})
+            compute = eg_details.get('compute', {})
+            eg = {
+                'id': entity_id('elastigroup-{}[{}:{}]'.format(eg_name, acc, region)),
+                'type': 'elastigroup',
+                'infrastructure_account': acc,
+                'region': region,
+                'created_by': 'agent',
+                'name': eg_name,
+                'availability_zones': [az.get('name', 'unknown-az') for az in
+                                       eg_details.get('compute', {}).get('availability_zones', [])],
+                'desired_capacity': capacity.get('target', 1),
+                'max_size': capacity.get('maximum', 1),
+                'min_size': capacity.get('minimum', 1),
+                'cloud_account_id': eg_data.account_id,
+                'elastigroup_id': eg_data.group_id,
+                'risk': strategy.get('risk', 100),
+                'orientation': strategy.get('availability_vs_cost', 'balanced'),
+                'instance_types': compute.get('instance_types', None),
+                'created_time': eg_details.get('created_at', None),
+            }
+
+            for tag in compute.get('launch_specification', {}).get('tags', []):
+                key = inflection.underscore(tag.get('tag_key', None))
+                val = tag.get('tag_value', None)
+                if key and val and key not in eg:
+                    eg[key] = val
+            add_traffic_tags_to_entity(eg)
+
+            eg['instances'] = []
+            for instance in instances:
+                eg['instances'].append(extract_instance_details(instance))
+
+            groups.append(eg)
     except Exception as e:
         current_span.set_tag('error', True)
         current_span.log_kv({'exception': traceback.format_exc()})
@@ -136,19 +220,16 @@ def get_elastigroup_resources(cf, stack_name, **kwargs):
             lambda:
             paginator.paginate(PaginationConfig={'MaxItems': MAX_PAGE}, StackName=stack_name).build_full_result()[
                 'StackResourceSummaries'])
-        for resource in resources:
-            elastigroups = []
-            if resource['ResourceType'] == ELASTIGROUP_RESOURCE_TYPE:
-                elastigroups.append(resource)
-
-            if elastigroups:
-                resources = cf.get_template(StackName=stack_name)['TemplateBody']['Resources']
-                for elastigroup in elastigroups:
-                    group_id = elastigroup["PhysicalResourceId"]
-                    group_name = elastigroup["LogicalResourceId"]
-                    spotinst_token = resources[group_name]['Properties']['accessToken']
-                    spotinst_account_id = resources[group_name]['Properties']['accountId']
-                    groups.append(Elastigroup(group_id, group_name, spotinst_account_id, spotinst_token))
+        elastigroups = [resource for resource in resources if resource['ResourceType'] == ELASTIGROUP_RESOURCE_TYPE]
+
+        if elastigroups:
+            resources = call_and_retry(cf.get_template, StackName=stack_name)['TemplateBody']['Resources']
+            for elastigroup in elastigroups:
+                group_id = elastigroup["PhysicalResourceId"]
+                group_name = elastigroup["LogicalResourceId"]
+                spotinst_token = resources[group_name]['Properties']['accessToken']
+                spotinst_account_id = resources[group_name]['Properties']['accountId']
+                groups.append(Elastigroup(group_id, group_name, spotinst_account_id, spotinst_token))
     except Exception as e:
         if isinstance(e, ClientError) and e.response['Error']['Code'] == 'AccessDenied':
             msg = 'Access to AWS API denied. You may need the cloudformation:ListStackResources and ' \
@@ -160,12 +241,47 @@ def get_elastigroup_resources(cf, stack_name, **kwargs):
             current_span.set_tag('error', True)
             current_span.log_kv({'exception': traceback.format_exc()})
             logger.exception('Failed to retrieve Elastigroup resources from Stack "{}"'.format(stack_name))
+        return None
 
     return groups
 
 
 @trace(pass_span=True)
-def get_all_stack_names(cf, **kwargs):
+def get_all_elastigroup_resources(cf, **kwargs):
+    """
+    Returns the Elastigroups of all stacks.
+
+    The resources and templates of a stack are only read again after the stack was updated, so stacks without
+    Elastigroups are skipped until they change.
+    """
+    current_span = extract_span_from_kwargs(**kwargs)
+
+    stacks = get_all_stacks(cf)
+    if stacks is None:
+        return []
+
+    for stack_id in set(STACK_ELASTIGROUPS_CACHE.keys()) - {stack['StackId'] for stack in stacks}:
+        del STACK_ELASTIGROUPS_CACHE[stack_id]
+
+    changed = [stack for stack in stacks if STACK_ELASTIGROUPS_CACHE.get(stack['StackId'], (None,))[0] !=
+               stack.get('LastUpdatedTime', stack.get('CreationTime'))]
+    current_span.log_kv({'num_changed_stacks': len(changed)})
+
+    changed_groups = parallel_map(lambda stack: get_elastigroup_resources(cf, stack['StackName']), changed)
+    for stack, groups in zip(changed, changed_groups):
+        # failed stacks are not cached and read again in the next run
+        if groups is not None:
+            STACK_ELASTIGROUPS_CACHE[stack['StackId']] = (stack.get('LastUpdatedTime', stack.get('CreationTime')),
+                                                          groups)
+
+    return [group for stack in stacks for group in STACK_ELASTIGROUPS_CACHE.get(stack['StackId'], (None, []))[1]]
+
+
+@trace(pass_span=True)
+def get_all_stacks(cf, **kwargs):
+    """
+    Returns the summaries of all active stacks, or None if they can not be listed.
+    """
     stacks = []
     current_span = extract_span_from_kwargs(**kwargs)
     paginator = cf.get_paginator('list_stacks')
@@ -174,9 +290,7 @@ def get_all_stack_names(cf, **kwargs):
         response_iterator = call_and_retry(
             lambda: paginator.paginate(StackStatusFilter=STACK_STATUS_FILTER))
         for page in response_iterator:
-            summaries = page['StackSummaries']
-            for summary in summaries:
-                stacks.append(summary['StackName'])
+            stacks.extend(page['StackSummaries'])
         current_span.log_kv({"num_stacks": len(stacks)})
     except Exception as e:
         if isinstance(e, ClientError) and e.response['Error']['Code'] == 'AccessDenied':
@@ -188,6 +302,7 @@ def get_all_stack_names(cf, **kwargs):
             current_span.set_tag('error', True)
             current_span.log_kv({'exception': traceback.format_exc()})
             logger.exception('Failed to retrieve stack names')
+        return None
 
     return stacks
 
@@ -203,8 +318,7 @@ def get_elastigroup(elastigroup_data, **kwargs):
     current_span.set_tag("elastigroup_name", elastigroup_data.group_name)
     current_span.set_tag("span.kind", "client")
 
-    client = SpotinstClient(auth_token=elastigroup_data.access_token, account_id=elastigroup_data.account_id,
-                            print_output=False)
+    client = get_spotinst_client(elastigroup_data.account_id, elastigroup_data.access_token)
 
     try:
         return client.get_elastigroup(elastigroup_data.group_id)
@@ -216,6 +330,25 @@ def get_elastigroup(elastigroup_data, **kwargs):
                                                                                 elastigroup_data.account_id))
 
 
+@trace(pass_span=True)
+def get_account_elastigroups(account_id, access_token, **kwargs):
+    """
+    Returns all Elastigroups of a Spotinst account, keyed by (account ID, group ID).
+    """
+    current_span = extract_span_from_kwargs(**kwargs)
+    current_span.set_tag("cloud_account_id", account_id)
+    current_span.set_tag("span.kind", "client")
+
+    client = get_spotinst_client(account_id, access_token)
+    try:
+        return {(account_id, group['id']): group for group in client.get_elastigroups()}
+    except Exception:
+        current_span.set_tag('error', True)
+        current_span.log_kv({'exception': traceback.format_exc()})
+        logger.exception('Failed to list elastigroups in account {}'.format(account_id))
+        return {}
+
+
 @trace(pass_span=True)
 def get_elastigroup_instances(elastigroup_data, **kwargs):
     """
@@ -227,8 +360,7 @@ def get_elastigroup_instances(elastigroup_data, **kwargs):
     current_span.set_tag("elastigroup_name", elastigroup_data.group_name)
     current_span.set_tag("span.kind", "client")
 
-    client = SpotinstClient(auth_token=elastigroup_data.access_token, account_id=elastigroup_data.account_id,
-                            print_output=False)
+    client = get_spotinst_client(elastigroup_data.account_id, elastigroup_data.access_token)
     try:
         return client.get_elastigroup_active_instances(elastigroup_data.group_id)
     except Exception:
@@ -0,0 +1,92 @@
+import threading
+
+from zmon_aws_agent.common import call_and_retry, get_client, MAX_PAGE
+
+
+def index_by(items, key):
+    """Index ``items`` by the value of ``key``, keeping the first item per value and skipping items without it."""
+    index = {}
+    for item in items:
+        if item.get(key):
+            index.setdefault(item[key], item)
+    return index
+
+
+class RegionInventory:
+    """
+    Raw AWS data of a region, shared by all collectors of a discovery cycle.
+
+    Every dataset is loaded on first access and only once, also when several collectors ask for it concurrently.
+    A failed load is not remembered, so the next collector asking for the dataset tries again.
+    """
+
+    def __init__(self, region):
+        self.region = region
+        self._data = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, load):
+        if name not in self._data:
+            with self._lock:
+                lock = self._locks.setdefault(name, threading.Lock())
+
+            with lock:
+                if name not in self._data:
+                    self._data[name] = load()
+
+        return self._data[name]
+
+    @property
+    def reservations(self):
+        def load():
+            ec2 = get_client('ec2', self.region)
+            paginator = ec2.get_paginator('describe_instances')
+            return call_and_retry(
+                lambda: paginator.paginate(
+                    PaginationConfig={'MaxItems': MAX_PAGE}).build_full_result()['Reservations'])
+
+        return self._get('reservations', load)
+
+    @property
+    def instances_by_id(self):
+        return self._get('instances_by_id',
+                         lambda: index_by([i for r in self.reservations for i in r['Instances']], 'InstanceId'))
+
+    @property
+    def addresses(self):
+        def load():
+            ec2 = get_client('ec2', self.region)
+            return call_and_retry(ec2.describe_addresses)['Addresses']
+
+        return self._get('addresses', load)
+
+    @property
+    def auto_scaling_groups(self):
+        def load():
+            asg = get_client('autoscaling', self.region)
+            paginator = asg.get_paginator('describe_auto_scaling_groups')
+            return call_and_retry(
+                lambda: paginator.paginate(
+                    PaginationConfig={'MaxItems': MAX_PAGE}).build_full_result()['AutoScalingGroups'])
+
+        return self._get('auto_scaling_groups', load)
+
+    @property
+    def asgs_by_name(self):
+        return self._get('asgs_by_name', lambda: index_by(self.auto_scaling_groups, 'AutoScalingGroupName'))
+
+    @property
+    def hosted_zones(self):
+        def load():
+            route53 = get_client('route53')
+            result = call_and_retry(route53.list_hosted_zones)
+            zones = result['HostedZones']
+
+            while result.get('IsTruncated', False):
+                result = call_and_retry(route53.list_hosted_zones, Marker=result['NextMarker'])
+                zones.extend(result['HostedZones'])
+
+            return zones
+
+        return self._get('hosted_zones', load)
@@ -15,14 +15,19 @@ import opentracing
 import requests
 import tokens
 import os
+import time
 import traceback
 
+from concurrent.futures import wait
+
 from zmon_cli.client import Zmon, compare_entities
 
 import zmon_aws_agent.aws as aws
 import zmon_aws_agent.postgresql as postgresql
 
 from zmon_aws_agent.common import get_user_agent
+from zmon_aws_agent.inventory import RegionInventory
+from zmon_aws_agent.scheduler import Task, TasksTimeout, run_tasks, COLLECTOR_WORKERS
 
 
 logging.getLogger('urllib3.connectionpool').setLevel(logging.WARN)
@@ -125,28 +130,51 @@ def update_local_entity(zmon_client, entity, **kwargs):
         logger.exception('Failed to add Local entity: {}'.format(entity))
 
 
-def main():
-    argp = argparse.ArgumentParser(description='ZMON AWS Agent')
-    argp.add_argument('-e', '--entity-service', dest='entityservice')
-    argp.add_argument('-r', '--region', dest='region', default=None)
-    argp.add_argument('-j', '--json', dest='json', action='store_true')
-    argp.add_argument('-t', '--tracer', dest='tracer', default=os.environ.get('OPENTRACING_TRACER', 'noop'))
-    argp.add_argument('-T', '--timeout', dest='timeout', default=15, type=int)  # default in zmon is 10 sec
-    argp.add_argument('--no-oauth2', dest='disable_oauth2', action='store_true', default=False)
-    argp.add_argument('--postgresql-user', dest='postgresql_user', default=os.environ.get('AGENT_POSTGRESQL_USER'))
-    argp.add_argument('--postgresql-pass', dest='postgresql_pass', default=os.environ.get('AGENT_POSTGRESQL_PASS'))
-    args = argp.parse_args()
-
-    if not args.disable_oauth2:
-        tokens.configure()
-        tokens.manage('uid', ['uid'])
-        tokens.start()
-
-    init_opentracing_tracer(args.tracer)
+@trace(pass_span=True)
+def get_region(**kwargs):
+    """Return the region of the instance the agent is running on, as reported by the instance meta-data."""
+    current_span = extract_span_from_kwargs(**kwargs)
+    logger.info('Trying to figure out region..')
+    try:
+        response = requests.get('http://169.254.169.254/latest/meta-data/placement/availability-zone', timeout=2)
+    except Exception:
+        current_span.set_tag('error', True)
+        current_span.log_kv({'exception': traceback.format_exc()})
+        logger.exception('Region was not specified as a parameter and' +
+                         'can not be fetched from instance meta-data!')
+        raise
+    return response.text[:-1]
+
+
+def speculative(fn):
+    """
+    Wrap a collector whose result is only used if the region has running apps. The collector starts before that is
+    known, so its failure is returned as the result instead of aborting the cycle, and dependent collectors pass it on.
+    """
+    def run(results):
+        for result in results.values():
+            if isinstance(result, Exception):
+                return result
+        try:
+            return fn(results)
+        except Exception as e:
+            return e
+    return run
+
+
+def get_result(results, name, default=None):
+    """Return the result of a speculative collector, raising its failure now that the result is used."""
+    result = results.get(name, default)
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def discover(args, region, deadline=None):
+    """Run a single discovery cycle. Collection is aborted once ``deadline`` (epoch seconds) is reached."""
     root_span = opentracing.tracer.start_span(operation_name='aws_entity_discovery')
     with root_span:
 
-        logging.basicConfig(level=logging.INFO)
         # 0. Fetch extra data for entities
         entity_extras = {}
         for ex in os.getenv('EXTRA_ENTITY_FIELDS', '').split(','):
@@ -156,36 +184,16 @@ def main():
             if k and v:
                 entity_extras[k] = v
 
-        # 1. Determine region
-        if not args.region:
-            logger.info('Trying to figure out region..')
-            try:
-                response = requests.get('http://169.254.169.254/latest/meta-data/placement/availability-zone',
-                                        timeout=2)
-            except Exception:
-                root_span.set_tag('error', True)
-                root_span.log_kv({'exception': traceback.format_exc()})
-                logger.exception('Region was not specified as a parameter and' +
-                                 'can not be fetched from instance meta-data!')
-                raise
-            region = response.text[:-1]
-        else:
-            region = args.region
-
+        # 1. Region is determined once on start up
         root_span.set_tag('region', region)
 
-        logger.info('Using region: {}'.format(region))
-
         logger.info('Entity service URL: %s', args.entityservice)
 
-        logger.info('Reading DNS data for hosted zones')
-        aws.populate_dns_data()
-
         aws_account_id = aws.get_account_id(region)
         infrastructure_account = 'aws:{}'.format(aws_account_id) if aws_account_id else None
 
         if not infrastructure_account:
-            logger.error('AWS agent: Cannot determine infrastructure account ID. Terminating!')
+            logger.error('AWS agent: Cannot determine infrastructure account ID. Skipping discovery!')
             return
         root_span.set_tag('account', infrastructure_account)
 
@@ -195,10 +203,63 @@ def main():
         zmon_client = Zmon(args.entityservice, token=token, user_agent=get_user_agent(), timeout=args.timeout)
 
         query = {'infrastructure_account': infrastructure_account, 'region': region, 'created_by': 'agent'}
-        entities = zmon_client.get_entities(query)
 
-        # 3. Get running apps
-        apps = aws.get_running_apps(region, entities)
+        # 3. Collect AWS entities. Independent collectors run concurrently, dependent ones start as soon as their
+        # inputs are ready. Collectors adding traffic tags need the DNS data first. Raw AWS data needed by several
+        # collectors is fetched once per cycle through the shared inventory. Most collectors only matter if the
+        # region has running apps, they run speculatively alongside the apps collector and their failures are
+        # ignored in a region without apps.
+        inventory = RegionInventory(region)
+
+        def read_dns_data(results):
+            logger.info('Reading DNS data for hosted zones')
+            aws.populate_dns_data(inventory=inventory)
+
+        tasks = [
+            Task('dns', read_dns_data),
+            Task('entities', lambda r: zmon_client.get_entities(query)),
+            Task('apps', lambda r: aws.get_running_apps(region, r['entities'], inventory=inventory),
+                 requires=['dns', 'entities']),
+            Task('elbs', speculative(lambda r: aws.get_running_elbs(region, infrastructure_account)),
+                 requires=['dns']),
+            Task('scaling_groups',
+                 speculative(lambda r: aws.get_auto_scaling_groups(region, infrastructure_account,
+                                                                   inventory=inventory)),
+                 requires=['dns']),
+            Task('elastigroups',
+                 speculative(lambda r: elastigroup.get_elastigroup_entities(region, infrastructure_account)),
+                 requires=['dns']),
+            Task('rds', speculative(lambda r: aws.get_rds_instances(region, infrastructure_account, r['entities'])),
+                 requires=['entities']),
+            Task('elasticaches', speculative(lambda r: aws.get_elasticache_nodes(region, infrastructure_account))),
+            Task('dynamodbs', speculative(lambda r: aws.get_dynamodb_tables(region, infrastructure_account))),
+            Task('certificates', speculative(lambda r: aws.get_certificates(region, infrastructure_account))),
+            Task('aws_limits',
+                 speculative(lambda r: aws.get_limits(region, infrastructure_account, r['apps'], r['elbs'],
+                                                      r['entities'])),
+                 requires=['apps', 'elbs', 'entities']),
+            Task('sqs', speculative(lambda r: aws.get_sqs_queues(region, infrastructure_account, r['entities'])),
+                 requires=['entities']),
+            Task('postgresql_clusters',
+                 speculative(lambda r: postgresql.get_postgresql_clusters(region, infrastructure_account,
+                                                                          r['scaling_groups'], r['apps'],
+                                                                          inventory=inventory)),
+                 requires=['dns', 'scaling_groups', 'apps']),
+            Task('account_alias', lambda r: aws.get_account_alias(region)),
+        ]
+
+        if args.postgresql_user and args.postgresql_pass:
+            tasks.append(Task('postgresql_databases',
+                              speculative(lambda r: postgresql.get_databases_from_clusters(
+                                  r['postgresql_clusters'], infrastructure_account, region, args.postgresql_user,
+                                  args.postgresql_pass, existing_entities=r['entities'])),
+                              requires=['postgresql_clusters', 'entities']))
+
+        timeout = max(deadline - time.time(), 0) if deadline is not None else None
+        results = run_tasks(tasks, max_workers=args.workers, timeout=timeout)
+
+        entities = results['entities']
+        apps = results['apps']
 
         elbs = []
         scaling_groups = []
@@ -209,25 +270,26 @@ def main():
         dynamodbs = []
         sqs = []
         postgresql_clusters = []
+        postgresql_databases = []
         aws_limits = []
 
         new_entities = []
         to_be_removed = []
 
         if len(apps) > 0:
-            elbs = aws.get_running_elbs(region, infrastructure_account)
-            scaling_groups = aws.get_auto_scaling_groups(region, infrastructure_account)
-            elastigroups = elastigroup.get_elastigroup_entities(region, infrastructure_account)
-            rds = aws.get_rds_instances(region, infrastructure_account, entities)
-            elasticaches = aws.get_elasticache_nodes(region, infrastructure_account)
-            dynamodbs = aws.get_dynamodb_tables(region, infrastructure_account)
-            certificates = aws.get_certificates(region, infrastructure_account)
-            aws_limits = aws.get_limits(region, infrastructure_account, apps, elbs, entities)
-            sqs = aws.get_sqs_queues(region, infrastructure_account, entities)
-            postgresql_clusters = postgresql.get_postgresql_clusters(region, infrastructure_account,
-                                                                     scaling_groups, apps)
-
-        account_alias = aws.get_account_alias(region)
+            elbs = get_result(results, 'elbs')
+            scaling_groups = get_result(results, 'scaling_groups')
+            elastigroups = get_result(results, 'elastigroups')
+            rds = get_result(results, 'rds')
+            elasticaches = get_result(results, 'elasticaches')
+            dynamodbs = get_result(results, 'dynamodbs')
+            certificates = get_result(results, 'certificates')
+            aws_limits = get_result(results, 'aws_limits')
+            sqs = get_result(results, 'sqs')
+            postgresql_clusters = get_result(results, 'postgresql_clusters')
+            postgresql_databases = get_result(results, 'postgresql_databases', [])
+
+        account_alias = results['account_alias']
         ia_entity = {
             'type': 'local',
             'infrastructure_account': infrastructure_account,
@@ -245,23 +307,17 @@ def main():
 
         application_entities = aws.get_apps_from_entities(apps, infrastructure_account, region)
 
-        if args.postgresql_user and args.postgresql_pass:
-            postgresql_databases = postgresql.get_databases_from_clusters(postgresql_clusters,
-                                                                          infrastructure_account,
-                                                                          region,
-                                                                          args.postgresql_user,
-                                                                          args.postgresql_pass)
-        else:
+        if not (args.postgresql_user and args.postgresql_pass):
             # Pretend the list of DBs is empty, but also make sure we don't remove
             # any pre-existing database entities because we don't know about them.
-            postgresql_databases = []
             entities = [e for e in entities if e.get('type') != 'postgresql_database']
 
         current_entities = (
             elbs + scaling_groups + elastigroups + apps + application_entities +
             rds + postgresql_databases + postgresql_clusters + elasticaches + dynamodbs +
             certificates + sqs)
-        current_entities.append(aws_limits)
+        if aws_limits:
+            current_entities.append(aws_limits)
         current_entities.append(ia_entity)
 
         for entity in current_entities:
@@ -317,5 +373,68 @@ def main():
             print(json.dumps(d, indent=4))
 
 
+def run_daemon(args, region):
+    """Repeat the discovery forever, keeping clients, caches and the OAuth token between cycles."""
+    while True:
+        started = time.time()
+        try:
+            discover(args, region, deadline=started + args.cycle_timeout)
+        except Exception as e:
+            if isinstance(e, TasksTimeout):
+                logger.error('AWS agent discovery cycle timed out: {}'.format(e))
+            else:
+                logger.exception('AWS agent discovery cycle failed!')
+
+            # collectors which are still running would race with the next cycle on the shared caches
+            _, not_done = wait(getattr(e, 'futures', []), timeout=args.cycle_timeout)
+            if not_done:
+                logger.error('AWS agent collectors did not finish, exiting!')
+                # hanging worker threads would block a regular exit
+                os._exit(1)
+
+        logger.info('Discovery cycle took {:.1f} seconds, sleeping {} seconds'.format(
+                    time.time() - started, args.interval))
+        time.sleep(args.interval)
+
+
+def main():
+    argp = argparse.ArgumentParser(description='ZMON AWS Agent')
+    argp.add_argument('-e', '--entity-service', dest='entityservice')
+    argp.add_argument('-r', '--region', dest='region', default=None)
+    argp.add_argument('-j', '--json', dest='json', action='store_true')
+    argp.add_argument('-t', '--tracer', dest='tracer', default=os.environ.get('OPENTRACING_TRACER', 'noop'))
+    argp.add_argument('-T', '--timeout', dest='timeout', default=15, type=int)  # default in zmon is 10 sec
+    argp.add_argument('-w', '--workers', dest='workers', default=COLLECTOR_WORKERS, type=int,
+                      help='Number of collectors running concurrently')
+    argp.add_argument('-d', '--daemon', dest='daemon', action='store_true', default=False,
+                      help='Keep running and repeat the discovery every --interval seconds')
+    argp.add_argument('--interval', dest='interval', type=int, default=int(os.environ.get('AGENT_SLEEP_SECONDS', 60)),
+                      help='Seconds to sleep between two discovery cycles in daemon mode')
+    argp.add_argument('--cycle-timeout', dest='cycle_timeout', type=int,
+                      default=int(os.environ.get('AGENT_CYCLE_TIMEOUT', 540)),
+                      help='Maximum duration of a discovery cycle in daemon mode')
+    argp.add_argument('--no-oauth2', dest='disable_oauth2', action='store_true', default=False)
+    argp.add_argument('--postgresql-user', dest='postgresql_user', default=os.environ.get('AGENT_POSTGRESQL_USER'))
+    argp.add_argument('--postgresql-pass', dest='postgresql_pass', default=os.environ.get('AGENT_POSTGRESQL_PASS'))
+    args = argp.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if not args.disable_oauth2:
+        tokens.configure()
+        tokens.manage('uid', ['uid'])
+        tokens.start()
+
+    init_opentracing_tracer(args.tracer)
+
+    region = args.region or get_region()
+    logger.info('Using region: {}'.format(region))
+
+    if args.daemon:
+        run_daemon(args, region)
+    else:
+        discover(args, region)
+
+
 if __name__ == '__main__':
     main()
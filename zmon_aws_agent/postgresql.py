@@ -1,14 +1,17 @@
 import logging
 import psycopg2
-import boto3
 import yaml
 import base64
 import traceback
 import os
+import time
+
+from botocore.exceptions import ClientError
 
 # better move that one to common?
-from zmon_aws_agent.aws import entity_id
-from zmon_aws_agent.common import call_and_retry, clean_opentracing_span
+from zmon_aws_agent.aws import entity_id, populate_dns_data, DNS_ZONE_CACHE, DNS_CNAME_INDEX
+from zmon_aws_agent.common import call_and_retry, clean_opentracing_span, get_client, parallel_map
+from zmon_aws_agent.inventory import RegionInventory, index_by
 
 from opentracing_utils import trace, extract_span_from_kwargs
 from opentracing.ext import tags as ot_tags
@@ -18,6 +21,16 @@ logger = logging.getLogger(__name__)
 
 POSTGRESQL_DEFAULT_PORT = 5432
 POSTGRESQL_CONNECT_TIMEOUT = os.environ.get('AGENT_POSTGRESQL_CONNECT_TIMEOUT', 2)
+POSTGRESQL_MAX_WORKERS = int(os.environ.get('AGENT_POSTGRESQL_MAX_WORKERS', 10))
+POSTGRESQL_DISCOVERY_TIMEOUT = int(os.environ.get('AGENT_POSTGRESQL_DISCOVERY_TIMEOUT', 120))
+POSTGRESQL_DATABASES_TTL = int(os.environ.get('AGENT_POSTGRESQL_DATABASES_TTL', 3600))
+
+# EIP_ALLOCATION of launch configurations and template versions:
+# ('lc', name) or ('lt', 'LaunchTemplateId' or 'LaunchTemplateName', template, version) -> allocation
+EIP_ALLOCATION_CACHE = {}
+
+# databases of PostgreSQL clusters: dnsname -> (expiry, database names)
+POSTGRESQL_DATABASES_CACHE = {}
 
 
 @trace(pass_span=True, tags={'aws': 'postgres'})
@@ -38,59 +51,98 @@ def list_postgres_databases(*args, **kwargs):
 
         kwargs.update({'connect_timeout': POSTGRESQL_CONNECT_TIMEOUT})
         conn = psycopg2.connect(*args, **kwargs)
-        cur = conn.cursor()
-        cur.execute(query)
-        return [row[0] for row in cur.fetchall()]
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query)
+                return [row[0] for row in cur.fetchall()]
+        finally:
+            conn.close()
     except Exception:
         current_span.set_tag('error', True)
         current_span.log_kv({'exception': traceback.format_exc()})
         logger.exception('Failed to list DBs!')
-        return []
+        return None
 
 
 @trace(tags={'aws': 'postgres'})
 def get_databases_from_clusters(pgclusters, infrastructure_account, region,
-                                postgresql_user, postgresql_pass):
+                                postgresql_user, postgresql_pass, existing_entities=None):
     entities = []
 
-    for pg in pgclusters:
+    clusters = [pg for pg in pgclusters if pg.get('dnsname')]
+
+    def list_databases(pg):
         try:
-            dnsname = pg.get('dnsname')
-
-            if dnsname:
-                dbnames = list_postgres_databases(host=dnsname,
-                                                  port=POSTGRESQL_DEFAULT_PORT,
-                                                  user=postgresql_user,
-                                                  password=postgresql_pass,
-                                                  dbname='postgres',
-                                                  sslmode='require')
-                for db in dbnames:
-                    entity = {
-                        'id': entity_id('{}-{}[{}:{}]'.format(db, dnsname, infrastructure_account, region)),
-                        'type': 'postgresql_database',
-                        'created_by': 'agent',
-                        'infrastructure_account': infrastructure_account,
-                        'region': region,
-
-                        'postgresql_cluster': pg.get('id'),
-                        'database_name': db,
-                        'shards': {
-                            db: '{}:{}/{}'.format(dnsname, POSTGRESQL_DEFAULT_PORT, db)
-                        }
-                    }
-                    entities.append(entity)
+            return list_postgres_databases(host=pg['dnsname'],
+                                           port=POSTGRESQL_DEFAULT_PORT,
+                                           user=postgresql_user,
+                                           password=postgresql_pass,
+                                           dbname='postgres',
+                                           sslmode='require')
         except Exception:
-            logger.exception('Failed to make Database entities for PostgreSQL clusters on {}!'
-                             .format(pg.get('dnsname', '')))
+            logger.exception('Failed to make Database entities for PostgreSQL clusters on {}!'.format(pg['dnsname']))
+            return None
+
+    now = time.time()
+
+    # databases are rarely added or dropped, so the lists are only refreshed after POSTGRESQL_DATABASES_TTL
+    for dnsname in set(POSTGRESQL_DATABASES_CACHE.keys()) - {pg['dnsname'] for pg in clusters}:
+        del POSTGRESQL_DATABASES_CACHE[dnsname]
+
+    databases = {dnsname: dbnames for dnsname, (expiry, dbnames) in POSTGRESQL_DATABASES_CACHE.items() if expiry > now}
+    stale = [pg for pg in clusters if pg['dnsname'] not in databases]
+
+    # unreachable clusters block until the connect timeout, so they are queried concurrently and the whole step is
+    # limited, clusters which failed or did not answer in time keep their last known databases
+    cluster_dbnames = parallel_map(list_databases, stale, max_workers=POSTGRESQL_MAX_WORKERS,
+                                   timeout=POSTGRESQL_DISCOVERY_TIMEOUT)
+
+    for pg, dbnames in zip(stale, cluster_dbnames):
+        if dbnames is None:
+            if pg['dnsname'] in POSTGRESQL_DATABASES_CACHE:
+                logger.warning('Listing databases of PostgreSQL cluster on {} failed, using the last known '
+                               'databases!'.format(pg['dnsname']))
+                databases[pg['dnsname']] = POSTGRESQL_DATABASES_CACHE[pg['dnsname']][1]
+            continue
+
+        databases[pg['dnsname']] = dbnames
+        POSTGRESQL_DATABASES_CACHE[pg['dnsname']] = (now + POSTGRESQL_DATABASES_TTL, dbnames)
+
+    for pg in clusters:
+        dnsname = pg['dnsname']
+        dbnames = databases.get(dnsname)
+
+        if dbnames is None:
+            # keep the existing entities, they would be removed otherwise and added again in the next run
+            logger.warning('Listing databases of PostgreSQL cluster on {} failed or timed out!'.format(dnsname))
+            entities.extend(e for e in existing_entities or []
+                            if e.get('type') == 'postgresql_database' and e.get('postgresql_cluster') == pg.get('id'))
+            continue
+
+        for db in dbnames:
+            entity = {
+                'id': entity_id('{}-{}[{}:{}]'.format(db, dnsname, infrastructure_account, region)),
+                'type': 'postgresql_database',
+                'created_by': 'agent',
+                'infrastructure_account': infrastructure_account,
+                'region': region,
+
+                'postgresql_cluster': pg.get('id'),
+                'database_name': db,
+                'shards': {
+                    db: '{}:{}/{}'.format(dnsname, POSTGRESQL_DEFAULT_PORT, db)
+                }
+            }
+            entities.append(entity)
 
     return entities
 
 
 @trace(tags={'aws': 'ec2'})
-def collect_eip_addresses(infrastructure_account, region):
-    ec2 = boto3.client('ec2', region_name=region)
+def collect_eip_addresses(infrastructure_account, region, inventory=None):
+    inventory = inventory or RegionInventory(region)
 
-    addresses = call_and_retry(ec2.describe_addresses)['Addresses']
+    addresses = inventory.addresses
 
     return [a for a in addresses if a.get('NetworkInterfaceOwnerId') == infrastructure_account.split(':')[1]]
 
@@ -104,74 +156,123 @@ def filter_instances(infrastructure_account, instances):
     return [i for i in instances if i.get('infrastructure_account') == infrastructure_account]
 
 
-@trace(tags={'aws': 'asg'})
-def collect_launch_configurations(infrastructure_account, region):
-    asg = boto3.client('autoscaling', region_name=region)
-    lc_paginator = asg.get_paginator('describe_launch_configurations')
-    lcs = call_and_retry(lambda: lc_paginator.paginate().build_full_result()['LaunchConfigurations'])
-
-    user_data = {}
-
-    for lc in lcs:
-        # LaunchConfigurationName takes the form of spilo-your-cluster-AppServerInstanceProfile-66CCXX77EEPP
-        lc_name = '-'.join(lc.get('LaunchConfigurationName', '').split('-')[1:-2])
-        user_data[lc_name] = lc.get('UserData')
+def get_launch_specification(asg):
+    """
+    Return the key of the launch configuration or launch template version an ASG launches its instances with.
+    """
+    if asg.get('LaunchConfigurationName'):
+        return 'lc', asg['LaunchConfigurationName']
 
-    return user_data
+    template = asg.get('LaunchTemplate') or \
+        asg.get('MixedInstancesPolicy', {}).get('LaunchTemplate', {}).get('LaunchTemplateSpecification')
+    if template and (template.get('LaunchTemplateId') or template.get('LaunchTemplateName')):
+        # templates are referenced either by ID or by name
+        field = 'LaunchTemplateId' if template.get('LaunchTemplateId') else 'LaunchTemplateName'
+        version = template.get('Version', '$Default')
+        return 'lt', field, template[field], version
 
+    return None
 
-def extract_eipalloc_from_lc(launch_configuration, cluster_name):
-    lc = launch_configuration.get(cluster_name, '')
 
-    user_data = base64.decodebytes(lc.encode('utf-8')).decode('utf-8')
+def extract_eipalloc_from_user_data(user_data):
+    user_data = base64.decodebytes((user_data or '').encode('utf-8')).decode('utf-8')
     user_data = yaml.safe_load(user_data)
 
+    if not isinstance(user_data, dict):
+        return ''
+
     return user_data.get('environment', {}).get('EIP_ALLOCATION', '')
 
 
-@trace(tags={'aws': 'route53'})
-def collect_hosted_zones(infrastructure_account, region):
-    r53 = boto3.client('route53', region_name=region)
-    hosted_zones = r53.list_hosted_zones()  # we expect here approx. one entry
-    return [hz['Id'] for hz in hosted_zones['HostedZones']]
+@trace(tags={'aws': 'asg'})
+def collect_eip_allocations(infrastructure_account, region, asg_names, inventory=None):
+    """
+    Return the EIP_ALLOCATION of the launch configurations or templates of the given ASGs, keyed by ASG name.
+
+    Only the configurations referenced by the ASGs are described. Launch configurations and template versions can not
+    be changed, so their allocations are cached.
+    """
+    inventory = inventory or RegionInventory(region)
+
+    specs = {}
+    for name in asg_names:
+        asg = inventory.asgs_by_name.get(name)
+        spec = get_launch_specification(asg) if asg else None
+        if spec:
+            specs[name] = spec
+
+    for spec in set(EIP_ALLOCATION_CACHE.keys()) - set(specs.values()):
+        del EIP_ALLOCATION_CACHE[spec]
+
+    allocations = {}
+
+    lc_names = sorted({spec[1] for spec in specs.values() if spec[0] == 'lc' and spec not in EIP_ALLOCATION_CACHE})
+    if lc_names:
+        asg_client = get_client('autoscaling', region)
+        for names in [lc_names[i: i + 50] for i in range(0, len(lc_names), 50)]:
+            lcs = call_and_retry(asg_client.describe_launch_configurations,
+                                 LaunchConfigurationNames=names)['LaunchConfigurations']
+            for lc in lcs:
+                EIP_ALLOCATION_CACHE[('lc', lc['LaunchConfigurationName'])] = \
+                    extract_eipalloc_from_user_data(lc.get('UserData'))
+
+    templates = sorted({spec for spec in specs.values() if spec[0] == 'lt' and spec not in EIP_ALLOCATION_CACHE})
+    if templates:
+        ec2_client = get_client('ec2', region)
+        for spec in templates:
+            _, field, template, version = spec
+            try:
+                versions = call_and_retry(ec2_client.describe_launch_template_versions,
+                                          Versions=[version], **{field: template})['LaunchTemplateVersions']
+            except ClientError:
+                # deleted templates or versions must not fail the discovery of all clusters
+                logger.exception('Failed to describe version {} of launch template {}'.format(version, template))
+                allocations[spec] = ''
+                continue
+
+            eip_allocation = ''
+            if versions:
+                eip_allocation = extract_eipalloc_from_user_data(versions[0]['LaunchTemplateData'].get('UserData'))
+
+            # symbolic versions like $Latest can point to another version next time
+            if version.isdigit():
+                EIP_ALLOCATION_CACHE[spec] = eip_allocation
+            else:
+                allocations[spec] = eip_allocation
 
+    allocations.update(EIP_ALLOCATION_CACHE)
 
-@trace(tags={'aws': 'route53'})
-def collect_recordsets(infrastructure_account, region):
-    r53 = boto3.client('route53', region_name=region)
-    hosted_zone_ids = collect_hosted_zones(infrastructure_account, region)
-    rs_paginator = r53.get_paginator('list_resource_record_sets')
+    return {name: allocations.get(spec, '') for name, spec in specs.items()}
 
-    recordsets = []
-    for hz in hosted_zone_ids:
-        recordsets = call_and_retry(
-            lambda: rs_paginator.paginate(HostedZoneId=hz).build_full_result()['ResourceRecordSets'])
 
-    ret = {}
-    for rs in recordsets:
-        if rs['Type'] == 'CNAME':
-            rcs = rs.get('ResourceRecords', [])
-            if rcs:
-                ip = rcs[0]['Value'].split('.')[0].replace('ec2-', '').replace('-', '.')
-                ret[ip] = rs.get('Name', '')[0:-1]  # cut off the final .
+def collect_recordsets(infrastructure_account, region, inventory=None):
+    """Return the DNS names of public IPs, from the DNS data shared with the other collectors."""
+    if not DNS_ZONE_CACHE:
+        populate_dns_data(inventory=inventory)
 
-    return ret
+    return dict(DNS_CNAME_INDEX)
 
 
 @trace(tags={'aws': 'postgres'})
-def get_postgresql_clusters(region, infrastructure_account, asgs, insts):
+def get_postgresql_clusters(region, infrastructure_account, asgs, insts, inventory=None):
+    inventory = inventory or RegionInventory(region)
+
     entities = []
 
     try:
-        addresses = collect_eip_addresses(infrastructure_account, region)
+        addresses = collect_eip_addresses(infrastructure_account, region, inventory=inventory)
         spilo_asgs = filter_asgs(infrastructure_account, asgs)
         instances = filter_instances(infrastructure_account, insts)
-        dns_records = collect_recordsets(infrastructure_account, region)
+        dns_records = collect_recordsets(infrastructure_account, region, inventory=inventory)
     except Exception:
         logger.exception('Failed to collect the AWS objects for PostgreSQL cluster detection')
         return []
 
-    launch_configs = []
+    instances_by_id = index_by(instances, 'aws_id')
+    eips_by_instance = index_by(addresses, 'InstanceId')
+    eips_by_allocation = index_by(addresses, 'AllocationId')
+
+    eip_allocations = None
 
     # we will use the ASGs as a skeleton for building the entities
     for cluster in spilo_asgs:
@@ -186,10 +287,10 @@ def get_postgresql_clusters(region, infrastructure_account, asgs, insts):
         for i in cluster['instances']:
             instance_id = i['aws_id']
 
-            try:
-                i_data = [inst for inst in instances if inst['aws_id'] == instance_id][0]
-            except IndexError:
-                logger.exception('Failed to find a Spilo EC2 instance: %s', instance_id)
+            i_data = instances_by_id.get(instance_id)
+            if not i_data:
+                logger.error('Failed to find a Spilo EC2 instance: %s', instance_id)
+                continue
 
             private_ip = i_data['ip']
             role = i_data.get('role', '')
@@ -198,9 +299,9 @@ def get_postgresql_clusters(region, infrastructure_account, asgs, insts):
                                       'private_ip': private_ip,
                                       'role': role})
 
-            address = [a for a in addresses if a.get('InstanceId') == instance_id]
+            address = eips_by_instance.get(instance_id)
             if address:
-                eip.append(address[0])  # we currently expect only one EIP per instance
+                eip.append(address)  # we currently expect only one EIP per instance
 
         if len(eip) > 1:
             pass  # in the future, this might be a valid case, when replicas also get public IPs
@@ -210,15 +311,16 @@ def get_postgresql_clusters(region, infrastructure_account, asgs, insts):
 
             # this is so for reducing boto3 call numbers
             try:
-                if not launch_configs:
-                    launch_configs = collect_launch_configurations(infrastructure_account, region)
+                if eip_allocations is None:
+                    eip_allocations = collect_eip_allocations(infrastructure_account, region,
+                                                              [asg['name'] for asg in spilo_asgs], inventory=inventory)
 
-                eip_allocation = extract_eipalloc_from_lc(launch_configs, cluster_name)
+                eip_allocation = eip_allocations.get(cluster['name'], '')
 
                 if eip_allocation:
-                    address = [a for a in addresses if a.get('AllocationId') == eip_allocation]
+                    address = eips_by_allocation.get(eip_allocation)
                     if address:
-                        public_ip = address[0]['PublicIp']
+                        public_ip = address['PublicIp']
                         allocation_error = 'There is a public IP defined but not attached to any instance'
             except Exception:
                 logger.exception('Failed to collect launch configurations')
@@ -0,0 +1,96 @@
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, FIRST_COMPLETED, wait
+
+from opentracing_utils.span import inspect_span_from_stack
+
+
+COLLECTOR_WORKERS = int(os.environ.get('AGENT_COLLECTOR_WORKERS', 8))
+
+logger = logging.getLogger(__name__)
+
+
+class TasksTimeout(TimeoutError):
+    """
+    Raised by ``run_tasks`` when the tasks did not finish in time. ``futures`` are the tasks which are still running.
+    """
+
+    def __init__(self, message, futures):
+        super().__init__(message)
+        self.futures = futures
+
+
+class Task:
+    """
+    A named collector step and the names of the tasks whose results it needs.
+    """
+
+    def __init__(self, name, fn, requires=None):
+        self.name = name
+        self.fn = fn
+        self.requires = list(requires or [])
+
+
+def _run_task(task, inputs, parent_span):
+    # ``parent_span`` is kept as a local, so traced collectors running in this worker thread
+    # find it while inspecting the call stack and are attached to the caller's trace.
+    start = time.time()
+    result = task.fn(inputs)
+    logger.debug('Task {} finished in {:.2f}s'.format(task.name, time.time() - start))
+    return result
+
+
+def run_tasks(tasks, max_workers=COLLECTOR_WORKERS, timeout=None):
+    """
+    Run ``tasks`` on a bounded thread pool, starting every task as soon as all of its requirements are done.
+
+    Each task function receives a dict with the results of the tasks it requires. Returns a dict with the results
+    of all tasks keyed by task name. If a task fails, tasks which did not start yet are cancelled and the exception
+    is re-raised. ``timeout`` bounds the whole run in seconds and raises ``TasksTimeout`` when exceeded. Running tasks
+    can not be interrupted, they keep running in the background and are attached as ``futures`` to the exception.
+    """
+    by_name = {t.name: t for t in tasks}
+    for t in tasks:
+        missing = [r for r in t.requires if r not in by_name]
+        if missing:
+            raise ValueError('Task {} requires unknown tasks: {}'.format(t.name, ', '.join(missing)))
+
+    deadline = time.time() + timeout if timeout is not None else None
+    parent_span = inspect_span_from_stack()
+
+    results = {}
+    pending = list(tasks)
+    running = {}
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while pending or running:
+            ready = [t for t in pending if all(r in results for r in t.requires)]
+            for t in ready:
+                pending.remove(t)
+                inputs = {r: results[r] for r in t.requires}
+                running[executor.submit(_run_task, t, inputs, parent_span)] = t
+
+            if not running:
+                raise ValueError('Tasks have cyclic requirements: {}'.format(', '.join(t.name for t in pending)))
+
+            remaining = max(deadline - time.time(), 0) if deadline is not None else None
+            done, _ = wait(running, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                raise TasksTimeout('Tasks did not finish in time: {}'.format(
+                    ', '.join(t.name for t in list(running.values()) + pending)), list(running))
+
+            for future in done:
+                t = running.pop(future)
+                results[t.name] = future.result()
+    except Exception as e:
+        e.futures = [f for f in running if not f.done()]
+        raise
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    return results